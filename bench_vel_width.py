@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the velocity width statistics, using synthetic spectra so that no snapshot or save file is needed.
+Usage: python bench_vel_width.py [output.json]
+Timings for each benchmark and size are written as JSON, labelled with the git commit, so that runs can be compared."""
+
+from __future__ import print_function
+import sys
+import os.path as path
+import subprocess
+import time
+import json
+import platform
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from fake_spectra import line_data
+import vw_plotspectra as ps
+
+#(NumLos, nbins, number of lines) for each benchmark run
+SIZES = [(500, 1000, 2), (2000, 1000, 4), (5000, 2000, 6)]
+
+class SyntheticSpectra(ps.VWPlotSpectra):
+    """
+    Spectra with multi-component absorbers made from random numbers, rather than computed from a snapshot.
+    Nothing is read from or written to disc.
+    nlos - number of spectra
+    nbins - number of velocity bins in each spectrum
+    nlines - number of lines of the synthetic ion, with oscillator strengths spread over several decades
+    ncomp - maximum number of absorption components in each spectrum
+    """
+    def __init__(self, nlos=1000, nbins=1000, nlines=4, ncomp=6, seed=23, snr=0., spec_res=8., dvbin=1.):
+        self.NumLos = nlos
+        self.nbins = nbins
+        self.dvbin = dvbin
+        self.snr = snr
+        self.spec_res = spec_res
+        self.minwidth = 500.
+        self.velfac = 1.
+        self.rscale = 1.
+        self.label = "Synthetic"
+        self.savefile = None
+        self.tau_obs = {}
+        self.tau = {}
+        self.absorber_width = {}
+        self.colden = {}
+        self.velocity = {}
+        self.temp = {}
+        self.num_important = {}
+        #Synthetic lines for SiII, strongest first
+        lines = {}
+        for ii in range(nlines):
+            lines[1190+100*ii] = line_data.Line(1190.+100*ii, 1.5*10**(-0.7*ii), 1e9)
+        self.lines = {("Si", 2): lines, ("H", 1): {1215: line_data.Line(1215.67, 0.4164, 6.265e8)}}
+        self.profile = self._make_profile(ncomp, seed)
+
+    def _make_profile(self, ncomp, seed):
+        """Sum of up to ncomp components in each spectrum, each a Gaussian core with Lorentzian wings,
+        like a Voigt profile. Components cluster around a random centre, as in a halo. Periodic in velocity."""
+        rng = np.random.RandomState(seed)
+        vel = np.arange(self.nbins)*self.dvbin
+        vmax = self.nbins*self.dvbin
+        centre = rng.uniform(0, vmax, self.NumLos)
+        ncomps = rng.randint(1, ncomp+1, self.NumLos)
+        profile = np.zeros((self.NumLos, self.nbins))
+        for ii in range(ncomp):
+            pos = centre + rng.normal(0, 60, self.NumLos)
+            bpar = rng.uniform(3, 30, self.NumLos)
+            amp = 10**rng.uniform(-2, 2.5, self.NumLos)*(ii < ncomps)
+            dist = np.mod(vel[np.newaxis,:] - pos[:,np.newaxis] + vmax/2, vmax) - vmax/2
+            bb = bpar[:,np.newaxis]
+            profile += amp[:,np.newaxis]*(np.exp(-dist**2/bb**2) + 1e-3*bb**2/(dist**2+bb**2))
+        return profile
+
+    def compute_spectra(self, elem, ion, ll, get_tau):
+        """Optical depth in a line, proportional to fosc * lambda, or the column density."""
+        if not get_tau:
+            if elem == "H":
+                return 1e19*self.profile
+            return 1e14*self.profile
+        line = self.lines[(elem, ion)][ll]
+        return self.profile*line.fosc_X*line.lambda_X/1190.
+
+def _setup(hspec, names, deps=()):
+    """Empty the named caches of a spectra object, then compute the quantities the benchmark depends on,
+    in case an earlier benchmark discarded them."""
+    for name in names:
+        hspec._cache(name).clear()
+    for dep in deps:
+        dep()
+
+def _benchmarks(hspec):
+    """
+    List of (name, setup, function) to time. setup empties the caches of the quantity being timed,
+    and makes sure the quantities it depends on are computed, so each benchmark times only its own stage.
+    Recomputing the observer tau discards everything derived from it, so these are recomputed where needed.
+    """
+    vel_data = hspec.vel_width("Si", 2)
+    v_table = 10**np.arange(1, 3, 0.1)
+    def plot_errors():
+        """Bootstrap errors plot, as used for the comparison to data"""
+        hspec._plot_errors(vel_data, v_table, 100, 5, False, True)
+        plt.clf()
+    obs_tau = lambda: hspec.get_observer_tau("Si", 2)
+    absorber = lambda: hspec.find_absorber_width("Si", 2)
+    vel_stats = lambda: hspec.vel_stats("Si", 2)
+    filt = lambda: hspec.get_filt("Si", 2)
+    return [("find_absorber_width", lambda: _setup(hspec, ["absorber_width"], [obs_tau]), absorber),
+            ("get_observer_tau", lambda: _setup(hspec, ["tau_obs", "tau_conv", "tau_noise"]), obs_tau),
+            ("vel_width", lambda: _setup(hspec, ["vel_statistics"], [obs_tau, absorber]), lambda: hspec.vel_width("Si", 2)),
+            ("vel_mean_median", lambda: _setup(hspec, ["vel_statistics"], [obs_tau, absorber]), lambda: hspec.vel_mean_median("Si", 2)),
+            ("vel_peak", lambda: _setup(hspec, ["vel_statistics"], [obs_tau, absorber]), lambda: hspec.vel_peak("Si", 2)),
+            ("get_separated", lambda: _setup(hspec, [], [obs_tau, filt]), lambda: hspec.get_separated("Si", 2)),
+            ("_vel_stat_hist", lambda: _setup(hspec, ["stat_hists"], [obs_tau, absorber, vel_stats, filt]), lambda: hspec._vel_stat_hist("Si", 2, 0.1, hspec.vel_width)),
+            ("_plot_errors", lambda: None, plot_errors)]
+
+def time_benchmarks(nlos, nbins, nlines, repeat=3):
+    """Time each benchmark for one size of synthetic spectra. Returns a list of dictionaries, one per benchmark."""
+    hspec = SyntheticSpectra(nlos, nbins, nlines)
+    results = []
+    for (name, setup, func) in _benchmarks(hspec):
+        times = []
+        for _ in range(repeat):
+            setup()
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+        results.append({"name":name, "nlos":nlos, "nbins":nbins, "nlines":nlines, "repeat":repeat,
+                        "best":np.min(times), "mean":np.mean(times)})
+        print(name," NumLos=",nlos," nbins=",nbins," nlines=",nlines," best: ",np.min(times)," s")
+    return results
+
+def git_commit():
+    """Hash of the current git commit of this repository, or None if it is not available."""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=path.dirname(path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode().strip()
+
+def run_benchmarks(outfile="bench_vel_width.json", sizes=None, repeat=3):
+    """Run all the benchmarks for each size, and save the timings to outfile."""
+    if sizes is None:
+        sizes = SIZES
+    results = []
+    for (nlos, nbins, nlines) in sizes:
+        results += time_benchmarks(nlos, nbins, nlines, repeat)
+    output = {"commit":git_commit(), "time":time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python":platform.python_version(), "numpy":np.__version__, "results":results}
+    with open(outfile, 'w') as f:
+        json.dump(output, f, indent=1)
+    print("Saved benchmarks to ",outfile)
+    return output
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run_benchmarks(sys.argv[1])
+    else:
+        run_benchmarks()
@@ -2,15 +2,129 @@
 """Class to generate spectra in the positions where there is a DLA, as known from the grid generation."""
 
 from __future__ import print_function
+import time
+import json
 import numpy as np
 import hdfsim
 import h5py
 import vw_spectra
 import os.path as path
 
+class GridSampler(object):
+    """
+    Draws random cells from the lists of DLA and LLS cells in a grid file.
+    Only the cells drawn are read from the file, so memory and I/O scale with the number of cells wanted,
+    not the size of the grid. Stratified sampling needs two passes over the column densities,
+    but these are read chunk cells at a time.
+    gridfile - grid file, with the lists of cells in the abslists group.
+    lists - lists of cells to draw from, out of DLA and LLS. These are treated as a single combined list.
+    seed - seed for the random number generator, self.rng, which is also used to place sightlines within a cell.
+    """
+    def __init__(self, gridfile, lists=("DLA", "LLS"), seed=23, chunk=2**22):
+        self.gridfile = gridfile
+        self.lists = lists
+        self.chunk = chunk
+        self.rng = np.random.default_rng(seed)
+        f = h5py.File(gridfile,'r')
+        self.ngrid = np.array(f["HaloData"]["ngrid"])
+        sizes = [f["abslists"][name].shape[-1] for name in lists]
+        f.close()
+        #Start of each list in the combined list
+        self.starts = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def _read(self, suffix, index):
+        """Read the entries index of the combined list from the datasets abslists/<list><suffix>.
+        The last axis of each dataset indexes the cells."""
+        index = np.asarray(index, dtype=np.int64)
+        data = None
+        f = h5py.File(self.gridfile,'r')
+        for (ii, name) in enumerate(self.lists):
+            here = np.where(np.logical_and(index >= self.starts[ii], index < self.starts[ii+1]))[0]
+            if np.size(here) == 0:
+                continue
+            dset = f["abslists"][name+suffix]
+            if data is None:
+                data = np.zeros(dset.shape[:-1]+(np.size(index),), dtype=dset.dtype)
+            #h5py can only read sorted, unique lists of entries
+            (cells, inverse) = np.unique(index[here]-self.starts[ii], return_inverse=True)
+            sel = (slice(None),)*(dset.ndim-1)+(cells,)
+            data[..., here] = np.take(dset[sel], np.ravel(inverse), axis=-1)
+        f.close()
+        return data
+
+    def cells(self, index):
+        """Grid indices of the entries index of the combined list, as a 3xN array"""
+        return self._read("", index)
+
+    def values(self, index):
+        """Log column density of the entries index of the combined list"""
+        return self._read("_val", index)
+
+    def sample(self, num, strata=None):
+        """
+        Draw num random entries from the combined list, returning their indices.
+        strata - if not None, bin edges in log column density. An equal number of cells is drawn
+                 from each bin which is not empty. Cells outside the edges are in the first or last bin.
+        """
+        if len(self) == 0:
+            raise ValueError("No cells in "+str(self.lists)+" in "+self.gridfile)
+        if strata is None:
+            return self.rng.integers(0, len(self), num)
+        return self._sample_stratified(num, strata)
+
+    def _strata(self, strata):
+        """Iterate over the combined list in chunks, yielding the start of each chunk and the bin of each cell in it."""
+        nstrata = np.size(strata)-1
+        f = h5py.File(self.gridfile,'r')
+        try:
+            for (ii, name) in enumerate(self.lists):
+                dset = f["abslists"][name+"_val"]
+                for start in range(0, dset.shape[-1], self.chunk):
+                    stratum = np.clip(np.digitize(dset[start:start+self.chunk], strata)-1, 0, nstrata-1)
+                    yield (self.starts[ii]+start, stratum)
+        finally:
+            f.close()
+
+    def _sample_stratified(self, num, strata):
+        """Draw num random entries from the combined list, with equal numbers from each column density bin."""
+        nstrata = np.size(strata)-1
+        counts = np.zeros(nstrata, dtype=np.int64)
+        for (_, stratum) in self._strata(strata):
+            counts += np.bincount(stratum, minlength=nstrata)
+        full = np.where(counts > 0)[0]
+        #Equal numbers from each bin, with the remainder from randomly chosen bins
+        nper = np.zeros(nstrata, dtype=np.int64)
+        nper[full] = num // np.size(full)
+        nper[self.rng.choice(full, num % np.size(full), replace=False)] += 1
+        #Bin of each cell drawn and its position in the bin
+        drawn = np.repeat(np.arange(nstrata), nper)
+        rank = self.rng.integers(0, counts[drawn])
+        index = np.zeros(num, dtype=np.int64)
+        seen = np.zeros(nstrata, dtype=np.int64)
+        for (start, stratum) in self._strata(strata):
+            for ss in full:
+                here = np.where(stratum == ss)[0]
+                want = np.where(np.logical_and(drawn == ss, np.logical_and(rank >= seen[ss], rank < seen[ss]+np.size(here))))
+                index[want] = start + here[rank[want]-seen[ss]]
+                seen[ss] += np.size(here)
+        return self.rng.permutation(index)
+
 class GridSpectra(vw_spectra.VWSpectra):
-    """Generate metal line spectra from simulation snapshot"""
-    def __init__(self,num, base, numlos=5000, res = 1., cdir = None, dla=True, savefile="grid_spectra_DLA.hdf5", savedir=None, gridfile="boxhi_grid_H2.hdf5"):
+    """Generate metal line spectra from simulation snapshot, along sightlines through cells of the grid
+    known to contain a DLA or an LLS.
+    seed - seed for choosing the sightlines.
+    strata - if not None, bin edges in log column density: cells are drawn equally from each bin. See GridSampler.
+    margin - if not None, cells whose column density in the grid is more than margin dex below the threshold are discarded
+             without computing their spectra. This is faster, but makes the DLA incidence correction approximate,
+             and draws a different sample. By default every cell drawn has its spectra computed. See replace_not_DLA.
+    oversample - if margin is set, number of candidate cells drawn in each round of replace_not_DLA, per sightline still needed.
+    append - if True, add numlos new sightlines to an existing save file rather than making a new one.
+             Cells are drawn by continuing the random number stream saved with the file, so the new sightlines
+             are as if the file had been made with more sightlines to begin with. See VWSpectra.append_sightlines."""
+    def __init__(self,num, base, numlos=5000, res = 1., cdir = None, dla=True, savefile="grid_spectra_DLA.hdf5", savedir=None, gridfile="boxhi_grid_H2.hdf5", seed=23, strata=None, margin=None, oversample=1.5, append=False):
         #Load halos to push lines through them
         f = hdfsim.get_file(num, base, 0)
         self.box = f["Header"].attrs["BoxSize"]
@@ -22,18 +136,62 @@ class GridSpectra(vw_spectra.VWSpectra):
         self.NumLos = numlos
         #All through y axis
         axis = np.ones(self.NumLos)
-        #Load grid positions
-        self.dlaind = self._load_dla_index(gridfile)
-        #Re-seed for repeatability
-        np.random.seed(23)
+        #Cells to draw sightlines through. Seeded for repeatability
+        self.sampler = GridSampler(gridfile, seed=seed)
+        self.celsz = 1.*self.box/self.sampler.ngrid[0]
+        self.strata = strata
+        self.margin = margin
+        self.oversample = oversample
+        if append:
+            nbins = self._load_sampler(path.join(savedir, savefile), seed)
         cofm = self.get_cofm()
-        vw_spectra.VWSpectra.__init__(self,num, base, cofm, axis, res, cdir, savefile=savefile,savedir=savedir, reload_file=True)
+        vw_spectra.VWSpectra.__init__(self,num, base, cofm=cofm, axis=axis, res=res, cdir=cdir, savefile=savefile,savedir=savedir, reload_file=True)
+        if append:
+            #Use exactly the velocity bins of the saved spectra
+            self.nbins = nbins
+            self.dvbin = self.vmax / (1.*nbins)
 
         if dla:
             self.replace_not_DLA(ndla=numlos, thresh=10**20.3)
         else:
             self.replace_not_DLA(ndla=numlos, thresh=10**17)
         print("Found DLAs")
+        if append:
+            self.append_sightlines()
+
+    def _load_sampler(self, savefile, seed):
+        """
+        Continue the random number stream of the sampler from where it was when savefile was saved.
+        Files saved before the stream was stored get a new stream, seeded by seed and the number of sightlines in the file,
+        so the cells already drawn are not drawn again in the same order. Returns the number of velocity bins in the file.
+        """
+        f = h5py.File(savefile, 'r')
+        try:
+            self.sampler.rng.bit_generator.state = json.loads(f["sampler"].attrs["rng_state"])
+        except KeyError:
+            self.sampler.rng = np.random.default_rng([seed, f["spectra"]["axis"].shape[0]])
+        nbins = int(f["Header"].attrs["nbins"])
+        f.close()
+        return nbins
+
+    def _save_sampler(self, f):
+        """Save the state of the random number stream of the sampler to an open hdf file, so that append can continue it."""
+        if "sampler" in f:
+            del f["sampler"]
+        grp = f.create_group("sampler")
+        grp.attrs["rng_state"] = json.dumps(self.sampler.rng.bit_generator.state)
+
+    def _save_file(self, f):
+        """Save the state of the sampler, then the spectra."""
+        self._save_sampler(f)
+        vw_spectra.VWSpectra._save_file(self, f)
+
+    def append_sightlines(self):
+        """As VWSpectra.append_sightlines, also saving the state of the sampler, so that the next append continues from it."""
+        vw_spectra.VWSpectra.append_sightlines(self)
+        f = h5py.File(self.savefile, 'r+')
+        self._save_sampler(f)
+        f.close()
 
 
     def get_cofm(self, num = None):
@@ -41,38 +199,86 @@ class GridSpectra(vw_spectra.VWSpectra):
         if num == None:
             num = self.NumLos
 
-        #Get some random indices into the box.
-        index = np.random.random_integers(0,np.size(self.dlaind[0,:])-1,num)
-        cofm = np.array([self.dlaind[0,index],self.dlaind[0,index],self.dlaind[1,index]]).T
+        #Get some random cells
+        self.index = self.sampler.sample(num, self.strata)
+        return self._cofm_in_cells(self.index)
+
+    def _prefilter(self, index, thresh):
+        """The cells in index whose column density in the grid is within self.margin dex of the threshold, or all of them if margin is None."""
+        if self.margin is None:
+            return index
+        values = self.sampler.values(index)
+        return index[np.where(values >= np.log10(np.ravel(thresh)[0]) - self.margin)]
+
+    def replace_not_DLA(self, ndla, thresh=10**20.3, elem="H", ion=1):
+        """
+        Replace those sightlines which do not contain sightlines above a given column density with new sightlines,
+        until all sightlines are above the column density, as Spectra.replace_not_DLA does.
+        The first round uses the cells chosen by get_cofm, and later rounds draw ndla new cells.
+        If self.margin is set, cells are first filtered on the column density stored in the grid file, so that
+        only sightlines which might be above the threshold need their column density computed,
+        and later rounds draw oversample times as many cells as are still needed.
+        self.discarded counts the cells rejected by the filter as well as the sightlines below the threshold.
+        The DLA incidence correction from it is then approximate: a sightline through a rejected cell
+        could still have been above the threshold.
+        Statistics for each round are kept in self.replace_stats, to help choose margin and oversample.
+        """
+        found = 0
+        self.discarded = 0
+        self.replace_stats = []
+        cofm_DLA = np.empty((ndla, 3))
+        H1_DLA = None
+        index = self.index
+        while found < ndla:
+            start = time.time()
+            candidates = self._prefilter(index, thresh)
+            if np.size(candidates) > 0:
+                self.cofm = self._cofm_in_cells(candidates)
+                self.axis = np.ones(np.size(candidates), dtype=np.int32)
+                col_den = self.compute_spectra(elem,ion,1215,False)
+                ind = self.filter_DLA(col_den, thresh)[0]
+                if H1_DLA is None:
+                    H1_DLA = np.empty((ndla, np.shape(col_den)[1]), dtype=col_den.dtype)
+                #Update saves
+                top = np.min([ndla, found+np.size(ind)])
+                cofm_DLA[found:top] = self.cofm[ind][:top-found,:]
+                H1_DLA[found:top] = col_den[ind][:top-found,:]
+            else:
+                ind = candidates
+            found += np.size(ind)
+            self.discarded += np.size(index)-np.size(ind)
+            self.replace_stats.append({"tried":np.size(index), "computed":np.size(candidates), "accepted":np.size(ind), "time":time.time()-start})
+            print("Round ",len(self.replace_stats),": tried ",np.size(index)," computed ",np.size(candidates)," accepted ",np.size(ind)," in ",self.replace_stats[-1]["time"]," s. Discarded: ",self.discarded)
+            #Get a bunch of new cells
+            if found < ndla and self.margin is None:
+                index = self.sampler.sample(ndla, self.strata)
+            elif found < ndla:
+                index = self.sampler.sample(int(np.ceil(self.oversample*(ndla-found))), self.strata)
+        #Correct proportions in case we find slightly more than we need
+        self.discarded = int(self.discarded*1.*ndla/1./found)
+        #Copy back
+        self.cofm = cofm_DLA
+        self.axis = np.ones(ndla, dtype=np.int32)
+        self.colden[(elem, ion)] = H1_DLA
+        #Finalise the cofm array
+        self.cofm_final = True
+        self.NumLos = ndla
+
+    def _cofm_in_cells(self, index):
+        """Sightline positions at a random place within each of the cells index of the sampler."""
+        num = np.size(index)
+        cells = self.sampler.cells(index)
+        yslab = (cells[1]+0.5)*self.celsz
+        zslab = (cells[2]+0.5)*self.celsz
+        cofm = np.array([yslab,yslab,zslab]).T
         #Randomize positions within a cell
-        cofm[:,1] += self.celsz*(np.random.random_sample(num)-0.5)
-        cofm[:,2] += self.celsz*(np.random.random_sample(num)-0.5)
+        cofm[:,1] += self.celsz*(self.sampler.rng.random(num)-0.5)
+        cofm[:,2] += self.celsz*(self.sampler.rng.random(num)-0.5)
         #Some sightlines could end up being through the same cell, in rare cases.
         #This is only a problem if you want to compare to a quasar survey with pixels large
         #compared to the grid size.
         return cofm
 
-    def _load_dla_index(self, gridfile, dla=False):
-        """Load the positions of DLAs or LLS from savefile"""
-        #Load the DLA/LLS positions
-        f=h5py.File(gridfile,'r')
-        grid_file=f["HaloData"]
-        ngrid = np.array(grid_file["ngrid"])
-        self.celsz = 1.*self.box/ngrid[0]
-        grp = f["abslists"]
-        #This is needed to make the dimensions right
-        ind = (grp["DLA"][0,:],grp["DLA"][1,:],grp["DLA"][2,:])
-        if not dla:
-            ind_lls = (grp["LLS"][0,:],grp["LLS"][1,:],grp["LLS"][2,:])
-        f.close()
-        yslab = (ind[1]+0.5)*self.celsz
-        yslab_lls = (ind_lls[1]+0.5)*self.celsz
-        yslab = np.append(yslab,yslab_lls)
-        zslab = (ind[2]+0.5)*self.celsz
-        zslab_lls = (ind_lls[2]+0.5)*self.celsz
-        zslab = np.append(zslab,zslab_lls)
-        return np.array((yslab, zslab))
-
 
 class TestGridSpectra(GridSpectra, vw_spectra.VWSpectra):
     """This specialised class tests the spectral generation code by loading several sightlines in a single cell and finding
@@ -89,48 +295,30 @@ class TestGridSpectra(GridSpectra, vw_spectra.VWSpectra):
         self.NumLos = numlos
         #All through y axis
         axis = np.ones(self.NumLos)
-        #Load grid positions
-        self.dlaind = self._load_dla_index(gridfile, dla)
-        self.dlaval = self._load_dla_val(gridfile, dla)
-        #Re-seed for repeatability
-        np.random.seed(seed)
+        #Cells to draw from. Seeded for repeatability
+        if dla:
+            self.sampler = GridSampler(gridfile, lists=("DLA",), seed=seed)
+        else:
+            self.sampler = GridSampler(gridfile, seed=seed)
+        self.celsz = 1.*self.box/self.sampler.ngrid[0]
         cofm = self.get_cofm()
-        vw_spectra.VWSpectra.__init__(self,num, base, cofm, axis, res, cdir, savefile=savefile,savedir=savedir, reload_file=True)
+        vw_spectra.VWSpectra.__init__(self,num, base, cofm=cofm, axis=axis, res=res, cdir=cdir, savefile=savefile,savedir=savedir, reload_file=True)
 
     def get_cofm(self, num = None):
         """Find a bunch of sightline positions through a single cell containing a DLA."""
         if num == None:
             num = self.NumLos
 
-        #Get a single random position
-        self.index = np.random.random_integers(0,np.size(self.dlaind[0,:])-1,1)*np.ones(num,dtype=np.int)
-        cofm = np.array([self.dlaind[0,self.index],self.dlaind[0,self.index],self.dlaind[1,self.index]]).T
-        #Randomize positions within a cell
-        cofm[:,1] += self.celsz*(np.random.random_sample(num)-0.5)
-        cofm[:,2] += self.celsz*(np.random.random_sample(num)-0.5)
-        #Some sightlines could end up being through the same cell, in rare cases.
-        #This is only a problem if you want to compare to a quasar survey with pixels large
-        #compared to the grid size.
-        return cofm
+        #Get a single random cell
+        self.index = self.sampler.sample(1)*np.ones(num,dtype=np.int64)
+        self.dlaval = self.sampler.values(self.index[:1])
+        return self._cofm_in_cells(self.index)
 
     def check_mean(self):
         """Compute difference between the mean column of the spectra in this cell and the grid value."""
-        dlaval = self.dlaval[self.index][0]
+        dlaval = self.dlaval[0]
         colden = self.get_col_density("H",1)
         specval = np.sum(colden)/self.NumLos
         print("From spectra:",specval)
         print("From grid:",10**dlaval)
         print("different:",specval/10**dlaval)
-
-    def _load_dla_val(self, gridfile, dla=True):
-        """Load the values of DLAs or LLS from savefile"""
-        #Load the DLA/LLS positions
-        f=h5py.File(gridfile,'r')
-        grp = f["abslists"]
-        #This is needed to make the dimensions right
-        if dla:
-            nhi = np.array(grp["DLA_val"])
-        else:
-            nhi = np.array(grp["LLS_val"])
-        f.close()
-        return nhi
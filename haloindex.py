@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""A spatial index over halo centres in a periodic box, for finding which halo contains a position,
+and a compact association of sightlines with the halos their absorbers are in."""
+
+from __future__ import print_function
+import numpy as np
+from scipy.spatial import cKDTree
+
+def _wrap(pos, box):
+    """Wrap positions into [0, box), as the periodic KD-tree requires."""
+    wrapped = np.mod(pos, box)
+    #np.mod can round tiny negative numbers up to box
+    wrapped[wrapped >= box] = 0
+    return wrapped
+
+def periodic_offset(pos, cofm, box):
+    """Vector from cofm to pos, using the nearest periodic image."""
+    diff = pos - cofm
+    return diff - box*np.rint(diff/box)
+
+class HaloIndex(object):
+    """
+    Centres and radii of a set of halos in a periodic box.
+    This is built once per halo catalogue, and can then assign any number of positions to halos.
+    cofm - halo centres
+    radii - halo radii: a position is in a halo if it is strictly within this distance of the centre.
+    box - box size, in the same units.
+    chunk - positions are assigned to halos in blocks of this many, to bound the memory used.
+    """
+    def __init__(self, cofm, radii, box, chunk=2**20):
+        self.box = box
+        self.cofm = np.array(cofm, dtype=np.float64)
+        self.radii = np.array(radii, dtype=np.float64)
+        self.chunk = chunk
+        #Halos with no radius contain nothing
+        self.nonempty = np.where(self.radii > 0)[0]
+        self.wrapped = _wrap(self.cofm[self.nonempty], box)
+
+    def containing(self, pos):
+        """
+        Find the halo containing each position.
+        If a position is in several halos, the one with the lowest index is used.
+        Returns an array of halo indices, -1 where a position is in no halo.
+        """
+        pos = np.atleast_2d(pos)
+        found = -np.ones(np.shape(pos)[0], dtype=np.int64)
+        if np.shape(pos)[0] == 0 or np.size(self.nonempty) == 0:
+            return found
+        for start in range(0, np.shape(pos)[0], self.chunk):
+            found[start:start+self.chunk] = self._containing_chunk(pos[start:start+self.chunk])
+        return found
+
+    def _containing_chunk(self, pos):
+        """containing() for a single block of positions."""
+        found = -np.ones(np.shape(pos)[0], dtype=np.int64)
+        ptree = cKDTree(_wrap(pos, self.box), boxsize=self.box)
+        #Positions within the radius of each halo, so the number of pairs scales with the size of each halo
+        near = ptree.query_ball_point(self.wrapped, self.radii[self.nonempty], return_sorted=False)
+        counts = np.array([len(nn) for nn in near], dtype=np.int64)
+        if np.sum(counts) == 0:
+            return found
+        halo = np.repeat(self.nonempty, counts)
+        part = np.concatenate([nn for nn in near if len(nn) > 0]).astype(np.int64)
+        #Recompute the distance exactly, and keep pairs strictly within the radius of their halo.
+        dd = np.sum(periodic_offset(pos[part], self.cofm[halo], self.box)**2, axis=1)
+        inside = np.where(dd < self.radii[halo]**2)
+        nhalo = np.size(self.radii)
+        first = nhalo*np.ones_like(found)
+        np.minimum.at(first, part[inside], halo[inside])
+        found[first < nhalo] = first[first < nhalo]
+        return found
+
+def _csr(rows, values, nrows):
+    """
+    Compressed sparse row form of a list of (row, value) pairs, with duplicate pairs removed.
+    Returns (offsets, values), where the values of row i are values[offsets[i]:offsets[i+1]], sorted.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    if np.size(values) > 0:
+        #Encode each pair as a single integer, which sorts by row then value
+        width = np.max(values)+1
+        pairs = np.unique(rows*width + values)
+        rows = pairs // width
+        values = pairs % width
+    offsets = np.searchsorted(rows, np.arange(nrows+1))
+    return (offsets.astype(np.int64), values.astype(np.int64))
+
+class HaloAssociation(object):
+    """
+    The halos and subhalos associated with absorption along each sightline, in compressed sparse row form:
+    the halos of sightline i are halos[halo_offsets[i]:halo_offsets[i+1]], and likewise for subhalos.
+    nearest - for each sightline, the halo with the largest virial velocity among its halos
+              and the parent halos of its subhalos, or -1 if there are none.
+    """
+    def __init__(self, halo_offsets, halos, subhalo_offsets, subhalos, nearest):
+        self.halo_offsets = np.asarray(halo_offsets, dtype=np.int64)
+        self.halos = np.asarray(halos, dtype=np.int64)
+        self.subhalo_offsets = np.asarray(subhalo_offsets, dtype=np.int64)
+        self.subhalos = np.asarray(subhalos, dtype=np.int64)
+        self.nearest = np.asarray(nearest, dtype=np.int64)
+
+    def nlos(self):
+        """Number of sightlines"""
+        return np.size(self.halo_offsets)-1
+
+    @staticmethod
+    def rows(offsets):
+        """The row (sightline) of each entry of a compressed sparse row array"""
+        return np.repeat(np.arange(np.size(offsets)-1), np.diff(offsets))
+
+    def host_halos(self, sub_parent):
+        """
+        The halos of each sightline together with the parent halos of its subhalos, without duplicates.
+        sub_parent - the parent halo of each subhalo.
+        Returns (offsets, halos) in compressed sparse row form.
+        """
+        rows = np.concatenate([self.rows(self.halo_offsets), self.rows(self.subhalo_offsets)])
+        hosts = np.concatenate([self.halos, np.asarray(sub_parent, dtype=np.int64)[self.subhalos]])
+        return _csr(rows, hosts, self.nlos())
+
+    def multiplicity(self, sub_parent):
+        """Number of distinct host halos of each sightline. See host_halos."""
+        return np.diff(self.host_halos(sub_parent)[0])
+
+    @staticmethod
+    def to_lists(offsets, values):
+        """A list of lists of the values in each row, as returned by HaloAssignedSpectra.find_nearby_halos."""
+        return [list(values[offsets[ii]:offsets[ii+1]]) for ii in range(np.size(offsets)-1)]
+
+    def save(self, grp):
+        """Save to an HDF5 group"""
+        for name in ("halo_offsets", "halos", "subhalo_offsets", "subhalos", "nearest"):
+            grp.create_dataset(name, data=getattr(self, name))
+
+def load_association(grp):
+    """Load a HaloAssociation saved to an HDF5 group by HaloAssociation.save"""
+    return HaloAssociation(*[np.array(grp[name]) for name in ("halo_offsets", "halos", "subhalo_offsets", "subhalos", "nearest")])
+
+def associate(rows, pos, halo_index, sub_index, sub_parent, virial, nrows):
+    """
+    Associate positions on each sightline with the halos and subhalos containing them.
+    rows - the sightline of each position.
+    pos - the positions.
+    halo_index, sub_index - HaloIndex over the halos and the subhalos.
+    sub_parent - the parent halo of each subhalo.
+    virial - virial velocity of each halo, used to choose the nearest halo.
+    nrows - number of sightlines.
+    Returns a HaloAssociation.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    hh = halo_index.containing(pos)
+    ss = sub_index.containing(pos)
+    (halo_offsets, halos) = _csr(rows[hh >= 0], hh[hh >= 0], nrows)
+    (subhalo_offsets, subhalos) = _csr(rows[ss >= 0], ss[ss >= 0], nrows)
+    assoc = HaloAssociation(halo_offsets, halos, subhalo_offsets, subhalos, -np.ones(nrows, dtype=np.int64))
+    (host_offsets, hosts) = assoc.host_halos(sub_parent)
+    #Sort by sightline, then largest virial velocity, then lowest index, and take the first host of each sightline
+    hrows = assoc.rows(host_offsets)
+    order = np.lexsort((hosts, -np.asarray(virial)[hosts], hrows))
+    first = np.searchsorted(hrows[order], np.arange(nrows))
+    found = np.where(np.diff(host_offsets) > 0)
+    assoc.nearest[found] = hosts[order][first[found]]
+    return assoc
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Opt-in timing and memory instrumentation for VWSpectra and VWPlotSpectra.
+
+enable() wraps the public methods of the spectra classes, the cached computations and the hot
+module-level functions (resolution convolution, per-sightline kernels and HDF5 loading) so that each call
+records its wall time, and for the cached computations whether the result came from the cache.
+If memory=True, the peak memory allocated during each call is also recorded, using tracemalloc.
+disable() restores the original functions, so that there is no overhead when instrumentation is off.
+
+Usage:
+    import instrument
+    instrument.enable()
+    ...make plots...
+    instrument.report()
+    instrument.save_json("timings.json")
+    instrument.save_trace("trace.json")   #View in chrome://tracing or Perfetto
+    instrument.disable()
+
+Times are inclusive: the time of a method includes the time of the methods it calls.
+"""
+
+from __future__ import print_function
+import os
+import time
+import json
+import inspect
+import functools
+from fake_spectra import spec_utils
+import vw_spectra
+import vw_plotspectra
+
+try:
+    import tracemalloc
+except ImportError:
+    #Python 2
+    tracemalloc = None
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+#Classes whose methods are instrumented. Methods inherited from a class earlier in the list are not wrapped again.
+CLASSES = [vw_spectra.VWSpectra, vw_plotspectra.VWPlotSpectra]
+#Private methods which are wrapped as well as the public ones.
+PRIVATE_METHODS = ["_really_load_array", "_vel_stat_hist", "_plot_errors", "_filter_mask", "_res_corr", "_save_file"]
+#Module-level functions to instrument: (module, function name)
+FUNCTIONS = [(spec_utils, "res_corr"), (spec_utils, "get_rolled_spectra"),
+             (vw_spectra, "_fft_res_corr"), (vw_spectra, "_absorber_windows"), (vw_spectra, "_vel_stat_kernel"),
+             (vw_spectra, "_separated_regions"), (vw_spectra, "bootstrap_histograms")]
+#Cached computations, and the dictionary each is cached in.
+#A call which adds nothing new to the dictionary is a cache hit.
+CACHED = {"find_absorber_width":"absorber_width", "get_observer_tau":"tau_conv", "vel_stats":"vel_statistics",
+          "get_max_density":"max_density", "get_filt_mask":"filt_ind", "get_tau":"tau", "get_col_density":"colden"}
+
+class Recorder(object):
+    """
+    Statistics for each instrumented function, and a trace of every call.
+    memory - if True, record the peak memory allocated in each call.
+    """
+    def __init__(self, memory=False):
+        self.memory = memory and tracemalloc is not None
+        self.stats = {}
+        self.events = []
+        self.start = _clock()
+        #For each active call, [memory at the start, peak memory seen so far]
+        self.stack = []
+
+    def _stat(self, name):
+        """Statistics for a single function, creating them if needed."""
+        try:
+            return self.stats[name]
+        except KeyError:
+            stat = {"calls":0, "time":0., "max_time":0., "hits":0, "misses":0, "peak_memory":0}
+            self.stats[name] = stat
+            return stat
+
+    def begin(self):
+        """Mark the start of a call. Returns the start time."""
+        if self.memory:
+            (current, peak) = tracemalloc.get_traced_memory()
+            #The peak is about to be reset, so save it for the caller
+            if len(self.stack) > 0:
+                self.stack[-1][1] = max(self.stack[-1][1], peak)
+            self.stack.append([current, current])
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        return _clock()
+
+    def end(self, name, start, hit=None):
+        """Record a call to name which started at start. hit is True or False for cached computations."""
+        now = _clock()
+        stat = self._stat(name)
+        stat["calls"] += 1
+        stat["time"] += now - start
+        stat["max_time"] = max(stat["max_time"], now - start)
+        if hit is not None:
+            if hit:
+                stat["hits"] += 1
+            else:
+                stat["misses"] += 1
+        args = {}
+        if self.memory:
+            (current, peak) = self.stack.pop()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            stat["peak_memory"] = max(stat["peak_memory"], peak - current)
+            args["peak_memory"] = peak - current
+            if len(self.stack) > 0:
+                self.stack[-1][1] = max(self.stack[-1][1], peak)
+        if hit is not None:
+            args["cache"] = "hit" if hit else "miss"
+        self.events.append({"name":name, "ph":"X", "ts":(start - self.start)*1e6, "dur":(now - start)*1e6,
+                            "pid":os.getpid(), "tid":0, "args":args})
+
+    def summary(self):
+        """Statistics for each function, as a dictionary."""
+        return {"total_time":_clock() - self.start, "memory":self.memory, "functions":self.stats}
+
+    def report(self, number=30):
+        """Print the functions which took the most time."""
+        names = sorted(self.stats, key=lambda name: -self.stats[name]["time"])[:number]
+        print("Function                       calls   time (s)   max (s)   hits  misses  peak mem (MB)")
+        for name in names:
+            stat = self.stats[name]
+            print(name.ljust(30),str(stat["calls"]).rjust(5),"%10.3f %9.3f" % (stat["time"], stat["max_time"]),
+                  str(stat["hits"]).rjust(6),str(stat["misses"]).rjust(7),"%14.1f" % (stat["peak_memory"]/1024.**2))
+
+#The active recorder, or None if instrumentation is disabled.
+recorder = None
+#Original functions, to restore on disable: (owner, name, original)
+_wrapped = []
+
+def _cache_state(obj, attr):
+    """The (key, object id) pairs in a cache dictionary, so a change in its contents can be detected.
+    Dictionaries of dictionaries, like filt_ind, are flattened one level."""
+    state = set()
+    for (key, value) in getattr(obj, attr, {}).items():
+        if isinstance(value, dict):
+            state.update(((key, kk), id(vv)) for (kk, vv) in value.items())
+        else:
+            state.add((key, id(value)))
+    return state
+
+def _wrap_function(name, func):
+    """Record the time of each call to a function."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        """Instrumented function"""
+        start = recorder.begin()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            recorder.end(name, start)
+    wrapper.instrumented = True
+    return wrapper
+
+def _wrap_cached(name, func, attr):
+    """Record the time of each call to a cached method, and whether it missed the cache."""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        """Instrumented method"""
+        before = _cache_state(self, attr)
+        start = recorder.begin()
+        hit = None
+        try:
+            result = func(self, *args, **kwargs)
+            hit = _cache_state(self, attr) <= before
+            return result
+        finally:
+            recorder.end(name, start, hit)
+    wrapper.instrumented = True
+    return wrapper
+
+def _instrument(owner, name, label):
+    """Replace owner.name with an instrumented version, unless it is already instrumented."""
+    func = getattr(owner, name)
+    if getattr(func, "instrumented", False):
+        return
+    #Get the underlying function, not the unbound method of python 2
+    func = getattr(func, "__func__", func)
+    if name in CACHED:
+        wrapper = _wrap_cached(label, func, CACHED[name])
+    else:
+        wrapper = _wrap_function(label, func)
+    _wrapped.append((owner, name, owner.__dict__.get(name)))
+    setattr(owner, name, wrapper)
+
+def enable(memory=False):
+    """
+    Start recording. Any previous records are discarded.
+    memory - if True, also record the peak memory allocated by each call. This is much slower.
+    """
+    global recorder
+    disable()
+    recorder = Recorder(memory)
+    if recorder.memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    for cls in CLASSES:
+        for name in dir(cls):
+            if name.startswith("_") and name not in PRIVATE_METHODS:
+                continue
+            if not inspect.isroutine(getattr(cls, name)):
+                continue
+            _instrument(cls, name, name)
+    for (module, name) in FUNCTIONS:
+        _instrument(module, name, module.__name__.split(".")[-1]+"."+name)
+
+def disable():
+    """Stop recording and restore the original functions. The records are kept for saving."""
+    while len(_wrapped) > 0:
+        (owner, name, original) = _wrapped.pop()
+        if original is None:
+            #Inherited, so remove the wrapper to expose the parent class method
+            delattr(owner, name)
+        else:
+            setattr(owner, name, original)
+    if recorder is not None and recorder.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def report(number=30):
+    """Print the functions which took the most time."""
+    if recorder is None:
+        print("Instrumentation was not enabled")
+        return
+    recorder.report(number)
+
+def save_json(filename):
+    """Save the statistics for each function as JSON."""
+    with open(filename, 'w') as f:
+        json.dump(recorder.summary(), f, indent=1)
+
+def save_trace(filename):
+    """Save every call in the Chrome trace event format."""
+    with open(filename, 'w') as f:
+        json.dump({"traceEvents":recorder.events, "displayTimeUnit":"ms"}, f)
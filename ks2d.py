@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Two-dimensional, two-sample Kolmogorov-Smirnov test of Peacock (1983) and Fasano & Franceschini (1987),
+as described in Numerical Recipes (ks2d2s).
+
+The statistic is the largest difference between the fractions of each sample in the four quadrants
+around each point, averaged over using the points of either sample as origins.
+Quadrant counts are found by sorting each sample once and sweeping over blocks of points,
+rather than by comparing every origin to every point, and a fixed reference sample is only sorted once,
+so that many trials against it are cheap. Trials can be run in a process pool."""
+
+from __future__ import print_function
+import multiprocessing
+import numpy as np
+
+class QuadrantCounter(object):
+    """
+    Sorted copy of a 2D sample, for counting the fraction of it in each quadrant around many origins.
+    x, y - coordinates of the points in the sample.
+    block - number of points in each block of the sweep.
+    """
+    def __init__(self, x, y, block=128):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.npts = np.size(x)
+        self.block = block
+        order = np.argsort(x, kind='mergesort')
+        self.xsort = x[order]
+        #y values in x order
+        self.yxorder = y[order]
+        self.ysort = np.sort(y)
+        #y values of each block of points in x order, sorted within the block
+        self.yblocks = [np.sort(self.yxorder[start:start+block]) for start in range(0, self.npts, block)]
+
+    def _count_lower_left(self, xo, yo):
+        """Number of points with x <= xo and y <= yo, for each origin."""
+        #Points with x <= xo are the first nprefix in x order
+        nprefix = np.searchsorted(self.xsort, xo, side='right')
+        count = np.zeros(np.size(xo), dtype=np.int64)
+        for (bb, yblock) in enumerate(self.yblocks):
+            start = bb*self.block
+            end = start + np.size(yblock)
+            #Origins to the right of the whole block
+            full = np.where(nprefix >= end)[0]
+            count[full] += np.searchsorted(yblock, yo[full], side='right')
+            #Origins whose prefix ends in this block
+            part = np.where(np.logical_and(nprefix > start, nprefix < end))[0]
+            if np.size(part) > 0:
+                ypart = self.yxorder[start:end]
+                inprefix = np.arange(end-start)[np.newaxis,:] < (nprefix[part]-start)[:,np.newaxis]
+                count[part] += np.sum(np.logical_and(inprefix, ypart[np.newaxis,:] <= yo[part,np.newaxis]), axis=1)
+        return count
+
+    def fractions(self, xo, yo):
+        """
+        Fraction of the sample in each quadrant around each origin, with the conventions of Numerical Recipes:
+        points on the boundary are counted with the lower or left quadrant.
+        Returns an array of shape (norigins, 4), for (x > xo, y > yo), (x <= xo, y > yo), (x <= xo, y <= yo), (x > xo, y <= yo).
+        """
+        xo = np.asarray(xo, dtype=np.float64)
+        yo = np.asarray(yo, dtype=np.float64)
+        lowleft = self._count_lower_left(xo, yo)
+        left = np.searchsorted(self.xsort, xo, side='right')
+        low = np.searchsorted(self.ysort, yo, side='right')
+        quad = np.array([self.npts - left - low + lowleft, left - lowleft, lowleft, low - lowleft]).T
+        return quad/(1.*self.npts)
+
+class KS2D(object):
+    """
+    2D KS test against a fixed reference sample. The quadrant fractions of the reference around its own points
+    are found once, so only the sample being tested needs to be sorted for each test.
+    reference - array of shape (npoints, 2).
+    """
+    def __init__(self, reference):
+        reference = np.asarray(reference, dtype=np.float64)
+        self.reference = reference
+        self.counter = QuadrantCounter(reference[:,0], reference[:,1])
+        self.self_fractions = self.counter.fractions(reference[:,0], reference[:,1])
+
+    def statistic(self, data):
+        """The 2D KS statistic between data, an array of shape (npoints, 2), and the reference sample."""
+        data = np.asarray(data, dtype=np.float64)
+        sample = QuadrantCounter(data[:,0], data[:,1])
+        #Using the points of data as origins
+        d1 = np.max(np.abs(sample.fractions(data[:,0], data[:,1]) - self.counter.fractions(data[:,0], data[:,1])))
+        #Using the points of the reference as origins
+        d2 = np.max(np.abs(sample.fractions(self.reference[:,0], self.reference[:,1]) - self.self_fractions))
+        return (d1+d2)/2.
+
+def ks_2d_2samp(data1, data2):
+    """The 2D KS statistic between two samples, each an array of shape (npoints, 2)."""
+    return KS2D(data2).statistic(data1)
+
+def _subsample_trials(args):
+    """Run a block of trials in one process. See subsample_trials."""
+    (reference, population, nsub, ntrials, seed) = args
+    engine = KS2D(reference)
+    rng = np.random.default_rng(seed)
+    return np.array([engine.statistic(population[rng.integers(0, np.shape(population)[0], nsub)]) for _ in range(ntrials)])
+
+def subsample_trials(reference, population, nsub, ntrials=1000, seed=23, nproc=None, chunk=50):
+    """
+    Find the 2D KS statistic between the reference sample and each of ntrials random subsamples of population,
+    drawn with replacement, each of nsub points. This gives the distribution of the statistic expected
+    for a sample of size nsub drawn from the same population.
+    Trials are run in blocks of chunk in a pool of nproc processes (default one per core).
+    Each block has its own random seed derived from seed, so the results do not depend on nproc.
+    Returns an array of the statistic for each trial.
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    population = np.asarray(population, dtype=np.float64)
+    nblocks = int(np.ceil(ntrials/(1.*chunk)))
+    seeds = np.random.SeedSequence(seed).spawn(nblocks)
+    tasks = [(reference, population, nsub, int(np.min([chunk, ntrials-bb*chunk])), seeds[bb]) for bb in range(nblocks)]
+    if nproc == 1:
+        results = [_subsample_trials(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(nproc)
+        results = pool.map(_subsample_trials, tasks)
+        pool.close()
+        pool.join()
+    return np.concatenate(results)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Read-only, lazily loaded access to arrays in a spectra save file.
+Rows are read on demand, and reductions along the other axes are done in chunks,
+so that a single spectrum or per-spectrum maximum does not need the whole array in memory."""
+
+from __future__ import print_function
+import numpy as np
+import h5py
+
+class LazyArray(object):
+    """
+    Proxy for an array stored in an HDF5 file.
+    If the dataset is stored contiguously it is memory-mapped, otherwise rows are read through h5py.
+    Indexing returns ordinary numpy arrays, reading only the rows asked for.
+    filename - HDF5 file
+    name - path of the dataset in the file, eg, tau_obs/Si/2
+    """
+    def __init__(self, filename, name):
+        self.filename = filename
+        self.name = name
+        f = h5py.File(filename, 'r')
+        dset = f[name]
+        self.shape = dset.shape
+        self.dtype = dset.dtype
+        offset = dset.id.get_offset()
+        f.close()
+        self.memmap = None
+        if offset is not None and np.prod(self.shape) > 0:
+            self.memmap = np.memmap(filename, dtype=self.dtype, mode='r', offset=offset, shape=self.shape)
+
+    @property
+    def ndim(self):
+        """Number of dimensions"""
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """Read the requested part of the array."""
+        if self.memmap is not None:
+            return np.array(self.memmap[index])
+        f = h5py.File(self.filename, 'r')
+        dset = f[self.name]
+        if isinstance(index, (list, np.ndarray)):
+            #h5py can only read increasing lists of rows
+            (rows, inverse) = np.unique(np.asarray(index), return_inverse=True)
+            data = dset[rows, ...][inverse]
+        else:
+            data = dset[index]
+        f.close()
+        return data
+
+    def __array__(self, dtype=None):
+        """Load the whole array."""
+        data = self[...]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def reduce(self, func, axis=-1, chunk=1024):
+        """Apply a reduction, such as np.max, along an axis other than the first,
+        reading chunk rows at a time."""
+        if axis % self.ndim == 0:
+            raise ValueError("Reductions over the first axis are not chunked")
+        if self.shape[0] == 0:
+            return func(self[...], axis=axis)
+        return np.concatenate([func(self[start:start+chunk], axis=axis) for start in range(0, self.shape[0], chunk)])
+
+    def max(self, axis=-1, chunk=1024):
+        """Maximum along an axis, computed chunk rows at a time."""
+        return self.reduce(np.max, axis=axis, chunk=chunk)
@@ -8,143 +8,195 @@ matplotlib.use('PDF')
 
 import matplotlib.pyplot as plt
 
-import vw_plotspectra as ps
 import os.path as path
 import numpy as np
 from save_figure import save_figure
 import myname
+import spectra_cache
 
 outdir = path.join(myname.base, "plots/2d_hist/")
 print("Plots at: ",outdir)
 
-def plot_max_den(sim, snap, ff=True):
-    """Load a simulation and plot the max metal density vs the max HI density"""
-    halo = myname.get_name(sim,ff)
-    #Load from a save file only
-    hspec = ps.VWPlotSpectra(snap, halo, None, None)
-    metal_den = np.max(hspec.get_density("Si", 2),axis=1)
-    HI_den = np.max(hspec.get_density("H", 1),axis=1)
+def _halo_mass(hspec):
+    """Mass of the nearest halo to each spectrum"""
+    (halos, _) = hspec.find_nearest_halo()
+    return hspec.sub_mass[halos]
+
+def _si_metallicity(hspec):
+    """SiII metallicity of each spectrum, in solar units"""
+    mms = np.sum(hspec.get_density("Si",2), axis=1)
+    hhs = np.sum(hspec.get_density("H",-1), axis=1)
+    return mms/hhs/0.0133
+
+#Functions to get each quantity, one value per spectrum.
+QUANTITIES = {"max_Si_den": lambda hspec: hspec.get_max_density("Si", 2),
+              "max_HI_den": lambda hspec: hspec.get_max_density("H", 1),
+              "vel_width": lambda hspec: hspec.vel_width("Si", 2),
+              "HI_col_den": lambda hspec: np.sum(hspec.get_col_density("H", 1),axis=1),
+              "halo_mass": _halo_mass,
+              "metallicity": lambda hspec: hspec.get_metallicity(),
+              "Si_metallicity": _si_metallicity}
+
+#Each histogram: (quantity on the x axis, quantity on the y axis, whether to use only spectra passing get_filt)
+PANELS = {"max_den": ("max_Si_den", "max_HI_den", True),
+          "vel_den": ("max_Si_den", "vel_width", True),
+          "vel_HI_col_den": ("HI_col_den", "vel_width", True),
+          "vel_mass": ("halo_mass", "vel_width", True),
+          "met_mass": ("halo_mass", "metallicity", True),
+          "vel_metals": ("metallicity", "vel_width", False),
+          "Si_metals": ("metallicity", "Si_metallicity", False)}
+
+def _bin_index(values, bins):
+    """Equal width bins over the range of the values, as np.histogram2d makes them.
+    Returns the bin edges and the bin of each value."""
+    (low, high) = (np.min(values), np.max(values))
+    if low == high:
+        (low, high) = (low - 0.5, high + 0.5)
+    edges = np.linspace(low, high, bins+1)
+    index = np.searchsorted(edges, values, side='right')
+    #The last edge is in the last bin
+    index[values == edges[-1]] -= 1
+    return (edges, index - 1)
+
+def joint_histograms(hspec, panels=None, bins=30):
+    """
+    Normalised 2D histograms of pairs of log quantities, as np.histogram2d(density=True) gives.
+    Each quantity is computed once, and all histograms are binned in a single pass.
+    panels - dictionary of histograms, as in PANELS.
+    Returns a dictionary of (H, xedges, yedges) with the keys of panels.
+    """
+    if panels is None:
+        panels = PANELS
+    names = sorted(panels.keys())
     ind = hspec.get_filt("Si",2)
-    (H, xedges, yedges) = np.histogram2d(np.log10(metal_den[ind]), np.log10(HI_den[ind]), bins=30,normed=True)
+    logs = {}
+    for (xname, yname, filt) in panels.values():
+        for qq in (xname, yname):
+            if qq not in logs:
+                logs[qq] = np.log10(QUANTITIES[qq](hspec))
+    #Bin each quantity once for each set of spectra it is used with
+    binned = {}
+    for (xname, yname, filt) in panels.values():
+        for qq in (xname, yname):
+            if (qq, filt) not in binned:
+                values = logs[qq]
+                if filt:
+                    values = values[ind]
+                binned[(qq, filt)] = _bin_index(values[np.isfinite(values)], bins)+(np.isfinite(values),)
+    #Flat index of each spectrum in the combined array of histograms
+    flat = []
+    for (nn, name) in enumerate(names):
+        (xname, yname, filt) = panels[name]
+        (_, xind, xfinite) = binned[(xname, filt)]
+        (_, yind, yfinite) = binned[(yname, filt)]
+        #Spectra with a finite value for both quantities
+        xfull = -np.ones(np.size(xfinite), dtype=np.int64)
+        xfull[xfinite] = xind
+        yfull = -np.ones(np.size(yfinite), dtype=np.int64)
+        yfull[yfinite] = yind
+        both = np.logical_and(xfinite, yfinite)
+        flat.append(nn*bins**2 + xfull[both]*bins + yfull[both])
+    counts = np.bincount(np.concatenate(flat), minlength=np.size(names)*bins**2).reshape(np.size(names), bins, bins)
+    hists = {}
+    for (nn, name) in enumerate(names):
+        (xname, yname, filt) = panels[name]
+        xedges = binned[(xname, filt)][0]
+        yedges = binned[(yname, filt)][0]
+        H = counts[nn] / np.diff(xedges)[:,np.newaxis]
+        H = H / np.diff(yedges)[np.newaxis,:]
+        H /= counts[nn].sum()
+        hists[name] = (H, xedges, yedges)
+    return hists
+
+#Histograms already computed, keyed by (sim, snap, ff, bins).
+#These are not saved to disk: a cache there could not tell when the save file or the statistics change.
+_hists = {}
+
+def get_histograms(sim, snap, ff=True, bins=30, recompute=False):
+    """
+    Get all the histograms in PANELS for a simulation.
+    These are computed from the spectra, which are loaded only once, and kept for the rest of the run.
+    """
+    key = (sim, snap, ff, bins)
+    if key in _hists and not recompute:
+        return _hists[key]
+    #Load from a save file only
+    hspec = spectra_cache.get_spectra(sim, snap, ff=ff)
+    hists = joint_histograms(hspec, PANELS, bins)
+    _hists[key] = hists
+    return hists
+
+def plot_hist(sim, snap, name, ff=True, vmax=None):
+    """Plot one of the histograms in PANELS for a simulation"""
+    (H, xedges, yedges) = get_histograms(sim, snap, ff)[name]
     extent = [yedges[0], yedges[-1], xedges[-1], xedges[0]]
-    plt.imshow(H, extent=extent, aspect="auto", vmax = 0.15)
+    plt.imshow(H, extent=extent, aspect="auto", vmax=vmax)
     plt.colorbar()
 
+def plot_max_den(sim, snap, ff=True):
+    """Plot the max metal density vs the max HI density"""
+    plot_hist(sim, snap, "max_den", ff, vmax=0.15)
+
 def plot_vel_den(sim, snap, ff=True):
-    """Load a simulation and plot the metal density vs the velocity width"""
-    halo = myname.get_name(sim, ff)
-    #Load from a save file only
-    hspec = ps.VWPlotSpectra(snap, halo, None, None)
-    vel = hspec.vel_width("Si",2)
-    den = hspec.get_density("Si", 2)
-    ind = hspec.get_filt("Si",2)
-    (H, xedges, yedges) = np.histogram2d(np.log10(den[ind]), np.log10(vel[ind]), bins=30,normed=True)
-    extent = [yedges[0], yedges[-1], xedges[-1], xedges[0]]
-    plt.imshow(H, extent=extent, aspect="auto")
-    plt.colorbar()
+    """Plot the max metal density vs the velocity width"""
+    plot_hist(sim, snap, "vel_den", ff)
 
 def plot_vel_HI_col_den(sim, snap, ff=True):
-    """Load a simulation and plot the HI column density vs the velocity width"""
-    halo = myname.get_name(sim, ff)
-    #Load from a save file only
-    hspec = ps.VWPlotSpectra(snap, halo, None, None)
-    HI_den = np.sum(hspec.get_col_density("H", 1),axis=1)
-    vel= hspec.vel_width("Si",2)
-    ind = hspec.get_filt("Si",2)
-    (H, xedges, yedges) = np.histogram2d(np.log10(HI_den[ind]), np.log10(vel[ind]), bins=30,normed=True)
-    extent = [yedges[0], yedges[-1], xedges[-1], xedges[0]]
-    plt.imshow(H, extent=extent, aspect="auto")
-    plt.colorbar()
+    """Plot the HI column density vs the velocity width"""
+    plot_hist(sim, snap, "vel_HI_col_den", ff)
 
 def plot_vel_mass(sim, snap, ff=True):
-    """Load a simulation and plot the halo mass vs the velocity width"""
-    halo = myname.get_name(sim, ff)
-    #Load from a save file only
-    hspec = ps.VWPlotSpectra(snap, halo)
-    ind = hspec.get_filt("Si",2)
-    vel= hspec.vel_width("Si",2)[ind]
-    (halos, _) = hspec.find_nearest_halo()
-    mass = hspec.sub_mass[halos][ind]
-    (H, xedges, yedges) = np.histogram2d(np.log10(mass), np.log10(vel), bins=30,normed=True)
-    extent = [yedges[0], yedges[-1], xedges[-1], xedges[0]]
-    plt.imshow(H, extent=extent, aspect="auto")
-    plt.colorbar()
+    """Plot the halo mass vs the velocity width"""
+    plot_hist(sim, snap, "vel_mass", ff)
 
 def plot_met_mass(sim, snap, ff=True):
-    """Load a simulation and plot the halo mass vs the velocity width"""
-    halo = myname.get_name(sim, ff)
-    #Load from a save file only
-    hspec = ps.VWPlotSpectra(snap, halo)
-    ind = hspec.get_filt("Si",2)
-    met = hspec.get_metallicity()[ind]
-    (halos, _) = hspec.find_nearest_halo()
-    mass = hspec.sub_mass[halos][ind]
-    (H, xedges, yedges) = np.histogram2d(np.log10(mass), np.log10(met), bins=30,normed=True)
-    extent = [yedges[0], yedges[-1], xedges[-1], xedges[0]]
-    plt.imshow(H, extent=extent, aspect="auto")
-    plt.colorbar()
+    """Plot the halo mass vs the metallicity"""
+    plot_hist(sim, snap, "met_mass", ff)
 
 def plot_vel_metals(sim, snap, ff=True):
     """Plot the correlation between metallicity and velocity width"""
-    halo = myname.get_name(sim, ff)
-    #Load from a save file only
-    hspec = ps.VWPlotSpectra(snap, halo)
-    met = hspec.get_metallicity()
-    vel = hspec.vel_width("Si",2)
-    (H, xedges, yedges) = np.histogram2d(np.log10(met), np.log10(vel), bins=30,normed=True)
-    extent = [yedges[0], yedges[-1], xedges[-1], xedges[0]]
-    plt.imshow(H, extent=extent, aspect="auto")
-    plt.colorbar()
+    plot_hist(sim, snap, "vel_metals", ff)
 
 def plot_Si_metals(sim, snap, ff=True):
-    """Plot the correlation between metallicity and velocity width"""
-    halo = myname.get_name(sim, ff)
-    #Load from a save file only
-    hspec = ps.VWPlotSpectra(snap, halo)
-    met = hspec.get_metallicity()
-    MM = hspec.get_density("Si",2)
-    HH = hspec.get_density("H",-1)
-    mms = np.sum(MM, axis=1)
-    hhs = np.sum(HH, axis=1)
-    Simet = mms/hhs/0.0133
-    (H, xedges, yedges) = np.histogram2d(np.log10(met), np.log10(Simet), bins=30,normed=True)
-    extent = [yedges[0], yedges[-1], xedges[-1], xedges[0]]
-    plt.imshow(H, extent=extent, aspect="auto")
-    plt.colorbar()
+    """Plot the correlation between metallicity and SiII metallicity"""
+    plot_hist(sim, snap, "Si_metals", ff)
 
 reds = {1:4, 3:3, 5:2}
 
-for ii in (0,1,2,3):
-    #Plot col_density of metals vs HI
-    plot_vel_mass(ii, 3)
-    save_figure(path.join(outdir,"cosmo"+str(ii)+"z3_vel_mass"))
-    plt.clf()
-
-for ii in (0,1,2,3):
-    #Plot col_density of metals vs HI
-    plot_met_mass(ii, 3)
-    save_figure(path.join(outdir,"cosmo"+str(ii)+"z3_met_mass"))
-    plt.clf()
-
-# plot_Si_metals(0, 3)
-# save_figure(path.join(outdir,"cosmo0_512_z3_Si_metals"))
-# plt.clf()
-#
-
-for ii in (0,1,2,3):
-    #Plot col_density of metals vs HI
-    plot_max_den(ii, 3)
-    save_figure(path.join(outdir,"cosmo"+str(ii)+"z3_coldens"))
-    plt.clf()
-
-for ii in (0,1,2,3):
-    #Plot metal col. den vs vel width
-    plot_vel_den(ii, 3)
-    save_figure(path.join(outdir,"cosmo"+str(ii)+"_vel_den_z3"))
-    plt.clf()
-
-for ii in (0,1,2,3):
-    #Plot metal col. den vs vel width
-    plot_vel_HI_col_den(ii, 3)
-    save_figure(path.join(outdir,"cosmo"+str(ii)+"_vel_HI_col_z3"))
-    plt.clf()
+if __name__ == "__main__":
+    for ii in (0,1,2,3):
+        #Plot col_density of metals vs HI
+        plot_vel_mass(ii, 3)
+        save_figure(path.join(outdir,"cosmo"+str(ii)+"z3_vel_mass"))
+        plt.clf()
+
+    for ii in (0,1,2,3):
+        #Plot col_density of metals vs HI
+        plot_met_mass(ii, 3)
+        save_figure(path.join(outdir,"cosmo"+str(ii)+"z3_met_mass"))
+        plt.clf()
+
+    # plot_Si_metals(0, 3)
+    # save_figure(path.join(outdir,"cosmo0_512_z3_Si_metals"))
+    # plt.clf()
+    #
+
+    for ii in (0,1,2,3):
+        #Plot col_density of metals vs HI
+        plot_max_den(ii, 3)
+        save_figure(path.join(outdir,"cosmo"+str(ii)+"z3_coldens"))
+        plt.clf()
+
+    for ii in (0,1,2,3):
+        #Plot metal col. den vs vel width
+        plot_vel_den(ii, 3)
+        save_figure(path.join(outdir,"cosmo"+str(ii)+"_vel_den_z3"))
+        plt.clf()
+
+    for ii in (0,1,2,3):
+        #Plot metal col. den vs vel width
+        plot_vel_HI_col_den(ii, 3)
+        save_figure(path.join(outdir,"cosmo"+str(ii)+"_vel_HI_col_z3"))
+        plt.clf()
+
+    spectra_cache.cache.report()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Generate some velocity widths through DLAs for the checking script"""
 import gridspectra as gs
+import vw_spectra
 import spectra as ss
 import os.path as path
 import numpy as np
@@ -12,15 +13,23 @@ np.seterr(under='warn')
 
 def make_stuff(halo):
     """Get the various arrays we want and save them"""
-    halo.get_density("H",1)
-    halo.get_observer_tau("Si",2, force_recompute=True)
-    #SiII 1260
-    halo.get_tau("Si",2,1260, force_recompute=True)
-    halo.get_tau("Si",2,1526, force_recompute=True)
-    halo.get_tau("H",1,1215, force_recompute=True)
-    halo.get_density("Si",2, force_recompute=True)
-    halo.get_density("Z",-1)
-    halo.get_density("H",-1)
+    if isinstance(halo, vw_spectra.VWSpectra):
+        #Compute everything in one pass over the particles.
+        #The densities are cheap once the particles are read, so recompute them all.
+        halo.compute_batch([("H",1,vw_spectra.COLDEN), ("Si",2,vw_spectra.OBSERVER_TAU),
+                            #SiII 1260
+                            ("Si",2,1260), ("Si",2,1526), ("H",1,1215),
+                            ("Si",2,vw_spectra.COLDEN), ("Z",-1,vw_spectra.COLDEN), ("H",-1,vw_spectra.COLDEN)], force_recompute=True)
+    else:
+        halo.get_density("H",1)
+        halo.get_observer_tau("Si",2, force_recompute=True)
+        #SiII 1260
+        halo.get_tau("Si",2,1260, force_recompute=True)
+        halo.get_tau("Si",2,1526, force_recompute=True)
+        halo.get_tau("H",1,1215, force_recompute=True)
+        halo.get_density("Si",2, force_recompute=True)
+        halo.get_density("Z",-1)
+        halo.get_density("H",-1)
     halo.save_file()
 
 snapnum=3
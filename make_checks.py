@@ -13,6 +13,7 @@ import vel_data
 import os.path as path
 import numpy as np
 import myname
+import spectra_cache
 from save_figure import save_figure
 
 outdir = path.join(myname.base, "plots/checks/")
@@ -22,8 +23,7 @@ zrange = {1:(7,3.5), 3:(7,0), 5:(2.5,0)}
 
 def plot_metal_ion_corr(sim, snap,species="Si",ion=2):
     """Plot metallicity from Z/H vs from a single species for computing ionisation corrections"""
-    halo = myname.get_name(sim)
-    hspec = ps.VWPlotSpectra(snap, halo)
+    hspec = spectra_cache.get_spectra(sim, snap)
     hspec.plot_metallicity(color="red", ls="-")
     hspec.plot_species_metallicity(species, ion, color="blue", ls="-")
     vel_data.plot_alpha_metal_data((3.5,2.5))
@@ -39,12 +39,10 @@ def plot_vel_width_SiII(sim, snap):
        setting n(Si+)/n(Si) = n(HI)/n(H)
     """
     #Load from a save file only
-    halo = myname.get_name(5, box=10)
-    hspec_tesc = ps.VWPlotSpectra(snap, halo, savefile="halo_spectra_2.hdf5") #,cdir=path.expanduser("~/codes/cloudy_tables/ion_out_no_atten/"))
+    hspec_tesc = spectra_cache.get_spectra(5, snap, box=10, savefile="halo_spectra_2.hdf5", summary=True) #,cdir=path.expanduser("~/codes/cloudy_tables/ion_out_no_atten/"))
     hspec_tesc.plot_vel_width("Si", 2, color="green", ls="-.")
-    halo = myname.get_name(sim)
-    hspec = ps.VWPlotSpectra(snap, halo)
-    hspecSi = ps.VWPlotSpectra(snap, halo,savefile="SiHI_spectra.hdf5")
+    hspec = spectra_cache.get_spectra(sim, snap, summary=True)
+    hspecSi = spectra_cache.get_spectra(sim, snap, savefile="SiHI_spectra.hdf5", summary=True)
     plot_check(hspec, hspecSi,"SiHI")
 
 def plot_vel_width_SiII_keating(sim, snap):
@@ -52,137 +50,119 @@ def plot_vel_width_SiII_keating(sim, snap):
        Plot the change in velocity widths between the full calculation and
        setting n(Si+)/n(Si) = n(HI)/n(H)
     """
-    halo = myname.get_name(sim)
     #Load from a save file only
-    hspec = ps.VWPlotSpectra(snap, halo)
-    hspecSi2 = ps.VWPlotSpectra(snap, halo,savefile="si_colden_spectra.hdf5")
+    hspec = spectra_cache.get_spectra(sim, snap, summary=True)
+    hspecSi2 = spectra_cache.get_spectra(sim, snap, savefile="si_colden_spectra.hdf5", summary=True)
     plot_check(hspec, hspecSi2,"SiHI_keating")
 
 def test_spec_resolution():
     """Plot the velocity widths for different spectral resolutions"""
-    halo = myname.get_name(7)
     #Higher resolution spectrum
-    hspec = ps.VWPlotSpectra(3, halo, savefile="grid_spectra_DLA.hdf5")
-    hspec2 = ps.VWPlotSpectra(3, halo, savefile="grid_spectra_DLA_res.hdf5")
+    hspec = spectra_cache.get_spectra(7, 3, savefile="grid_spectra_DLA.hdf5", summary=True)
+    hspec2 = spectra_cache.get_spectra(7, 3, savefile="grid_spectra_DLA_res.hdf5", summary=True)
     plot_check(hspec,hspec2,"specres")
 
 def test_vel_abswidth():
     """Plot the velocity widths for different minimum absorber widths"""
     halo = myname.get_name(7)
     #Higher resolution spectrum
-    hspec = ps.VWPlotSpectra(3, halo)
-    hspec2 = ps.VWPlotSpectra(3, halo)
+    hspec = spectra_cache.get_spectra(7, 3, summary=True)
+    #Not from the cache, as we change it
+    hspec2 = ps.VWPlotSummary(3, halo)
     hspec2.minwidth = 250.
     plot_check(hspec,hspec2,"abswidth")
 
 def test_pecvel():
     """Plot the velocity widths with and without peculiar velocities"""
-    halo = myname.get_name(7)
     #Higher resolution spectrum
-    hspec = ps.VWPlotSpectra(3, halo, savefile="grid_spectra_DLA.hdf5")
-    hspec2 = ps.VWPlotSpectra(3, halo, None, None, savefile="grid_spectra_DLA_pecvel.hdf5")
+    hspec = spectra_cache.get_spectra(7, 3, savefile="grid_spectra_DLA.hdf5", summary=True)
+    hspec2 = spectra_cache.get_spectra(7, 3, savefile="grid_spectra_DLA_pecvel.hdf5", summary=True)
     plot_check(hspec,hspec2,"pecvel")
 
 def test_tophat():
     """Plot the velocity widths with and with top hat vs SPH"""
-    halo = myname.get_name(7)
     #Higher resolution spectrum
-    hspec = ps.VWPlotSpectra(3, halo, savefile="grid_spectra_DLA.hdf5")
-    hspec2 = ps.VWPlotSpectra(3, halo, None, None, savefile="grid_spectra_DLA_tophat.hdf5")
+    hspec = spectra_cache.get_spectra(7, 3, savefile="grid_spectra_DLA.hdf5", summary=True)
+    hspec2 = spectra_cache.get_spectra(7, 3, savefile="grid_spectra_DLA_tophat.hdf5", summary=True)
     plot_check(hspec,hspec2,"tophat")
 
 def test_lowres():
     """Plot the velocity widths with and with top hat vs SPH"""
-    halo = myname.get_name(0)
-    halolow = myname.get_name(0, ff=False)
     #Higher resolution spectrum
-    hspec = ps.VWPlotSpectra(3, halo, savefile="grid_spectra_DLA.hdf5")
-    hspec2 = ps.VWPlotSpectra(60, halolow, None, None, savefile="rand_spectra_DLA.hdf5")
+    hspec = spectra_cache.get_spectra(0, 3, savefile="grid_spectra_DLA.hdf5", summary=True)
+    hspec2 = spectra_cache.get_spectra(0, 60, ff=False, savefile="rand_spectra_DLA.hdf5", summary=True)
     plot_check(hspec,hspec2,"lowres")
 
 def test_box_resolution():
     """Plot the velocity widths for different size boxes"""
-    halo = myname.get_name(7)
-    halo10 = myname.get_name(5,box=10)
 #     for zz in (1,3,5):
     zz = 3
-    hspec = ps.VWPlotSpectra(zz, halo, label="DEF")
-    hspec2 = ps.VWPlotSpectra(zz, halo10, label="SMALL")
+    hspec = spectra_cache.get_spectra(7, zz, label="DEF", summary=True)
+    hspec2 = spectra_cache.get_spectra(5, zz, box=10, label="SMALL", summary=True)
     plot_check(hspec,hspec2,"box", zz)
 
 def test_min_wind():
     """Plot the velocity widths for minimum wind velocity"""
-    halo = myname.get_name(7)
-    halo10 = myname.get_name(5)
     zz = 3
-    hspec = ps.VWPlotSpectra(zz, halo, label="DEF")
-    hspec2 = ps.VWPlotSpectra(zz, halo10, label="SLIKE")
+    hspec = spectra_cache.get_spectra(7, zz, label="DEF", summary=True)
+    hspec2 = spectra_cache.get_spectra(5, zz, label="SLIKE", summary=True)
     plot_check(hspec,hspec2,"minwind", zz)
 
 def test_metal():
     """Plot the velocity widths for metal enrichment"""
-    halo = myname.get_name(7)
-    halo10 = myname.get_name(8)
     zz = 3
-    hspec = ps.VWPlotSpectra(zz, halo, label="DEF")
-    hspec2 = ps.VWPlotSpectra(zz, halo10, label="ENRICH")
+    hspec = spectra_cache.get_spectra(7, zz, label="DEF", summary=True)
+    hspec2 = spectra_cache.get_spectra(8, zz, label="ENRICH", summary=True)
     plot_check(hspec,hspec2,"enrich", zz)
 
 def test_big_box():
     """Plot the velocity widths for different size boxes"""
-    halo = myname.get_name(0)
     halobig = path.expanduser("~/data/Illustris")
-    hspec = ps.VWPlotSpectra(3, halo, label="DEF")
-    hspec2 = ps.VWPlotSpectra(59, halobig, label="ILLUS")
+    hspec = spectra_cache.get_spectra(0, 3, label="DEF", summary=True)
+    hspec2 = ps.VWPlotSummary(59, halobig, label="ILLUS")
     plot_check(hspec,hspec2,"bigbox")
 
 def test_gfm_shield():
     """Plot the velocity widths for dynamical self-shielding vs post-processed self-shielding."""
-    halo = myname.get_name(7)
-    halo2 = myname.get_name('B')
-    hspec = ps.VWPlotSpectra(3, halo, label="2xUV")
-    hspec2 = ps.VWPlotSpectra(3, halo2, label="NOSHIELD")
+    hspec = spectra_cache.get_spectra(7, 3, label="2xUV", summary=True)
+    hspec2 = spectra_cache.get_spectra('B', 3, label="NOSHIELD", summary=True)
     plot_check(hspec,hspec2,"gfm_shield")
-    hspec = ps.VWPlotSpectra(5, halo, label="2xUV")
-    hspec2 = ps.VWPlotSpectra(5, halo2, label="NOSHIELD")
+    hspec = spectra_cache.get_spectra(7, 5, label="2xUV", summary=True)
+    hspec2 = spectra_cache.get_spectra('B', 5, label="NOSHIELD", summary=True)
     plot_check(hspec,hspec2,"gfm_shield", snap=5)
 
-class NoFilt(ps.VWPlotSpectra):
+class NoFilt(ps.VWPlotSummary):
     def get_filt(self, elem, ion):
-        return ps.VWPlotSpectra.get_filt(self, elem, ion, 100)
+        return ps.VWPlotSummary.get_filt(self, elem, ion, 100)
 
 def test_filt():
     """Plot impact of filtering low-metallicity systems."""
     halo = myname.get_name(7)
-    hspec = ps.VWPlotSpectra(3, halo, label="FILT")
+    hspec = spectra_cache.get_spectra(7, 3, label="FILT", summary=True)
     hspec2 = NoFilt(3, halo, label="NOFILT")
     plot_check(hspec,hspec2,"filtering")
 
 def test_atten():
     """Plot the effect of the self-shielding correction"""
-    halo = myname.get_name(7)
-    hspec = ps.VWPlotSpectra(3, halo, label="ATTEN")
-    hspec2 = ps.VWPlotSpectra(3, halo,savefile="grid_spectra_DLA_no_atten.hdf5",label="NOATTEN")
+    hspec = spectra_cache.get_spectra(7, 3, label="ATTEN", summary=True)
+    hspec2 = spectra_cache.get_spectra(7, 3, savefile="grid_spectra_DLA_no_atten.hdf5",label="NOATTEN", summary=True)
     plot_check(hspec,hspec2,"no_atten")
 
 def test_shield():
     """Plot velocity width for spectra using self-shielding like in Tescari 2009"""
-    halo = myname.get_name(7)
-    hspec = ps.VWPlotSpectra(3, halo)
-    hspec2 = ps.VWPlotSpectra(3, halo,savefile="grid_spectra_DLA_noshield.hdf5")
+    hspec = spectra_cache.get_spectra(7, 3, summary=True)
+    hspec2 = spectra_cache.get_spectra(7, 3, savefile="grid_spectra_DLA_noshield.hdf5", summary=True)
     plot_check(hspec,hspec2,"no_shield")
 
 def test_noise():
     """Plot the effect of noise on the spectrum"""
-    halo = myname.get_name(7)
-    hspec = ps.VWPlotSpectra(3, halo, snr=0.,label="No Noise")
-    hspec2 = ps.VWPlotSpectra(3, halo, snr = 20.,label="Noise")
+    hspec = spectra_cache.get_spectra(7, 3, snr=0.,label="No Noise", summary=True)
+    hspec2 = spectra_cache.get_spectra(7, 3, snr = 20.,label="Noise", summary=True)
     plot_check(hspec,hspec2,"noise")
 
 def plot_corr_as_points():
     """Plot the correlation as points"""
-    halo = myname.get_name(7)
-    hspec = ps.VWPlotSpectra(3, halo)
+    hspec = spectra_cache.get_spectra(7, 3)
     vel = hspec.vel_width("Si", 2)
     met = hspec.get_metallicity()
     #Ignore objects too faint to be seen
@@ -210,11 +190,9 @@ def plot_check(hspec, hspec2, ofile, snap=3):
     plt.clf()
     (vbin,one) = hspec.vel_width_hist("Si",2)
     (vbin,two) = hspec2.vel_width_hist("Si",2)
-    if np.size(one) != np.size(two):
-        maxx = np.min([np.size(one),np.size(two)])
-        plt.semilogx(vbin[:maxx],one[:maxx]/two[:maxx])
-    else:
-        plt.semilogx(vbin,one/two)
+    #Bins are the same for both, but may be empty
+    ind = np.where(two > 0)
+    plt.semilogx(vbin[ind],one[ind]/two[ind])
     plt.legend()
     save_figure(path.join(outdir,"cosmo_rel_vel_width_"+ofile+"_z"+str(snap)))
     plt.clf()
@@ -239,8 +217,7 @@ def plot_check(hspec, hspec2, ofile, snap=3):
 
 def test_tescari_halos(sim, snap):
     """Plot velocity width for spectra through the center of halos, like in Tescari 2009"""
-    halo = myname.get_name(sim, box=10)
-    hspec = ps.VWPlotSpectra(snap, halo, savefile="halo_spectra_2.hdf5",cdir=path.expanduser("~/codes/cloudy_tables/ion_out_no_atten/"))
+    hspec = spectra_cache.get_spectra(sim, snap, box=10, savefile="halo_spectra_2.hdf5",cdir=path.expanduser("~/codes/cloudy_tables/ion_out_no_atten/"))
     hspec.plot_vel_width("Si", 2, color="red")
     vel_data.plot_prochaska_2008_data()
     save_figure(path.join(outdir,"cosmo_tescari_halos"))
@@ -269,3 +246,4 @@ if __name__ == "__main__":
 #     plot_vel_width_metcol(0,3)
     plot_metal_ion_corr(7,3)
     plot_metal_ion_corr(0,3)
+    spectra_cache.cache.report()
@@ -7,9 +7,9 @@ matplotlib.use('PDF')
 
 import matplotlib.pyplot as plt
 
-import vw_plotspectra as ps
 import os.path as path
 import myname
+import spectra_cache
 import numpy as np
 from save_figure import save_figure
 
@@ -24,18 +24,10 @@ colors2 = {0:"darkred", 1:"indigo", 2:"cyan", 3:"darkgreen", 4:"gold", 5:"red",
 lss = {0:"--",1:":", 2:":",3:"-.", 4:"--", 5:"-",6:"--",7:"-", 9:"-"}
 labels = {0:"ILLUS",1:"HVEL", 2:"HVNOAGN",3:"NOSN", 4:"WMNOAGN", 5:"MVEL",6:"METAL",7:"DEF", 9:"FAST"}
 
-hspec_cache = {}
-
 def get_hspec(sim, snap, box=25):
     """Get a spectra object, possibly from the cache"""
-    halo = myname.get_name(sim, True, box=box)
     #Load from a save file only
-    try:
-        hspec = hspec_cache[(halo, snap)]
-    except KeyError:
-        hspec = ps.VWPlotSpectra(snap, halo, label=labels[sim])
-        hspec_cache[(halo, snap)] = hspec
-    return hspec
+    return spectra_cache.get_spectra(sim, snap, box=box, label=labels[sim])
 
 
 def plot_mass_hists(sim, snap):
@@ -224,4 +216,4 @@ if __name__ == "__main__":
             plot_vvir_vs_mm(ss, zz)
             plot_mass_vs_mm(ss, zz)
             plot_mm_vs_vel(ss, zz)
-
+    spectra_cache.cache.report()
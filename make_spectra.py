@@ -3,6 +3,7 @@
 import gridspectra as gs
 import randspectra as rs
 import vw_spectra as ss
+import shardspectra as shard
 import sys
 import os.path as path
 import numpy as np
@@ -16,24 +17,27 @@ sim=sys.argv[2]
 #base="/n/hernquistfs1/mvogelsberger/projects/GFM/Production/Cosmo/Cosmo"+str(sim)+"_V6/L25n512/output/"
 #savedir="/n/home11/spb/scratch/Cosmo/Cosmo"+str(sim)+"_V6_512/snapdir_"+str(snapnum).rjust(3,'0')
 base=path.expanduser("~/data/Cosmo/Cosmo"+str(sim)+"_V6/L25n512/output")
+#Arrays to compute for each sightline, as (elem, ion, line) requests for compute_batch.
+#These are all computed in one pass over the particles of each shard.
+#Each shard is computed from scratch, so there is no need to force a recompute.
+requests = [("H",1,ss.COLDEN),
+            #SiII 1260
+            ("Si",2,1260),
+            ("Si",2,1526),
+            ("H",1,1215),
+            ("Si",2,ss.COLDEN),
+            ("Z",-1,ss.COLDEN),
+            ("H",-1,ss.COLDEN),
+            ("H",1,ss.VELOCITY)]
 if len(sys.argv) > 4:
     halo = ss.VWSpectra(snapnum, base, None, None,savefile = "grid_spectra_DLA.hdf5")
-    halo.get_observer_tau("Si",2, force_recompute=True)
+    requests = [("Si",2,ss.OBSERVER_TAU),] + requests
 elif len(sys.argv) > 3:
     halo = rs.RandSpectra(snapnum, base, numlos=5000, thresh=0)
 else:
     halo = gs.GridSpectra(snapnum, base, numlos=5000)
-    halo.get_observer_tau("Si",2, force_recompute=True)
-
-
-halo.get_density("H",1)
-#SiII 1260
-halo.get_tau("Si",2,1260, force_recompute=True)
-halo.get_tau("Si",2,1526, force_recompute=True)
-halo.get_tau("H",1,1215 , force_recompute=True)
-halo.get_density("Si",2)
-halo.get_density("Z",-1)
-halo.get_density("H",-1)
-halo.get_velocity("H",1)
-halo.save_file()
+    requests = [("Si",2,ss.OBSERVER_TAU),] + requests
+quantities = [("compute_batch", (requests,)),]
 
+#Compute the spectra in parallel, in blocks of sightlines, and save them
+shard.make_sharded(halo, quantities)
@@ -12,10 +12,13 @@ import matplotlib.gridspec as gridspec
 import vw_plotspectra as ps
 import vel_data
 import leastsq as ls
+import ks2d
 import os.path as path
 import os
 import numpy as np
 import myname
+import spectra_cache
+import taskgraph
 import math
 from save_figure import save_figure
 
@@ -29,18 +32,26 @@ colors2 = {0:"darkred", 1:"indigo", 2:"cyan", 3:"darkgreen", 4:"gold", 5:"red",
 lss = {0:"--",1:":", 2:":",3:"-.", 4:"--", 5:"-",6:"--",7:"-", 8:"-",9:"-",'A':"--"}
 labels = {0:"ILLUS",1:"HVEL", 2:"HVNOAGN",3:"NOSN", 4:"WMNOAGN", 5:"MVEL",6:"METAL",7:"DEF", 8:"RICH",9:"FAST", 'A':"MOM", 'S':"SMALL"}
 
-hspec_cache = {}
-
-def get_hspec(sim, snap, snr=0., box = 25):
-    """Get a spectra object, possibly from the cache"""
-    halo = myname.get_name(sim, True, box=box)
+def get_hspec(sim, snap, snr=0., box = 25, summary=False):
+    """Get a spectra object, possibly from the cache.
+    If summary, get a view of the per-spectrum statistics only."""
     #Load from a save file only
-    try:
-        hspec = hspec_cache[(halo, snap)]
-    except KeyError:
-        hspec = ps.VWPlotSpectra(snap, halo, label=labels[sim], snr=snr)
-        hspec_cache[(halo, snap)] = hspec
-    return hspec
+    return spectra_cache.get_spectra(sim, snap, box=box, snr=snr, label=labels[sim], summary=summary)
+
+def snapshot_stats(sim, snap, box=25):
+    """Compute the statistics used by the paper figures for one snapshot and save them with the spectra,
+    so the figures only need to load them. This is run in a pool process by the task graph in __main__."""
+    hspec = get_hspec(sim, snap, box=box, summary=True)
+    hspec.vel_width("Si", 2)
+    hspec.get_filt("Si", 2)
+    hspec.get_metallicity()
+    hspec.equivalent_width("Si", 2, 1526)
+    #The bins used by each figure
+    for dv in (0.17, 0.1):
+        hspec.vel_width_hist("Si", 2, dv)
+    hspec.f_meanmedian_hist("Si", 2, 0.06)
+    hspec.f_peak_hist("Si", 2, 0.06)
+    hspec.eq_width_hist("Si", 2, 1526, 0.1)
 
 def plot_vel_width_sim(sim, snap, color="red", HI_cut = None):
     """Load a simulation and plot its velocity width"""
@@ -60,9 +71,6 @@ def plot_spectrum(sim, snap, num, low=0, high=-1, offset=0,subdir="", box=10):
     if not path.exists(sdir):
         os.mkdir(sdir)
     xoff = hspec.plot_spectrum("Si",2,-1,num, flux=False)
-    #Offset of the peak from the zero point
-#     peak = hspec._vel_peak_tau(tau_l)
-#     plt.text(-10,0.5,r"$f_\mathrm{edg} = "+str(peak)+"$")
     save_figure(path.join(sdir,str(num)+"_cosmo"+str(sim)+"_Si_tau"))
     plt.clf()
     hspec.plot_spectrum("Si",2,1260,num, flux=False)
@@ -161,7 +169,7 @@ def plot_met_corr(sims,snap):
     """Plot metallicity vel width correlations"""
     for sim in sims:
         out = "cosmo"+str(sim)+"_correlation_z"+str(snap)
-        hspec = get_hspec(sim, snap)
+        hspec = get_hspec(sim, snap, summary=True)
         hspec.plot_Z_vs_vel_width(color=colors[sim], color2=colors2[sim])
         vel_data.plot_prochaska_2008_correlation(zrange[snap])
         plt.xlim(10, 500)
@@ -182,9 +190,9 @@ def plot_cum_vel_width_sims(sims, snap):
     norm = cvels[-1]
     for sss in sims:
         #Make abs. plot
-        hspec = get_hspec(sss, snap)
+        hspec = get_hspec(sss, snap, summary=True)
         hspec.plot_cum_vel_width("Si", 2, norm=norm, color=colors[sss], ls=lss[sss])
-    hspec = get_hspec(5, snap, box=10)
+    hspec = get_hspec(5, snap, box=10, summary=True)
     hspec.label=labels["S"]
     hspec.plot_cum_vel_width("Si", 2, norm=norm, color=colors["S"], ls="--")
     hspec.plot_vw_errors("Si", 2, samples=norm,cumulative=True, color=colors2["S"])
@@ -203,7 +211,7 @@ def plot_vel_width_sims(sims, snap, log=False):
     vel_data.plot_prochaska_2008_data()
     for sss in sims:
         #Make abs. plot
-        hspec = get_hspec(sss, snap)
+        hspec = get_hspec(sss, snap, summary=True)
         hspec.plot_vel_width("Si", 2, color=colors[sss], ls=lss[sss])
     outstr = "cosmo_vel_width_z"+str(snap)
     if log:
@@ -213,7 +221,7 @@ def plot_vel_width_sims(sims, snap, log=False):
         outstr+="_log"
     else:
         plt.ylim(1e-2,2)
-    hspec = get_hspec(5, snap, box=10)
+    hspec = get_hspec(5, snap, box=10, summary=True)
     hspec.label=labels["S"]
     hspec.plot_vel_width("Si", 2, color=colors["S"], ls="--")
     hspec.plot_vw_errors("Si", 2, samples=100,cumulative=False, color=colors2["S"])
@@ -229,16 +237,16 @@ def plot_eq_width(sims, snap):
     """Plot velocity widths for a series of simulations"""
     for sss in sims:
         #Make abs. plot
-        hspec = get_hspec(sss, snap)
+        hspec = get_hspec(sss, snap, summary=True)
         hspec.plot_eq_width("Si", 2, 1526, color=colors[sss], ls=lss[sss])
-    hspec = get_hspec(7, snap)
+    hspec = get_hspec(7, snap, summary=True)
     outstr = "cosmo_eq_width_z"+str(snap)
     if snap == 5:
         nv_table = 7
     else:
         nv_table = 9
     (center, _) = vel_data.plot_si1526_eqw(zrange[snap], nv_table=nv_table)
-    hspec = get_hspec(5, snap, box=10)
+    hspec = get_hspec(5, snap, box=10, summary=True)
     hspec.label=labels["S"]
     hspec.plot_eq_width("Si", 2, 1526, color=colors["S"], ls="--")
     hspec.plot_eq_width_errors("Si", 2, 1526, 100, color=colors2["S"], nv_table=nv_table, min_width=center[0])
@@ -257,8 +265,9 @@ def plot_rel_vel_width(sims, snap):
     for sss in sims:
         hspec = get_hspec(sss, snap)
         (vbin, vel) = hspec.vel_width_hist("Si", 2)
-        mm = np.min([np.size(vel), np.size(vels7)])
-        plt.semilogx(vbin[:mm], vel[:mm]/vels7[:mm], color=colors[sss],ls=lss[sss])
+        #Bins are the same for all simulations, but may be empty
+        ind = np.where(vels7 > 0)
+        plt.semilogx(vbin[ind], vel[ind]/vels7[ind], color=colors[sss],ls=lss[sss])
     plt.xlim(10, 1000)
     save_figure(path.join(outdir,"cosmo_rel_vel_z"+str(snap)))
     plt.clf()
@@ -267,9 +276,9 @@ def plot_mean_median(sims, snap):
     """Plot mean-median statistic for all sims on one plot"""
     #Plot extra statistics
     for sss in sims:
-        hspec = get_hspec(sss, snap)
+        hspec = get_hspec(sss, snap, summary=True)
         hspec.plot_f_meanmedian("Si", 2, color=colors[sss], ls=lss[sss])
-    hspec = get_hspec(5, snap, box=10)
+    hspec = get_hspec(5, snap, box=10, summary=True)
     hspec.label=labels["S"]
     hspec.plot_f_meanmedian("Si", 2, color=colors["S"], ls="--")
     hspec.plot_f_meanmedian_errors("Si", 2, samples=100,cumulative=False, color=colors2["S"])
@@ -279,63 +288,73 @@ def plot_mean_median(sims, snap):
     save_figure(path.join(outdir,"cosmo_mean_median_z"+str(snap)))
     plt.clf()
 
-import numexpr as ne
+import haloindex
 
 class RotationFiltered(ps.VWPlotSpectra):
     """Class to plot the velocity widths of only rotationally supported gas"""
+    filt_label = "rotation"
+
     def _filter_particles(self, elem_den, pos, velocity, den):
         """Filtered list of particles that are rotationally supported by a halo."""
         #Filter particles that are non-dense, as they will not be in halos
         ind2 = np.where(np.logical_and(den > 3e-4, elem_den > 0))
-        halo_cofm = self.sub_cofm
-        sub_cofm = self.sub_sub_cofm
-        ind3 = []
         frachigh = 1.5
         fraclow = 0.7
-        non_rot = 0
-        for ii in ind2[0]:
-            #Is this within the virial radius of any halo?
-            ppos = pos[ii,:]
-            dd = ne.evaluate("sum((halo_cofm - ppos)**2,axis=1)")
-            ind = np.where(dd < self.sub_radii**2)
-            #Check subhalos
-            if np.size(ind) < 1:
-                dd = ne.evaluate("sum((sub_cofm - ppos)**2,axis=1)")
-                ind = np.where(dd < self.sub_sub_radii**2)
-                if np.size(ind) < 1:
-                    continue
-                ind = ind[0][0]
-                hvel = self.sub_sub_vel[ind,:]
-                hcofm = self.sub_sub_cofm[ind,:]
-                hrad = self.sub_sub_radii[ind]
-                vvir = self.virial_vel([ind,], subhalo=True)[0]
-            else:
-                ind = ind[0][0]
-                hvel = self.sub_vel[ind,:]
-                hcofm = self.sub_cofm[ind,:]
-                hrad = self.sub_radii[ind]
-                vvir = self.virial_vel([ind,])[0]
-            #It is! What is the perpendicular velocity wrt this halo?
-            lvel =  velocity[ii, :] - hvel
-            #Radial vector from halo
-            lpos = ppos - hcofm
-            ldist = np.sqrt(np.sum(lpos**2))
-            #Find parallel by dotting with unit vector
-            vpar = np.dot(lvel, lpos/ldist)
-            vperp = np.sqrt(np.sum(lvel**2) - vpar)
-            #Rotational velocity assuming NFW concentration 10 (like MW).
-            vhalo = vvir * np.sqrt(5*ldist) / (1+ 10 * ldist / hrad)
-            #Are we rotation supported?
-            #Also, the angular vector should dominate over the radial
-            if np.abs(vperp / (vpar+0.1)) < 2 or vperp / vhalo >  frachigh or vperp / vhalo < fraclow:
-                non_rot += 1
-                continue
-            #If we are, add to the list
-            ind3+= [ii,]
+        ppos = pos[ind2]
+        (halos, subhalos) = self._halo_indices()
+        #Is this within the virial radius of any halo?
+        hh = halos.containing(ppos)
+        #Check subhalos
+        ss = -np.ones_like(hh)
+        nohalo = np.where(hh < 0)
+        ss[nohalo] = subhalos.containing(ppos[nohalo])
+        inhalo = np.where(hh >= 0)
+        insub = np.where(ss >= 0)
+        hvel = np.empty_like(ppos)
+        hcofm = np.empty_like(ppos)
+        hrad = np.empty(np.shape(ppos)[0])
+        vvir = np.empty(np.shape(ppos)[0])
+        hvel[inhalo] = self.sub_vel[hh[inhalo],:]
+        hcofm[inhalo] = self.sub_cofm[hh[inhalo],:]
+        hrad[inhalo] = self.sub_radii[hh[inhalo]]
+        vvir[inhalo] = self.virial_vel()[hh[inhalo]]
+        hvel[insub] = self.sub_sub_vel[ss[insub],:]
+        hcofm[insub] = self.sub_sub_cofm[ss[insub],:]
+        hrad[insub] = self.sub_sub_radii[ss[insub]]
+        vvir[insub] = self.virial_vel(subhalo=True)[ss[insub]]
+        assigned = np.where(np.logical_or(hh >= 0, ss >= 0))
+        #It is! What is the perpendicular velocity wrt this halo?
+        lvel = velocity[ind2][assigned] - hvel[assigned]
+        #Radial vector from halo
+        lpos = haloindex.periodic_offset(ppos[assigned], hcofm[assigned], self.box)
+        ldist = np.sqrt(np.sum(lpos**2, axis=1))
+        #Find parallel by dotting with unit vector
+        vpar = np.sum(lvel*lpos, axis=1)/ldist
+        vperp = np.sqrt(np.sum(lvel**2, axis=1) - vpar)
+        #Rotational velocity assuming NFW concentration 10 (like MW).
+        vhalo = vvir[assigned] * np.sqrt(5*ldist) / (1+ 10 * ldist / hrad[assigned])
+        #Are we rotation supported?
+        #Also, the angular vector should dominate over the radial
+        non_rot = np.logical_or(np.abs(vperp / (vpar+0.1)) < 2, np.logical_or(vperp / vhalo > frachigh, vperp / vhalo < fraclow))
+        #If we are, add to the list
+        ind3 = ind2[0][assigned][np.logical_not(non_rot)]
         print("Filtered ",np.size(ind2[0])," particles to ",np.size(ind3))
-        print("Non-rotating ",non_rot)
+        print("Non-rotating ",np.sum(non_rot))
         return ind3
 
+    def _filter_mask(self, elem, ion, thresh):
+        """
+        Mask to exclude spectra where the ion is not observable
+        or is not rotated
+
+        thresh - observable column density threshold
+        """
+        #Remember this is not in log...
+        met = self.get_max_density(elem, ion)
+        mask = np.logical_and(met > thresh, np.max(self.get_observer_tau(elem, ion), axis=1) > 0.1)
+        print("Sightlines with rotating absorption: ",np.sum(mask))
+        return mask
+
     def get_filt(self, elem, ion, thresh = 1e-20):
         """
         Get an index list to exclude spectra where the ion is not observable
@@ -343,11 +362,7 @@ class RotationFiltered(ps.VWPlotSpectra):
 
         thresh - observable column density threshold
         """
-        #Remember this is not in log...
-        met = np.max(self.get_density(elem, ion), axis=1)
-        ind = np.where(np.logical_and(met > thresh, np.max(self.get_observer_tau(elem, ion), axis=1) > 0.1))
-        print("Sightlines with rotating absorption: ",np.size(ind))
-        return ind
+        return ps.VWPlotSpectra.get_filt(self, elem, ion, thresh)
 
 def plot_v_struct(sims, snap):
     """Plot mean-median statistic for all sims on one plot"""
@@ -369,9 +384,9 @@ def plot_v_struct(sims, snap):
 def plot_f_peak(sims, snap):
     """Plot peak statistic for all sims on one plot"""
     for sss in sims:
-        hspec = get_hspec(sss, snap)
+        hspec = get_hspec(sss, snap, summary=True)
         hspec.plot_f_peak("Si", 2, color=colors[sss], ls=lss[sss])
-    hspec = get_hspec(5, snap, box=10)
+    hspec = get_hspec(5, snap, box=10, summary=True)
     hspec.label=labels["S"]
     hspec.plot_f_peak("Si", 2, color=colors["S"], ls="--")
     hspec.plot_f_peak_errors("Si", 2, samples=100,cumulative=False, color=colors2["S"])
@@ -404,8 +419,8 @@ def plot_cum_f_peak_sims(sims, snap):
 def plot_vel_widths_cloudy():
     """Plot some velocity width data for different cloudy models"""
     #Load sims
-    hspec0 = ps.VWPlotSpectra(3, myname.get_name(0, True))
-    hspec1 = ps.VWPlotSpectra(3, myname.get_name(0,True), savefile="rand_spectra_DLA_fancy_atten.hdf5")
+    hspec0 = spectra_cache.get_spectra(0, 3)
+    hspec1 = spectra_cache.get_spectra(0, 3, savefile="rand_spectra_DLA_fancy_atten.hdf5")
     #Make abs. plot
     hspec0.plot_vel_width("Si", 2, color="blue", ls="--")
     hspec1.plot_vel_width("Si", 2, color="red", ls="-")
@@ -415,23 +430,22 @@ def plot_vel_widths_cloudy():
     #Make rel plot
     (vbin, vels0) = hspec0.vel_width_hist("Si", 2)
     (vbin, vels2) = hspec1.vel_width_hist("Si", 2)
-    mm = np.min((np.size(vels2),np.size(vels0)))
-    plt.semilogx(vbin[:mm], vels0[:mm]/vels2[:mm], color="blue",ls="-")
+    ind = np.where(vels2 > 0)
+    plt.semilogx(vbin[ind], vels0[ind]/vels2[ind], color="blue",ls="-")
     plt.xlim(1, 1000)
     save_figure(path.join(outdir,"cosmo_rel_vel_cloudy_z3"))
     plt.clf()
 
 def plot_vel_redshift_evo(sim):
     """Plot the evolution with redshift of a simulation"""
-    halo = myname.get_name(sim, True)
     vels = {}
     for snap in (1,3,5):
-        hspec0 = ps.VWPlotSpectra(snap, halo)
+        hspec0 = spectra_cache.get_spectra(sim, snap)
         (vbin, vels[snap]) = hspec0.vel_width_hist("Si", 2)
-    mm = np.min([np.size(vel) for vel in vels.values()])
     #Normalised by z=3
-    plt.semilogx(vbin[:mm], vels[5][:mm]/vels[3][:mm], color="black",ls="--")
-    plt.semilogx(vbin[:mm], vels[1][:mm]/vels[3][:mm], color="grey",ls="-")
+    ind = np.where(vels[3] > 0)
+    plt.semilogx(vbin[ind], vels[5][ind]/vels[3][ind], color="black",ls="--")
+    plt.semilogx(vbin[ind], vels[1][ind]/vels[3][ind], color="grey",ls="-")
     plt.xlim(10, 1000)
     plt.ylim(0.5,1.5)
     save_figure(path.join(outdir,"cosmo"+str(sim)+"_zz_evol"))
@@ -489,8 +503,7 @@ def do_statistics(sim, snap):
     (_, met, vel) = vel_data.load_data(zrange[snap])
     vel = np.log10(vel)
     #Get Simulated data
-    halo = myname.get_name(sim, True)
-    hspec = ps.VWPlotSpectra(snap, halo)
+    hspec = spectra_cache.get_spectra(sim, snap)
     svel = hspec.vel_width("Si", 2)
     smet = hspec.get_metallicity()
     #Ignore objects too faint to be seen
@@ -510,13 +523,11 @@ def do_statistics(sim, snap):
     #Now test whether they come from the same population
     kss = hspec.kstest(10**met, 10**vel)
     print("KS test between simulated and observed samples: ",kss)
-    #Do 200 trials and see how many times the KS test is worse
-    ntrials = 50
-    count = 0
-    for _ in range(ntrials):
-        rand = np.random.randint(0,np.size(svel), np.size(vel))
-        if kss <= hspec.kstest(10**smet[rand], 10**svel[rand]):
-            count+=1
+    #Do many trials with random simulated samples the size of the observed one, in parallel,
+    #and see how many times the KS test is worse
+    ntrials = 2000
+    trials = ks2d.subsample_trials(hspec.ks_engine().reference, np.array([smet, svel]).T, np.size(vel), ntrials)
+    count = np.sum(kss <= trials)
     print("Prob KS test between simulated samples was larger: ",count*1./ntrials)
 
 if __name__ == "__main__":
@@ -527,27 +538,28 @@ if __name__ == "__main__":
 #     for ss in (1,3,9):
 #         do_statistics(ss,3)
 
-    plot_spectrum_max(5,3, 10, 0.9, 0.025, 15, ffilter="vel_peak")
-    plot_spectrum_max(5,3, 10, 60, 20, 15)
-    plot_spectrum_max(5,3, 10, 100, 20, 15)
-    plot_spectrum_max(5,3, 10, 200, 35, 15)
-    plot_spectrum_max(5,3, 10, 400, 50, 15)
     simlist = (1,3,7,9) #range(8)
-
-#     plot_vel_width_sims(simlist, 4, log=True)
-    plot_vvir_models()
-
+    #Each snapshot's statistics are computed once, in parallel, and each figure is made as soon as
+    #the statistics it needs are ready.
+    graph = taskgraph.TaskGraph()
+    small = {}
     for zz in (3,1, 5):
+        stats = [graph.add(("stats", ss, zz, 25), snapshot_stats, (ss, zz)) for ss in simlist]
+        small[zz] = graph.add(("stats", 5, zz, 10), snapshot_stats, (5, zz, 10))
+        stats.append(small[zz])
 #         plot_v_struct(simlist, zz)
-        plot_met_corr(simlist,zz)
-        plot_eq_width(simlist, zz)
+        for plot in (plot_met_corr, plot_eq_width, plot_vel_width_sims, plot_cum_vel_width_sims, plot_mean_median, plot_f_peak):
+            graph.add((plot.__name__, zz), plot, (simlist, zz), deps=stats, local=True)
 #         plot_metallicity(simlist, zz)
-        plot_vel_width_sims(simlist, zz)
-        plot_cum_vel_width_sims(simlist, zz)
 #         plot_cum_f_peak_sims(simlist, zz)
-        plot_mean_median(simlist, zz)
-        plot_f_peak(simlist, zz)
-        hspec_cache = {}
+    #These need the full spectra, so wait until the statistics are saved to the same files.
+    for (velbin, velwidth, ffilter) in ((0.9, 0.025, "vel_peak"), (60, 20, "vel_width"), (100, 20, "vel_width"), (200, 35, "vel_width"), (400, 50, "vel_width")):
+        graph.add(("plot_spectrum_max", velbin), plot_spectrum_max, (5,3, 10, velbin, velwidth, 15, ffilter), deps=[small[3]], local=True)
+#     plot_vel_width_sims(simlist, 4, log=True)
+    graph.add("plot_vvir_models", plot_vvir_models, deps=[("stats", 7, 3, 25), ("stats", 3, 3, 25)], local=True)
+    graph.run()
+    graph.report()
+    spectra_cache.cache.report()
 
 #     for ss in simlist:
 #         plot_sep_frac(ss,3)
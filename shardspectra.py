@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Compute spectra for a set of sightlines in parallel. The sightlines are split into shards,
+each of which is computed and saved by a separate process. The shards are then merged into
+a single save file, with the same layout save_file writes."""
+
+from __future__ import print_function
+import os
+import os.path as path
+import multiprocessing
+import numpy as np
+import h5py
+import vw_spectra
+
+#Groups of per-sightline arrays in a save file, and the attribute each is loaded into.
+SHARD_ARRAYS = {"tau_obs":"tau_obs", "tau":"tau", "colden":"colden", "velocity":"velocity",
+                "temperature":"temp", "num_important":"num_important", "tau_obs_line":"tau_obs_line"}
+
+def shard_files(savefile, nshards):
+    """Names of the shard files for a save file. These go in a directory next to it."""
+    sdir = savefile+".shards"
+    return [path.join(sdir, "shard_"+str(ii).rjust(4,'0')+".hdf5") for ii in range(nshards)]
+
+def _shard_key(nbins, cls, kwargs, quantities):
+    """A string identifying what a shard computes, stored in the shard so that
+    a shard made with different quantities, bins or arguments is recomputed."""
+    return repr((cls.__name__, int(nbins), sorted(kwargs.items()), list(quantities)))
+
+def _shard_done(shardfile, cofm, axis, key):
+    """Check whether a shard has already been computed for these sightlines and quantities."""
+    if not path.exists(shardfile):
+        return False
+    try:
+        f = h5py.File(shardfile, 'r')
+        done = f.attrs.get("shard_key", None) == key
+        done = done and np.array_equal(np.array(f["spectra"]["cofm"]), cofm) and np.array_equal(np.array(f["spectra"]["axis"]), axis)
+        f.close()
+    except (IOError, KeyError):
+        return False
+    return done
+
+def _make_shard(args):
+    """
+    Compute the requested quantities for one shard of sightlines and save them.
+    The shard is written under a temporary name and then renamed,
+    so that a shard file which exists is always complete.
+    """
+    (num, base, cofm, axis, nbins, cls, kwargs, shardfile, quantities) = args
+    (sdir, sname) = path.split(shardfile)
+    tmpfile = shardfile+".tmp"
+    if path.exists(tmpfile):
+        os.remove(tmpfile)
+    halo = cls(num, base, cofm=cofm, axis=axis, savefile=sname+".tmp", savedir=sdir, reload_file=True, **kwargs)
+    #Use exactly the velocity bins of the parent spectra
+    halo.nbins = nbins
+    halo.dvbin = halo.vmax / (1.*nbins)
+    for (method, margs) in quantities:
+        getattr(halo, method)(*margs)
+    halo.save_file()
+    f = h5py.File(tmpfile, 'a')
+    f.attrs["shard_key"] = _shard_key(nbins, cls, kwargs, quantities)
+    f.close()
+    os.rename(tmpfile, shardfile)
+    return shardfile
+
+def merge_shards(halo, shardfiles):
+    """
+    Join the per-sightline arrays from each shard, in order, into the arrays of halo.
+    Only arrays present in every shard are merged.
+    """
+    merged = {}
+    for shardfile in shardfiles:
+        f = h5py.File(shardfile, 'r')
+        for (name, attr) in SHARD_ARRAYS.items():
+            if name not in f:
+                continue
+            for (key, dset) in vw_spectra._multihash_keys(f[name]):
+                merged.setdefault((attr, key), []).append(np.array(f[dset]))
+        f.close()
+    for ((attr, key), values) in merged.items():
+        if len(values) < len(shardfiles):
+            continue
+        if np.ndim(values[0]) == 0:
+            value = np.sum(values)
+        else:
+            value = np.concatenate(values)
+        halo._cache(attr)[key] = value
+        #Anything derived from the old observer tau is now stale
+        if attr == "tau_obs":
+            halo._forget_stats(key[0], key[1])
+
+def make_sharded(halo, quantities, nshards=64, nproc=None, cls=vw_spectra.VWSpectra, **kwargs):
+    """
+    Compute quantities for all the sightlines in halo using a process pool, and save them to halo.savefile.
+    halo - spectra object whose sightlines (cofm and axis) have already been chosen.
+    quantities - list of (method name, arguments) to call for each shard,
+                 eg, [("get_tau", ("Si", 2, 1260)), ("get_density", ("H", 1))]
+    nshards - number of sightline blocks to split the spectra into.
+    nproc - number of processes to use. Default is one per core.
+    cls - spectra class used to compute each shard.
+    kwargs - extra arguments for cls. By default cdir and spec_res are taken from halo.
+
+    Shards already computed for the same sightlines, quantities and arguments,
+    by an earlier run which crashed, are not recomputed.
+    """
+    nshards = int(np.min([nshards, halo.NumLos]))
+    shardfiles = shard_files(halo.savefile, nshards)
+    sdir = path.dirname(shardfiles[0])
+    if not path.exists(sdir):
+        os.makedirs(sdir)
+    clsargs = {"cdir":halo.cdir, "spec_res":halo.spec_res}
+    clsargs.update(kwargs)
+    tasks = []
+    for (block, shardfile) in zip(np.array_split(np.arange(halo.NumLos), nshards), shardfiles):
+        cofm = halo.cofm[block]
+        axis = halo.axis[block]
+        if not _shard_done(shardfile, cofm, axis, _shard_key(halo.nbins, cls, clsargs, quantities)):
+            tasks.append((halo.num, halo.base, cofm, axis, halo.nbins, cls, clsargs, shardfile, quantities))
+    print("Computing ",len(tasks)," of ",nshards," shards")
+    if len(tasks) > 0:
+        pool = multiprocessing.Pool(nproc)
+        for shardfile in pool.imap_unordered(_make_shard, tasks):
+            print("Saved ",shardfile)
+        pool.close()
+        pool.join()
+    merge_shards(halo, shardfiles)
+    halo.save_file()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""A cache of spectra objects shared by the plotting scripts, so that each save file is only loaded once per run.
+When the objects in the cache use more memory than a budget, the least recently used are dropped."""
+
+from __future__ import print_function
+from collections import OrderedDict
+import numpy as np
+import myname
+import vw_plotspectra as ps
+
+def _nbytes(obj):
+    """Approximate memory used by an object: the size of the numpy arrays it holds,
+    directly or in dictionaries, lists and tuples."""
+    total = 0
+    seen = set()
+    stack = list(obj.__dict__.values())
+    while len(stack) > 0:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        if isinstance(item, np.ndarray):
+            total += item.nbytes
+        elif isinstance(item, dict):
+            stack += list(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack += list(item)
+    return total
+
+class SpectraCache(object):
+    """
+    Least recently used cache of spectra objects, with a memory budget in bytes.
+    Objects grow as arrays are lazy-loaded or computed, so sizes are re-measured on every access.
+    The object just accessed is never dropped, even if it alone exceeds the budget.
+    """
+    def __init__(self, budget=8*1024**3):
+        self.budget = budget
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, loader):
+        """Get the object stored under key, calling loader() to make it if it is not in the cache."""
+        try:
+            obj = self.cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            obj = loader()
+            self.misses += 1
+        #Most recently used is last
+        self.cache[key] = obj
+        self._evict()
+        return obj
+
+    def _evict(self):
+        """Drop least recently used objects until the rest fit in the budget."""
+        sizes = [_nbytes(obj) for obj in self.cache.values()]
+        total = np.sum(sizes)
+        for (key, size) in zip(list(self.cache.keys())[:-1], sizes[:-1]):
+            if total <= self.budget:
+                break
+            del self.cache[key]
+            total -= size
+            self.evictions += 1
+
+    def nbytes(self):
+        """Memory currently used by the cached objects."""
+        return np.sum([_nbytes(obj) for obj in self.cache.values()])
+
+    def clear(self):
+        """Drop all cached objects."""
+        self.cache.clear()
+
+    def report(self):
+        """Print the cache statistics."""
+        print("Spectra cache: ",self.hits," hits ",self.misses," misses ",self.evictions," evictions, ",len(self.cache)," objects using ",self.nbytes()/1024.**2," MB")
+
+#The cache shared by all scripts. Change cache.budget to use more or less memory.
+cache = SpectraCache()
+
+def get_spectra(sim, snap, box=25, savefile=None, snr=0., cdir=None, label="", ff=True, summary=False):
+    """
+    Get the spectra for a simulation, loaded from a save file only, possibly from the cache.
+    sim, box, ff - which simulation, as for myname.get_name.
+    savefile, cdir - passed to the spectra class. If None, its defaults are used.
+    snr - signal to noise ratio of the spectra.
+    label - label for plots. This is not part of the cache key, and is set on every call.
+    summary - if True, get a VWPlotSummary, which loads only the per-spectrum statistics, rather than a VWPlotSpectra.
+    """
+    halo = myname.get_name(sim, ff, box=box)
+    kwargs = {}
+    if savefile is not None:
+        kwargs["savefile"] = savefile
+    if cdir is not None:
+        kwargs["cdir"] = cdir
+    if summary:
+        cls = ps.VWPlotSummary
+    else:
+        cls = ps.VWPlotSpectra
+    hspec = cache.get((sim, snap, box, ff, savefile, snr, cdir, summary), lambda: cls(snap, halo, snr=snr, **kwargs))
+    hspec.label = label
+    return hspec
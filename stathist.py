@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Histograms with fixed bin edges, for distributions of per-spectrum statistics.
+These can be filled a chunk of spectra at a time, merged between shards, snapshots or boxes,
+saved with the spectra, and normalised at the end."""
+
+from __future__ import print_function
+import numpy as np
+
+class StatHistogram(object):
+    """
+    Histogram with fixed bin edges.
+    edges - bin edges, in the units of the values.
+    log - if True, values are binned in log10, so the density is per unit log10(value).
+    """
+    def __init__(self, edges, log=False):
+        self.edges = np.array(edges, dtype=np.float64)
+        self.log = log
+        self.counts = np.zeros(np.size(self.edges)-1, dtype=np.int64)
+        #Number of values below the first edge and above the last
+        self.underflow = 0
+        self.overflow = 0
+
+    def _binned(self, values):
+        """Values and edges in the space they are binned in."""
+        if self.log:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return (np.log10(values), np.log10(self.edges))
+        return (values, self.edges)
+
+    def update(self, values):
+        """Add a chunk of values to the histogram. Returns the histogram."""
+        (values, edges) = self._binned(np.ravel(values))
+        self.counts += np.histogram(values, edges)[0]
+        self.underflow += int(np.sum(values < edges[0]))
+        self.overflow += int(np.sum(values > edges[-1]))
+        return self
+
+    def merge(self, other):
+        """Add the counts of another histogram, which must have the same bins. Returns the histogram."""
+        if self.log != other.log or not np.array_equal(self.edges, other.edges):
+            raise ValueError("Histograms have different bins")
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
+
+    def __add__(self, other):
+        total = StatHistogram(self.edges, self.log)
+        return total.merge(self).merge(other)
+
+    def total(self):
+        """Number of values in the bins"""
+        return np.sum(self.counts)
+
+    def centres(self):
+        """Middle of each bin, in the units of the values"""
+        return (self.edges[1:]+self.edges[:-1])/2.
+
+    def log_centres(self):
+        """Middle of each bin in log10"""
+        ledges = np.log10(self.edges)
+        return (ledges[1:]+ledges[:-1])/2.
+
+    def density(self):
+        """
+        Normalise the histogram so it integrates to one over the bins, as np.histogram does with density=True.
+        Returns (centres, density).
+        """
+        (_, edges) = self._binned(self.edges)
+        return (self.centres(), self.counts/np.diff(edges).astype(float)/self.counts.sum())
+
+    def save(self, grp):
+        """Save to an HDF5 group"""
+        grp.attrs["log"] = self.log
+        grp.attrs["underflow"] = self.underflow
+        grp.attrs["overflow"] = self.overflow
+        grp.create_dataset("edges", data=self.edges)
+        grp.create_dataset("counts", data=self.counts)
+
+def load_histogram(grp):
+    """Load a StatHistogram saved to an HDF5 group by StatHistogram.save"""
+    hist = StatHistogram(np.array(grp["edges"]), bool(grp.attrs["log"]))
+    hist.counts = np.array(grp["counts"], dtype=np.int64)
+    hist.underflow = int(grp.attrs["underflow"])
+    hist.overflow = int(grp.attrs["overflow"])
+    return hist
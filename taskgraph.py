@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""A small task graph runner for the plotting scripts.
+
+Each task is a function call with a list of the tasks it depends on. Tasks are run as soon as their
+dependencies have finished. Tasks which compute statistics run in a process pool, so independent snapshots
+are processed at the same time. Tasks marked local, like figures, which share the global matplotlib state,
+run one at a time in this process, while the pool carries on with the rest.
+Adding a task which is already in the graph does nothing, so a statistic shared by several figures is only computed once.
+
+Usage:
+    graph = TaskGraph()
+    stats = graph.add(("stats", 7, 3), snapshot_stats, (7, 3))
+    graph.add("figure", plot_figure, (3,), deps=[stats], local=True)
+    graph.run()
+"""
+
+from __future__ import print_function
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+class Task(object):
+    """A function call in the graph, with the names of the tasks it depends on."""
+    def __init__(self, name, func, args, deps, local):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.deps = list(deps)
+        self.local = local
+
+def _run_task(task):
+    """Run a task in a pool process. Exceptions are returned as text, as they may not be picklable."""
+    start = time.time()
+    try:
+        return (task.name, True, task.func(*task.args), time.time() - start)
+    except Exception:
+        return (task.name, False, traceback.format_exc(), time.time() - start)
+
+def _result(name, future):
+    """
+    Get the result of a finished pool task as for _run_task, reporting errors outside the task itself,
+    such as a result which cannot be pickled, as a failure of the task.
+    Raises RuntimeError if a worker process died, as its task was lost.
+    """
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        raise RuntimeError("A worker process died, for example from running out of memory, so task "+str(name)+" could not finish")
+    except Exception as exc:
+        return (name, False, repr(exc), 0.)
+
+class TaskGraph(object):
+    """
+    Graph of tasks, run in dependency order. Tasks must be added after the tasks they depend on,
+    so the graph cannot have cycles.
+    """
+    def __init__(self):
+        self.tasks = OrderedDict()
+        #Results and run times of finished tasks
+        self.results = {}
+        self.times = {}
+
+    def add(self, name, func, args=(), deps=(), local=False):
+        """
+        Add a task to the graph, unless a task with this name is already in it.
+        name - unique, hashable name for the task.
+        func, args - the task calls func(*args). For tasks run in the pool, these must be picklable,
+                     so func should be a module-level function.
+        deps - names of the tasks which must finish before this one starts.
+        local - if True, run in this process rather than the pool.
+        Returns the name, for use in the deps of later tasks.
+        """
+        if name in self.tasks:
+            return name
+        for dep in deps:
+            if dep not in self.tasks:
+                raise KeyError("Task "+str(name)+" depends on unknown task "+str(dep))
+        self.tasks[name] = Task(name, func, args, deps, local)
+        return name
+
+    def _ready(self, task):
+        """Have all the dependencies of a task finished?"""
+        return all(dep in self.results for dep in task.deps)
+
+    def _finish(self, name, success, result, runtime):
+        """Record the result of a finished task."""
+        if not success:
+            raise RuntimeError("Task "+str(name)+" failed:\n"+result)
+        self.results[name] = result
+        self.times[name] = runtime
+
+    def run(self, nproc=None):
+        """
+        Run every task in the graph. Pool tasks are run in nproc processes (default one per core).
+        If a worker process dies, for example killed for running out of memory,
+        the tasks it was running would never finish, so this raises RuntimeError instead.
+        Returns a dictionary of the result of each task.
+        """
+        waiting = [task for task in self.tasks.values() if task.name not in self.results]
+        #Running pool tasks, with the name of each
+        running = {}
+        pool = ProcessPoolExecutor(nproc)
+        try:
+            while len(waiting) > 0 or len(running) > 0:
+                ready = [task for task in waiting if self._ready(task)]
+                #Start all the pool tasks we can first, so the pool is busy while local tasks run
+                for task in ready:
+                    if not task.local:
+                        running[pool.submit(_run_task, task)] = task.name
+                        waiting.remove(task)
+                local = [task for task in ready if task.local]
+                if len(local) > 0:
+                    task = local[0]
+                    waiting.remove(task)
+                    self._finish(*_run_task(task))
+                elif len(running) > 0:
+                    wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                #Collect all the finished pool tasks
+                for future in [future for future in running if future.done()]:
+                    self._finish(*_result(running.pop(future), future))
+        finally:
+            #Do not start any more tasks if one has failed
+            for future in running:
+                future.cancel()
+            pool.shutdown()
+        return self.results
+
+    def report(self):
+        """Print the run time of each task."""
+        for (name, runtime) in self.times.items():
+            print(str(name).ljust(40),"%10.2f s" % runtime)
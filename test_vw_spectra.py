@@ -0,0 +1,865 @@
+# -*- coding: utf-8 -*-
+"""Tests for vw_spectra and its helper modules, checking the vectorised routines against the loops they replaced."""
+
+import collections
+import numpy as np
+import h5py
+import pytest
+from fake_spectra import spec_utils
+import vw_spectra
+import haloindex
+import spectra_cache
+import gridspectra
+import stathist
+import ks2d
+
+Line = collections.namedtuple("Line", ["lambda_X", "fosc_X", "gamma_X"])
+
+def _synthetic_tau(nlos, nbins, seed):
+    """Optical depths made of several Gaussian components of random position, width and depth,
+    wrapping around the periodic box, including empty and fully saturated spectra."""
+    rng = np.random.RandomState(seed)
+    pix = np.arange(nbins)
+    tau = np.zeros((nlos, nbins))
+    for ii in range(nlos):
+        for _ in range(rng.randint(0, 6)):
+            dist = (pix - rng.uniform(0, nbins) + nbins/2.) % nbins - nbins/2.
+            tau[ii] += 10**rng.uniform(-2, 3)*np.exp(-dist**2/(2*rng.uniform(1, 40)**2))
+    tau[0] = 0
+    tau[1] = 1e4
+    return tau
+
+def _reference_absorber_width(spec, tau, minwidth, chunk):
+    """The per-spectrum loop find_absorber_width used before _absorber_windows."""
+    if spec.snr > 0:
+        thresh = - np.log(1-4./spec.snr)
+    else:
+        thresh = -np.log(1-0.15)
+    (offset, roll) = spec_utils.get_rolled_spectra(tau)
+    if 0 < minwidth < spec.nbins/2:
+        low  = int(spec.nbins/2-minwidth/spec.dvbin)*np.ones(spec.NumLos, dtype=int)
+        high = int(spec.nbins/2+minwidth/spec.dvbin)*np.ones(spec.NumLos, dtype=int)
+    else:
+        low = np.zeros(spec.NumLos, dtype=int)
+        high = spec.nbins*np.ones(spec.NumLos, dtype=int)
+    for ii in range(spec.NumLos):
+        #First expand the search area in case there is absorption at the edges.
+        for i in range(low[ii],0,-chunk):
+            if not np.any(roll[ii,i:(i+chunk)] > thresh):
+                low[ii] = i
+                break
+        #Where is there no absorption rightwards of the peak?
+        for i in range(high[ii],spec.nbins,chunk):
+            if not np.any(roll[ii,i:(i+chunk)] > thresh):
+                high[ii] = i+chunk
+                break
+        #Shrink to width which has some absorption
+        ind = np.where(roll[ii][low[ii]:high[ii]] > thresh)[0]
+        if np.size(ind) != 0:
+            oldlow = low[ii]
+            low[ii] = np.max((ind[0]+oldlow,0))
+            high[ii] = np.min((ind[-1]+oldlow+chunk,spec.nbins))
+    return (low, high, offset)
+
+def _make_spectra(tau, snr=0.):
+    """A VWSpectra with only what find_absorber_width needs, returning tau for its strongest line."""
+    spec = object.__new__(vw_spectra.VWSpectra)
+    (spec.NumLos, spec.nbins) = np.shape(tau)
+    spec.dvbin = 1.
+    spec.snr = snr
+    spec.spec_res = 8.
+    spec.minwidth = 500.
+    spec.absorber_width = {}
+    spec.lines = {("Si", 2): {1260: Line(1260.42, 1.18, 2.95e9), 1526: Line(1526.7, 0.133, 1.13e9)}}
+    spec.get_tau = lambda elem, ion, line: tau
+    return spec
+
+def test_absorber_width_matches_loop():
+    """find_absorber_width gives the same windows and offsets as the old loop."""
+    for seed in range(3):
+        tau = _synthetic_tau(60, 800, seed)
+        for snr in (0., 20.):
+            for minwidth in (0, 50., 250., 500.):
+                for chunk in (1, 7, 20, 64):
+                    spec = _make_spectra(tau, snr)
+                    result = spec.find_absorber_width("Si", 2, chunk=chunk, minwidth=minwidth)
+                    expected = _reference_absorber_width(spec, tau, minwidth, chunk)
+                    for (res, exp) in zip(result, expected):
+                        assert np.array_equal(res, exp), (seed, snr, minwidth, chunk)
+
+def _reference_vel_stats(tau, low, high, offset):
+    """The per-spectrum loops vel_width, vel_mean_median and vel_peak used before _vel_stat_kernel.
+    Returns the pixel indices (nnlow, nnhigh, median, vmax) of each spectrum, relative to low."""
+    points = np.zeros([4, np.shape(tau)[0]], dtype=int)
+    for ll in range(np.shape(tau)[0]):
+        tau_l = np.roll(tau[ll,:],offset[ll])[low[ll]:high[ll]]
+        cum_tau = np.cumsum(tau_l)
+        points[0, ll] = np.where(cum_tau - 0.05*cum_tau[-1] >= 0)[0][0]
+        points[1, ll] = np.where(cum_tau - 0.95*cum_tau[-1] >= 0)[0][0]
+        points[2, ll] = np.where(cum_tau - 0.5*cum_tau[-1] >= 0)[0][0]
+        points[3, ll] = np.where(tau_l == np.max(tau_l))[0][0]
+    return points
+
+def test_vel_stat_kernel_matches_loop():
+    """_vel_stat_kernel finds the same v90, f_mm and f_edg points as the old loops,
+    including empty spectra, single pixel windows and absorption which wraps around the box."""
+    nbins = 500
+    tau = _synthetic_tau(80, nbins, 4)
+    #Absorption straddling the edge of the box
+    tau[2] = 0
+    tau[2, :5] = 3.
+    tau[2, -7:] = 1.
+    #A single absorbing pixel
+    tau[3] = 0
+    tau[3, 17] = 2.
+    spec = _make_spectra(tau)
+    for chunk in (1, 20):
+        for minwidth in (0, 100.):
+            spec.absorber_width = {}
+            (low, high, offset) = spec.find_absorber_width("Si", 2, chunk=chunk, minwidth=minwidth)
+            #Single pixel windows and the full box
+            (low, high) = (np.array(low), np.array(high))
+            (low[4], high[4]) = (nbins//2, nbins//2+1)
+            (low[5], high[5]) = (0, nbins)
+            for block in (7, 1024):
+                points = vw_spectra._vel_stat_kernel(tau, low, high, offset, block=block)
+                assert np.array_equal(points, _reference_vel_stats(tau, low, high, offset)), (chunk, minwidth, block)
+
+def test_vel_stats_matches_loop():
+    """vel_stats gives the v90, f_mm and f_edg the old per-spectrum methods did."""
+    tau = _synthetic_tau(60, 400, 5)
+    spec = _make_spectra(tau)
+    spec.get_observer_tau = lambda elem, ion: tau
+    (low, high, offset) = spec.find_absorber_width("Si", 2)
+    (nnlow, nnhigh, median, vmax) = _reference_vel_stats(tau, low, high, offset)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        (vel_width, mean_median, peak) = spec.vel_stats("Si", 2)
+        vmean = (nnlow+nnhigh)/2.
+        assert np.array_equal(vel_width, spec.dvbin*(nnhigh-nnlow))
+        assert np.array_equal(mean_median, np.abs(vmean - median)/((nnhigh-nnlow)/2.), equal_nan=True)
+        assert np.array_equal(peak, np.abs(vmax - vmean)/((nnhigh-nnlow)/2.), equal_nan=True)
+
+def _reference_observer_lines(maxtaus):
+    """The line chosen for each spectrum by the old get_observer_tau, from the maximum (convolved)
+    optical depth of each line in each spectrum, maxtaus[line, spectrum]. Returns indices into the lines."""
+    chosen = np.zeros(np.shape(maxtaus)[1], dtype=int)
+    for ii in range(np.shape(maxtaus)[1]):
+        ind = np.where(np.logical_and(maxtaus[:,ii] < 3, maxtaus[:,ii] > 0.1))
+        if np.size(ind) > 0:
+            line = np.where(maxtaus[:,ii] == np.max(maxtaus[ind,ii]))
+        else:
+            ind2 = np.where(maxtaus[:,ii] > 0.1)
+            if np.size(ind2) > 0:
+                line = np.where(maxtaus[:,ii] == np.min(maxtaus[ind2,ii]))
+            else:
+                line = np.where(maxtaus[:,ii] == np.max(maxtaus[:,ii]))
+        chosen[ii] = line[0][0]
+    return chosen
+
+def test_observer_line_matches_old_selection():
+    """_choose_observer_tau picks the same line as the old selection over all lines at once,
+    including ties, spectra where every line is saturated and spectra where every line is too weak."""
+    (nlos, nbins) = (300, 200)
+    rng = np.random.RandomState(6)
+    pix = np.arange(nbins)
+    profile = np.exp(-(pix-nbins/2.)**2/(2*5.**2))
+    #Few distinct scales, so that lines often tie
+    scales = np.array([0.01, 0.05, 0.5, 1., 2., 5., 10., 100.])
+    lines = [1190, 1260, 1304, 1526]
+    factors = scales[rng.randint(0, np.size(scales), (len(lines), nlos))]
+    #Every line saturated, every line too weak, and every line the same
+    factors[:, 0] = [10., 100., 5., 10.]
+    factors[:, 1] = [0.01, 0.05, 0.01, 0.05]
+    factors[:, 2] = 1.
+    taus = [factors[ll][:, np.newaxis]*profile for ll in range(len(lines))]
+    spec = _make_spectra(taus[0])
+    spec.tau_obs = {}
+    maxtaus = np.array([np.max(spec_utils.res_corr(tau, spec.dvbin, spec.spec_res), axis=-1) for tau in taus])
+    chosen = _reference_observer_lines(maxtaus)
+    ntau = spec._choose_observer_tau("Si", 2, zip(lines, taus))
+    assert np.array_equal(spec.tau_obs_line[("Si", 2)], np.array(lines)[chosen])
+    assert np.array_equal(ntau, np.array([taus[chosen[ii]][ii] for ii in range(nlos)]))
+    assert ntau is spec.tau_obs[("Si", 2)]
+
+def _make_saveable(tau, savefile, seed=7):
+    """A spectra object which can be saved to and loaded from savefile.
+    The optical depth in each line is tau scaled by a factor depending on the line, so lines differ in strength."""
+    spec = _make_spectra(tau)
+    #Compute the optical depths as usual
+    del spec.get_tau
+    spec.savefile = str(savefile)
+    for name in ("tau_obs", "tau", "colden", "velocity", "temp", "num_important"):
+        setattr(spec, name, {})
+    spec.cofm = np.random.RandomState(seed).uniform(0, 25000., (spec.NumLos, 3))
+    spec.axis = np.ones(spec.NumLos, dtype=np.int32)
+    (spec.red, spec.hubble, spec.box, spec.OmegaM, spec.omegab, spec.OmegaLambda) = (3., 0.7, 25000., 0.27, 0.045, 0.73)
+    spec.discarded = 0
+    spec.npart = np.zeros(6)
+    spec.part_ind = {}
+    spec.cofm_final = False
+    def compute_spectra(elem, ion, ll, get_tau):
+        """Optical depth in a line, or a column density for get_tau False"""
+        if not get_tau:
+            return tau*1e14
+        line = spec.lines[(elem, ion)][ll]
+        return tau*line.fosc_X*line.lambda_X/1000.
+    spec.compute_spectra = compute_spectra
+    return spec
+
+def _reloaded(spec):
+    """A fresh copy of spec, loaded from its save file."""
+    new = _make_spectra(np.zeros((1, spec.nbins)))
+    del new.get_tau
+    new.savefile = spec.savefile
+    new._reload()
+    new.compute_spectra = spec.compute_spectra
+    return new
+
+def test_observer_line_saved(tmp_path):
+    """The line chosen for each observer tau spectrum is the line whose optical depth it holds,
+    and is saved and loaded with the spectra."""
+    tau = _synthetic_tau(50, 300, 8)
+    spec = _make_saveable(tau, tmp_path / "spectra.hdf5")
+    spec.get_observer_tau("Si", 2)
+    chosen = spec.tau_obs_line[("Si", 2)]
+    assert set(chosen) == set(spec.lines[("Si", 2)].keys())
+    for ii in range(spec.NumLos):
+        assert np.array_equal(spec.tau_obs[("Si", 2)][ii], spec.compute_spectra("Si", 2, chosen[ii], True)[ii])
+    spec.save_file()
+    new = _reloaded(spec)
+    assert np.array_equal(new.tau_obs_line[("Si", 2)], chosen)
+    assert np.array_equal(new.get_observer_tau("Si", 2, noise=False), spec.get_observer_tau("Si", 2, noise=False))
+
+def test_observer_tau_caches(tmp_path):
+    """The convolved and noisy observer tau are cached per resolution and signal to noise,
+    and recomputed when the observer tau is"""
+    tau = _synthetic_tau(30, 300, 12)
+    spec = _make_saveable(tau, tmp_path / "spectra.hdf5")
+    spec.snr = 20.
+    noisy = np.array(spec.get_observer_tau("Si", 2))
+    smooth = np.array(spec.get_observer_tau("Si", 2, noise=False))
+    assert np.array_equal(smooth, spec._res_corr(spec.tau_obs[("Si", 2)]))
+    for ii in (0, 5, 29):
+        assert np.array_equal(noisy[ii], spec.add_noise(spec.snr, np.array(smooth[ii]), ii))
+        assert np.array_equal(spec.get_observer_tau("Si", 2, number=ii), noisy[ii])
+    assert spec.get_observer_tau("Si", 2) is spec.get_observer_tau("Si", 2)
+    spec.snr = 10.
+    assert not np.array_equal(spec.get_observer_tau("Si", 2), noisy)
+    spec.spec_res = 20.
+    assert np.array_equal(spec.get_observer_tau("Si", 2, noise=False), spec._res_corr(spec.tau_obs[("Si", 2)]))
+    spec.snr = 20.
+    spec.spec_res = 8.
+    assert np.array_equal(spec.get_observer_tau("Si", 2), noisy)
+    #Recomputing the observer tau discards the cached spectra made from the old one
+    compute_spectra = spec.compute_spectra
+    spec.compute_spectra = lambda elem, ion, ll, get_tau: 2*compute_spectra(elem, ion, ll, get_tau)
+    spec.get_observer_tau("Si", 2, force_recompute=True)
+    smooth = spec._res_corr(spec.tau_obs[("Si", 2)])
+    assert np.array_equal(spec.get_observer_tau("Si", 2, noise=False), smooth)
+    assert np.array_equal(spec.get_observer_tau("Si", 2)[3], spec.add_noise(spec.snr, np.array(smooth[3]), 3))
+
+def _reference_bootstrap_sample(vel_data, v_table, index, noise):
+    """One sample of the differential distribution, as in the old _bootstrap_sample, from given draws"""
+    bootstrap = vel_data[index]
+    bootstrap += noise
+    return np.histogram(bootstrap, v_table)[0]
+
+def _reference_errors(cdfs, v_table, samples, cumulative, lognorm):
+    """The 68% contour from the samples, as in the old _plot_errors"""
+    if cumulative:
+        cdfs = np.cumsum(cdfs, axis=1)
+        norm = 1
+    else:
+        if lognorm:
+            v_table = np.log10(v_table)
+        norm = samples * np.array([(-v_table[i]+v_table[i+1]) for i in range(np.size(v_table)-1)])
+    return (np.percentile(cdfs, 16, axis=0)/norm, np.percentile(cdfs, 84, axis=0)/norm)
+
+def test_bootstrap_matches_samples():
+    """Bootstrap histograms are the histograms of the old per-sample loop, given the same draws,
+    and are reproducible for a given seed"""
+    rng = np.random.RandomState(13)
+    #Integer values, so some fall exactly on the bin edges, and some outside them
+    vel_data = rng.randint(0, 120, size=500).astype(np.float64)
+    v_table = np.array([10., 20., 40., 60., 100.])
+    (nboot, samples) = (300, 50)
+    for error in (0., 5.):
+        draws = np.random.default_rng(23)
+        index = draws.integers(0, np.size(vel_data), size=(nboot, samples))
+        noise = np.zeros((nboot, samples))
+        if error > 0:
+            noise = draws.normal(0, error, size=(nboot, samples))
+        ref = np.array([_reference_bootstrap_sample(vel_data, v_table, index[ii], noise[ii]) for ii in range(nboot)])
+        hists = vw_spectra.bootstrap_histograms(vel_data, v_table, samples, error, nboot=nboot, seed=23)
+        assert np.array_equal(hists, ref)
+        #Small blocks use different draws, but the same number of samples
+        blocked = vw_spectra.bootstrap_histograms(vel_data, v_table, samples, error, nboot=nboot, seed=23, block=samples*7)
+        assert np.shape(blocked) == (nboot, np.size(v_table)-1)
+        assert np.all(np.sum(blocked, axis=1) <= samples)
+        for (cumulative, lognorm) in ((False, True), (False, False), (True, True)):
+            (vbin, lower, upper) = vw_spectra.bootstrap_errors(vel_data, v_table, samples, error, cumulative, lognorm, nboot=nboot)
+            (ref_lower, ref_upper) = _reference_errors(ref, v_table, samples, cumulative, lognorm)
+            assert np.allclose(vbin, (v_table[1:]+v_table[:-1])/2.)
+            assert np.array_equal(lower, ref_lower)
+            assert np.array_equal(upper, ref_upper)
+    assert not np.array_equal(vw_spectra.bootstrap_histograms(vel_data, v_table, samples, 5., nboot=nboot, seed=24), hists)
+
+def _reference_combine_regions(condition, mindist):
+    """Contiguous True regions of a single row, combining those closer than mindist, as in the old combine_regions loop"""
+    idx = np.nonzero(np.diff(condition))[0] + 1
+    if condition[0]:
+        idx = np.r_[0, idx]
+    if condition[-1]:
+        idx = np.r_[idx, condition.size]
+    reg = np.reshape(idx, (-1, 2))
+    if mindist > 0 and np.shape(reg)[0] > 1:
+        newreg = [list(reg[0,:])]
+        for ii in range(1, np.shape(reg)[0]):
+            if reg[ii,0] - newreg[-1][1] < mindist:
+                newreg[-1][1] = reg[ii,1]
+            else:
+                newreg.append(list(reg[ii,:]))
+        reg = np.array(newreg)
+    return reg
+
+def test_separated_regions_matches_loop():
+    """Regions found for all spectra at once are those of the old per-spectrum loop"""
+    rng = np.random.RandomState(19)
+    #Runs of varying length, so gaps between regions are both short and long
+    condition = np.repeat(rng.uniform(size=(40, 60)) > 0.6, rng.randint(1, 4, size=60), axis=1)
+    condition[0] = False
+    condition[1] = True
+    condition[2, [0, -1]] = True
+    for mindist in (0, 1, 3, 10):
+        (row, low, high) = vw_spectra._separated_regions(condition, mindist)
+        for ii in range(np.shape(condition)[0]):
+            ref = _reference_combine_regions(condition[ii], mindist)
+            ours = np.where(row == ii)
+            assert np.array_equal(low[ours], ref[:,0])
+            assert np.array_equal(high[ours], ref[:,1])
+        assert np.all(np.diff(row) >= 0)
+    assert np.size(vw_spectra._separated_regions(np.zeros((3, 5), dtype=bool), 2)[0]) == 0
+
+def _observable(spec):
+    """Filter on the observer tau, so it can be computed without particle densities"""
+    return lambda elem, ion, thresh: np.max(spec.get_observer_tau(elem, ion), axis=1) > thresh
+
+def test_derived_stats_saved(tmp_path):
+    """Absorber windows, velocity statistics and filters are saved with the spectra and loaded back unchanged"""
+    tau = _synthetic_tau(50, 300, 9)
+    spec = _make_saveable(tau, tmp_path / "spectra.hdf5")
+    spec._filter_mask = _observable(spec)
+    stats = spec.vel_stats("Si", 2)
+    mask = spec.get_filt_mask("Si", 2, 1.)
+    spec.save_file()
+    new = _reloaded(spec)
+    key = ("Si", 2, spec.minwidth, spec.snr, spec.spec_res)
+    assert key in new.vel_statistics
+    for (loaded, saved) in zip(new.vel_stats("Si", 2), stats):
+        assert np.array_equal(loaded, saved, equal_nan=True)
+    assert set(new.absorber_width.keys()) == set(spec.absorber_width.keys())
+    for kk in spec.absorber_width:
+        for (loaded, saved) in zip(new.absorber_width[kk], spec.absorber_width[kk]):
+            assert np.array_equal(loaded, saved, equal_nan=True)
+    assert np.array_equal(new.filt_ind[spec.filt_label][("Si", 2, 1., spec.snr, spec.spec_res)][0], mask)
+    assert np.array_equal(new.get_filt("Si", 2, 1.), np.where(mask))
+
+def test_save_stats_merges(tmp_path):
+    """save_stats from objects sharing a save file keeps the statistics of both,
+    replaces a histogram saved again, and discards statistics from another version of the layout"""
+    tau = _synthetic_tau(50, 300, 10)
+    first = _make_saveable(tau, tmp_path / "spectra.hdf5")
+    first.save_file()
+    second = _reloaded(first)
+    first.vel_stats("Si", 2)
+    first.stat_histogram("Si", 2, first.vel_width, np.logspace(0, 3, 11), filt=False)
+    first.save_stats()
+    second.stat_histogram("Si", 2, second.vel_width, np.logspace(0, 3, 21), filt=False)
+    second.save_stats()
+    #Saving the same histogram again replaces it
+    first.save_stats()
+    new = _reloaded(first)
+    assert set(new.vel_statistics.keys()) == set(first.vel_statistics.keys())
+    assert set(new.stat_hists.keys()) == set(first.stat_hists.keys()) | set(second.stat_hists.keys())
+    assert len(new.stat_hists) == 2
+    for (key, hist) in list(first.stat_hists.items()) + list(second.stat_hists.items()):
+        assert np.array_equal(new.stat_hists[key].counts, hist.counts)
+    f = h5py.File(first.savefile, 'r+')
+    assert len(f["derived"]["stat_hist"]) == 2
+    f["derived"].attrs["version"] = vw_spectra.DERIVED_VERSION - 1
+    f.close()
+    old = _reloaded(first)
+    assert len(old._cache("vel_statistics")) == 0 and len(old._cache("stat_hists")) == 0
+    old.save_stats()
+    f = h5py.File(first.savefile, 'r')
+    assert f["derived"].attrs["version"] == vw_spectra.DERIVED_VERSION
+    assert len(f["derived"]["stat_hist"]) == 0 and len(f["derived"]["vel_stats"]) == 0
+    f.close()
+
+def test_filters_cached_per_label(tmp_path):
+    """Filters are cached separately for each filt_label and each (thresh, snr, spec_res), and saved for every label"""
+    tau = _synthetic_tau(50, 300, 14)
+    spec = _make_saveable(tau, tmp_path / "spectra.hdf5")
+    calls = collections.Counter()
+    def filter_mask(elem, ion, thresh):
+        """Count the filters computed, for a filter which depends on the label"""
+        calls[(spec.filt_label, thresh, spec.snr)] += 1
+        maxtau = np.max(spec.get_observer_tau(elem, ion, noise=False), axis=1)
+        if spec.filt_label == "strong":
+            return maxtau > 10*thresh
+        return maxtau > thresh
+    spec._filter_mask = filter_mask
+    density = spec.get_filt_mask("Si", 2, 1.)
+    spec.filt_label = "strong"
+    strong = spec.get_filt_mask("Si", 2, 1.)
+    assert np.sum(strong) < np.sum(density)
+    spec.filt_label = "density"
+    assert spec.get_filt_mask("Si", 2, 1.) is density
+    assert np.array_equal(spec.get_filt("Si", 2, 1.), np.where(density))
+    spec.get_filt_mask("Si", 2, 2.)
+    spec.snr = 20.
+    spec.get_filt_mask("Si", 2, 1.)
+    assert calls == collections.Counter({("density", 1., 0.): 1, ("strong", 1., 0.): 1, ("density", 2., 0.): 1, ("density", 1., 20.): 1})
+    spec.snr = 0.
+    spec.save_file()
+    new = _reloaded(spec)
+    new._filter_mask = filter_mask
+    assert np.array_equal(new.get_filt_mask("Si", 2, 1.), density)
+    new.filt_label = "strong"
+    assert np.array_equal(new.get_filt_mask("Si", 2, 1.), strong)
+    assert sum(calls.values()) == 4
+
+def test_append_sightlines(tmp_path):
+    """Appending sightlines to a save file gives the same arrays as computing all the sightlines at once"""
+    (tau1, tau2) = (_synthetic_tau(30, 300, 15), _synthetic_tau(20, 300, 16))
+    spec = _make_saveable(tau1, tmp_path / "spectra.hdf5", seed=1)
+    spec.get_observer_tau("Si", 2)
+    spec.get_tau("Si", 2, 1526)
+    spec.vel_stats("Si", 2)
+    spec.discarded = 3
+    spec.save_file()
+    more = _make_saveable(tau2, tmp_path / "spectra.hdf5", seed=2)
+    more.discarded = 4
+    more.append_sightlines()
+    whole = _make_saveable(np.concatenate([tau1, tau2]), tmp_path / "whole.hdf5")
+    whole.get_observer_tau("Si", 2)
+    assert more.NumLos == 50
+    assert np.array_equal(more.cofm[:30], spec.cofm)
+    assert np.array_equal(more.cofm[30:], _make_saveable(tau2, tmp_path / "unused.hdf5", seed=2).cofm)
+    assert np.array_equal(more.axis, np.ones(50))
+    assert more.discarded == 7
+    assert np.array_equal(more.tau_obs_line[("Si", 2)], whole.tau_obs_line[("Si", 2)])
+    more._really_load_array(("Si", 2), more.tau_obs, "tau_obs")
+    assert np.array_equal(more.tau_obs[("Si", 2)], whole.tau_obs[("Si", 2)])
+    more._really_load_array(("Si", 2, 1526), more.tau, "tau")
+    assert np.array_equal(more.tau[("Si", 2, 1526)], whole.compute_spectra("Si", 2, 1526, True))
+    #The derived statistics only covered the old sightlines
+    assert len(more._cache("vel_statistics")) == 0
+    #The file can be appended to again
+    third = _make_saveable(tau2[:5], tmp_path / "spectra.hdf5", seed=3)
+    third.append_sightlines()
+    third._really_load_array(("Si", 2), third.tau_obs, "tau_obs")
+    assert third.NumLos == 55 and np.shape(third.tau_obs[("Si", 2)]) == (55, 300)
+
+def test_append_refused(tmp_path):
+    """append_sightlines refuses, leaving the file alone, if it holds arrays it cannot extend"""
+    tau = _synthetic_tau(30, 300, 17)
+    spec = _make_saveable(tau, tmp_path / "spectra.hdf5")
+    spec.get_observer_tau("Si", 2)
+    spec.save_file()
+    f = h5py.File(spec.savefile, 'r+')
+    f.require_group("num_important").create_group("Si").create_dataset("2", data=np.zeros(30))
+    f.close()
+    more = _make_saveable(tau[:10], tmp_path / "spectra.hdf5", seed=2)
+    with pytest.raises(ValueError):
+        more.append_sightlines()
+    f = h5py.File(spec.savefile, 'r')
+    assert np.shape(f["spectra"]["cofm"]) == (30, 3)
+    assert np.shape(f["tau_obs"]["Si"]["2"]) == (30, 300)
+    f.close()
+
+class _Segments(object):
+    """Stand in for the snapshot set, with a number of segments."""
+    def __init__(self, nsegments):
+        self.nsegments = nsegments
+    def get_n_segments(self):
+        """Number of files in the snapshot"""
+        return self.nsegments
+
+def _make_particle_spectra(nsegments, nlos=20, nbins=48, npart=40):
+    """
+    A spectra object whose particles are synthetic, so that compute_spectra and friends run as usual:
+    _read_particle_data gives random particles for each segment and ion, none for SiII in segment 1,
+    and _do_interpolation_work is a fixed random linear map of the particle density, non-linear in the line.
+    Counts the particle reads in spec.reads.
+    """
+    spec = _make_spectra(np.zeros((nlos, nbins)))
+    #Compute the optical depths as usual
+    del spec.get_tau
+    for name in ("tau_obs", "tau", "colden", "velocity", "temp", "num_important"):
+        setattr(spec, name, {})
+    spec.lines[("Si", 2)] = collections.OrderedDict([(1190, Line(1190.4, 0.277, 6.5e8)), (1260, Line(1260.42, 1.18, 2.95e9)),
+                                                     (1304, Line(1304.37, 0.0863, 1.1e9)), (1526, Line(1526.7, 0.133, 1.13e9))])
+    spec.lines[("H", 1)] = {1215: Line(1215.67, 0.4164, 6.265e8)}
+    spec.cofm = np.zeros((nlos, 3))
+    spec.axis = np.ones(nlos, dtype=np.int32)
+    (spec.velfac, spec.rscale, spec.atime) = (1.5, 3., 0.25)
+    spec.part_ind = {}
+    spec.cofm_final = False
+    spec.snapshot_set = _Segments(nsegments)
+    spec.reads = collections.Counter()
+    def read_particle_data(fn, elem, ion, get_tau):
+        """Random particles for each segment and ion"""
+        spec.reads[(elem, ion)] += 1
+        if (fn, elem) == (1, "Si"):
+            return (False,)*6
+        rng = np.random.RandomState(100*fn+10*ion+len(elem))
+        pos = rng.rand(npart, 3).astype(np.float32)
+        vel = (100*rng.randn(npart, 3)).astype(np.float32)
+        elem_den = rng.rand(npart).astype(np.float32)
+        if not get_tau:
+            vel = np.zeros(1, dtype=np.float32)
+        return (pos, vel, elem_den, rng.rand(npart).astype(np.float32), rng.rand(npart).astype(np.float32), 28.)
+    spec._read_particle_data = read_particle_data
+    rng = np.random.RandomState(9)
+    #Spectra of very different strengths, so that different lines are chosen for the observer tau
+    weights = rng.rand(nlos, nbins, npart)*10**rng.uniform(-2.5, 1.5, (nlos, 1, 1))
+    def do_interpolation_work(pos, vel, elem_den, temp, hh, amumass, line, get_tau):
+        """A linear map of the density, raised to a power depending on the line for optical depths"""
+        out = np.einsum("lbn,n->lb", weights, elem_den*pos[:,0])
+        if get_tau:
+            out = (out*line.fosc_X*line.lambda_X*1e-3)**(1+0.1*np.sin(line.lambda_X))
+        return out.astype(np.float32)
+    spec._do_interpolation_work = do_interpolation_work
+    return spec
+
+def test_compute_batch_matches_single_arrays():
+    """compute_batch gives the same arrays as the separate calls it replaces, reading each segment once per ion
+    when the observer lines are also requested, or when there is a single segment."""
+    requests = [("Si", 2, vw_spectra.OBSERVER_TAU), ("Si", 2, 1260), ("Si", 2, 1526), ("H", 1, 1215),
+                ("H", 1, vw_spectra.COLDEN), ("Si", 2, vw_spectra.COLDEN), ("H", 1, vw_spectra.VELOCITY)]
+    for nsegments in (1, 3):
+        batch = _make_particle_spectra(nsegments)
+        batch.compute_batch(requests)
+        single = _make_particle_spectra(nsegments)
+        single.get_observer_tau("Si", 2)
+        for (elem, ion, line) in requests[1:4]:
+            single.get_tau(elem, ion, line)
+        single.get_density("H", 1)
+        single.get_density("Si", 2)
+        single.get_velocity("H", 1)
+        assert np.size(np.unique(batch.tau_obs_line[("Si", 2)])) > 1
+        for name in ("tau_obs", "tau", "colden", "velocity", "tau_obs_line"):
+            (bb, ss) = (getattr(batch, name), getattr(single, name))
+            assert set(bb.keys()) == set(ss.keys()), name
+            for key in bb:
+                assert np.allclose(bb[key], ss[key], rtol=1e-5), (nsegments, name, key)
+        assert batch.part_ind == {} and not batch.cofm_final
+        if nsegments == 1:
+            assert batch.reads == {("Si", 2): 1, ("H", 1): 1}
+        else:
+            #The two observer lines not also requested need a further pass each
+            assert batch.reads == {("Si", 2): 3*nsegments, ("H", 1): nsegments}
+        #Arrays already computed are not computed again, unless asked
+        batch.reads.clear()
+        batch.compute_batch(requests)
+        assert sum(batch.reads.values()) == 0
+        batch.compute_batch([("H", 1, 1215)], force_recompute=True)
+        assert batch.reads == {("H", 1): nsegments}
+
+def test_lazy_tau_matches_full(tmp_path):
+    """A single spectrum read lazily from the save file is convolved as the same row of the full array is,
+    with the same convolution as the observer tau."""
+    tau = _synthetic_tau(30, 256, 10)
+    spec = _make_saveable(tau, tmp_path / "spectra.hdf5")
+    spec.get_tau("Si", 2, 1260)
+    spec.get_observer_tau("Si", 2)
+    spec.save_file()
+    for fft in (False, True):
+        (lazy, full) = (_reloaded(spec), _reloaded(spec))
+        for new in (lazy, full):
+            new.lazy_arrays = True
+            new.fft_res_corr = fft
+        full_tau = full.get_tau("Si", 2, 1260, noise=False)
+        full_obs = full.get_observer_tau("Si", 2, noise=False)
+        #Optical depths in a line are convolved as the observer tau is
+        assert np.array_equal(full_tau, full._res_corr(spec.compute_spectra("Si", 2, 1260, True)))
+        for number in (0, 17):
+            assert np.array_equal(lazy.get_tau("Si", 2, 1260, number, noise=False), full_tau[number])
+            assert np.array_equal(lazy.get_observer_tau("Si", 2, number, noise=False), full_obs[number])
+        #Only single spectra were read
+        assert np.size(lazy.tau[("Si", 2, 1260)]) == 1
+
+def _brute_force_containing(pos, cofm, radii, box):
+    """Lowest index halo strictly within its radius of each position, using the nearest periodic image"""
+    found = -np.ones(np.shape(pos)[0], dtype=np.int64)
+    for ii in range(np.shape(pos)[0]):
+        diff = np.abs(np.mod(pos[ii] - cofm, box))
+        diff = np.minimum(diff, box - diff)
+        inside = np.where(np.logical_and(np.sum(diff**2, axis=1) < radii**2, radii > 0))[0]
+        if np.size(inside) > 0:
+            found[ii] = inside[0]
+    return found
+
+def test_halo_index_matches_brute_force():
+    """HaloIndex finds the same halos as a search over every halo, including across the box edges"""
+    rng = np.random.RandomState(17)
+    box = 100.
+    cofm = rng.uniform(0, box, size=(200, 3))
+    radii = rng.uniform(0, 8, size=200)
+    radii[::10] = 0
+    #Positions near halos, near the box edges and outside the box
+    pos = np.concatenate([cofm[rng.randint(0, 200, 500)] + rng.normal(0, 4, size=(500, 3)),
+                          rng.uniform(-10, 10, size=(300, 3)), rng.uniform(-box, 2*box, size=(300, 3))])
+    #Exactly on the radius, which is outside, and just inside across the edge
+    cofm[0] = (10., 10., 10.)
+    radii[0] = 5.
+    cofm[1] = (1., 50., 50.)
+    radii[1] = 3.
+    #In two halos, where the lower index is used
+    cofm[2:4] = (50., 50., 50.)
+    radii[2:4] = (2., 4.)
+    pos[:3] = ((15., 10., 10.), (99., 50., 50.), (50., 50., 51.))
+    ref = _brute_force_containing(pos, cofm, radii, box)
+    for chunk in (2**20, 37):
+        found = haloindex.HaloIndex(cofm, radii, box, chunk=chunk).containing(pos)
+        assert np.array_equal(found, ref)
+    assert ref[0] != 0 and ref[1] == 1 and ref[2] == 2
+    assert np.sum(ref >= 0) > 100
+    assert np.array_equal(haloindex.HaloIndex(cofm, np.zeros(200), box).containing(pos), -np.ones(np.shape(pos)[0]))
+    assert np.size(haloindex.HaloIndex(cofm, radii, box).containing(np.zeros((0, 3)))) == 0
+
+def _reference_assign_to_halo(cofm, axis, zpos, halo_radii, halo_cofm):
+    """The halo containing each absorber, as in the old HaloAssignedSpectra.assign_to_halo"""
+    halos = []
+    for ii in range(len(zpos)):
+        proj_pos = np.array(cofm[ii,:])
+        ax = axis[ii]-1
+        halos.append([])
+        for zzp in zpos[ii]:
+            proj_pos[ax] = zzp
+            dd = np.sum((halo_cofm - proj_pos)**2,axis=1)
+            ind = np.where(dd < halo_radii**2)
+            if np.size(ind) >= 1:
+                halos[ii].append(ind[0][0])
+    return halos
+
+def test_halo_association_matches_lists():
+    """The association as lists is the same as the old per-sightline lists of halos and subhalos"""
+    rng = np.random.RandomState(11)
+    box = 100.
+    nlos = 60
+    #Keep everything away from the box edge, as the old loop was not periodic
+    cofm = rng.uniform(20, 80, size=(nlos, 3))
+    axis = rng.randint(1, 4, size=nlos)
+    zpos = [list(rng.uniform(20, 80, size=rng.randint(0, 6))) for _ in range(nlos)]
+    #Absorbers on the sightlines of the first few halo centres, so that some are in several halos
+    halo_cofm = np.concatenate([cofm[:10], rng.uniform(20, 80, size=(30, 3))])
+    halo_radii = rng.uniform(0, 15, size=40)
+    halo_radii[5] = 0
+    sub_cofm = halo_cofm[:20] + rng.normal(0, 3, size=(20, 3))
+    sub_radii = rng.uniform(0, 6, size=20)
+    sub_parent = np.arange(20)
+    rows = np.repeat(np.arange(nlos), [len(zz) for zz in zpos])
+    pos = np.array(cofm[rows,:])
+    pos[np.arange(np.size(rows)), axis[rows]-1] = np.array([zz for zzs in zpos for zz in zzs])
+    assoc = haloindex.associate(rows, pos, haloindex.HaloIndex(halo_cofm, halo_radii, box),
+                                haloindex.HaloIndex(sub_cofm, sub_radii, box), sub_parent, halo_radii, nlos)
+    halos = assoc.to_lists(assoc.halo_offsets, assoc.halos)
+    subhalos = assoc.to_lists(assoc.subhalo_offsets, assoc.subhalos)
+    ref_halos = _reference_assign_to_halo(cofm, axis, zpos, halo_radii, halo_cofm)
+    ref_subhalos = _reference_assign_to_halo(cofm, axis, zpos, sub_radii, sub_cofm)
+    assert len(halos) == nlos and len(subhalos) == nlos
+    for ii in range(nlos):
+        assert halos[ii] == sorted(set(ref_halos[ii]))
+        assert subhalos[ii] == sorted(set(ref_subhalos[ii]))
+    assert np.max([len(hh) for hh in halos]) > 1
+    assert np.sum([len(hh) for hh in subhalos]) > 0
+
+class _Held(object):
+    """An object holding arrays, directly and in containers"""
+    def __init__(self, nbytes):
+        self.direct = np.zeros(nbytes//16)
+        self.nested = {"a": [np.zeros(nbytes//16)], "b": self.direct}
+
+def test_spectra_cache_eviction():
+    """The cache drops the least recently used objects to stay in its budget, but never the one just used"""
+    assert spectra_cache._nbytes(_Held(1024)) == 1024
+    cache = spectra_cache.SpectraCache(budget=3072)
+    loads = collections.Counter()
+    def loader(key, nbytes=1024):
+        """Make an object, counting the loads"""
+        def load():
+            """Make the object"""
+            loads[key] += 1
+            return _Held(nbytes)
+        return load
+    objs = dict((key, cache.get(key, loader(key))) for key in "abc")
+    assert list(cache.cache.keys()) == list("abc") and cache.evictions == 0
+    assert cache.get("a", loader("a")) is objs["a"]
+    cache.get("d", loader("d"))
+    #b was used least recently
+    assert list(cache.cache.keys()) == list("cad")
+    assert cache.nbytes() == 3072
+    #Objects are measured again on each access, as they grow
+    objs["c"].grown = np.zeros(2048//8)
+    cache.get("a", loader("a"))
+    assert list(cache.cache.keys()) == list("da")
+    cache.get("big", loader("big", 10240))
+    assert list(cache.cache.keys()) == ["big"]
+    cache.get("b", loader("b"))
+    assert list(cache.cache.keys()) == ["b"]
+    assert loads == collections.Counter({"a": 1, "b": 2, "c": 1, "d": 1, "big": 1})
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 6, 5)
+    cache.clear()
+    assert len(cache.cache) == 0
+
+def _make_gridfile(gridfile, seed=21):
+    """A grid file with lists of DLA and LLS cells"""
+    rng = np.random.RandomState(seed)
+    f = h5py.File(gridfile, 'w')
+    f.create_group("HaloData").create_dataset("ngrid", data=np.array([64]))
+    grp = f.create_group("abslists")
+    for (name, nn, low, high) in (("DLA", 700, 20.3, 22.5), ("LLS", 500, 17., 20.3)):
+        grp.create_dataset(name, data=rng.randint(0, 64, size=(3, nn)))
+        grp.create_dataset(name+"_val", data=rng.uniform(low, high, size=nn))
+    f.close()
+
+def test_grid_sampler_stratified(tmp_path):
+    """Stratified samples have equal numbers of cells from each bin which is not empty,
+    and depend only on the seed, not on the chunks the grid file is read in"""
+    gridfile = str(tmp_path / "grid.hdf5")
+    _make_gridfile(gridfile)
+    f = h5py.File(gridfile, 'r')
+    allcells = np.concatenate([np.array(f["abslists"]["DLA"]), np.array(f["abslists"]["LLS"])], axis=1)
+    allvals = np.concatenate([np.array(f["abslists"]["DLA_val"]), np.array(f["abslists"]["LLS_val"])])
+    f.close()
+    #The bins below and above all the cells are empty
+    strata = np.array([10., 15., 18., 19., 20.3, 21., 25., 30.])
+    nstrata = np.size(strata)-1
+    index = gridspectra.GridSampler(gridfile, seed=5).sample(301, strata)
+    assert np.array_equal(index, gridspectra.GridSampler(gridfile, seed=5, chunk=97).sample(301, strata))
+    assert not np.array_equal(index, gridspectra.GridSampler(gridfile, seed=6).sample(301, strata))
+    sampler = gridspectra.GridSampler(gridfile, seed=5)
+    assert len(sampler) == np.size(allvals)
+    assert np.array_equal(sampler.values(index), allvals[index])
+    assert np.array_equal(sampler.cells(index), allcells[:, index])
+    counts = np.bincount(np.clip(np.digitize(allvals[index], strata)-1, 0, nstrata-1), minlength=nstrata)
+    assert counts[0] == 0 and counts[-1] == 0
+    assert np.all(counts[1:-1] >= 301 // 5) and np.all(counts[1:-1] <= 301 // 5 + 1)
+    #Plain samples are reproducible too
+    assert np.array_equal(sampler.sample(50), gridspectra.GridSampler(gridfile, seed=5).sample(50))
+
+def test_stat_histogram_merge(tmp_path):
+    """Histograms of chunks of values, merged or saved and loaded, are the histogram of all the values"""
+    rng = np.random.RandomState(23)
+    values = np.concatenate([10**rng.uniform(0.5, 3.5, size=1000), [10., 1000., 0.]])
+    edges = np.logspace(1, 3, 9)
+    for log in (True, False):
+        whole = stathist.StatHistogram(edges, log).update(values)
+        chunks = [stathist.StatHistogram(edges, log).update(chunk) for chunk in np.array_split(values, 7)]
+        merged = stathist.StatHistogram(edges, log)
+        for chunk in chunks:
+            merged.merge(chunk)
+        added = chunks[0]
+        for chunk in chunks[1:]:
+            added = added + chunk
+        f = h5py.File(str(tmp_path / "hist.hdf5"), 'w')
+        merged.save(f.create_group("hist"))
+        loaded = stathist.load_histogram(f["hist"])
+        f.close()
+        for hist in (merged, added, loaded):
+            assert np.array_equal(hist.counts, whole.counts)
+            assert (hist.underflow, hist.overflow, hist.log) == (whole.underflow, whole.overflow, log)
+        assert whole.total() + whole.underflow + whole.overflow == np.size(values)
+    #The edges are the same as np.histogram, including the last
+    assert np.array_equal(whole.counts, np.histogram(values, edges)[0])
+    (_, density) = stathist.StatHistogram(edges, True).update(values).density()
+    assert np.allclose(density, np.histogram(np.log10(values[values > 0]), np.log10(edges), density=True)[0])
+    with pytest.raises(ValueError):
+        whole.merge(stathist.StatHistogram(edges, True))
+
+def _true_colden(cells):
+    """Log column density along a sightline through a grid cell"""
+    return 17. + 5.5*(cells[1]*64+cells[2])/4095.
+
+def _make_grid_spectra(gridfile, margin, seed=3):
+    """GridSpectra drawing cells from gridfile, whose column densities are those of _true_colden"""
+    spec = object.__new__(gridspectra.GridSpectra)
+    spec.sampler = gridspectra.GridSampler(gridfile, seed=seed)
+    spec.celsz = 25000./64
+    (spec.strata, spec.margin, spec.oversample) = (None, margin, 1.5)
+    spec.colden = {}
+    spec.computed = []
+    def compute_spectra(elem, ion, ll, get_tau):
+        """Column density spread evenly over each spectrum"""
+        cells = np.floor(spec.cofm/spec.celsz).astype(int).T
+        spec.computed.append(np.shape(spec.cofm)[0])
+        return np.repeat(10**_true_colden(cells)[:,np.newaxis], 10, axis=1)/10.
+    spec.compute_spectra = compute_spectra
+    spec.index = spec.sampler.sample(200)
+    return spec
+
+def test_grid_prefilter(tmp_path):
+    """Without a margin every cell drawn has its spectra computed. With a margin larger than the error
+    in the grid column density, the prefilter rejects only cells without a DLA, so fewer spectra are computed"""
+    gridfile = str(tmp_path / "grid.hdf5")
+    rng = np.random.RandomState(37)
+    f = h5py.File(gridfile, 'w')
+    f.create_group("HaloData").create_dataset("ngrid", data=np.array([64]))
+    grp = f.create_group("abslists")
+    for (name, nn) in (("DLA", 400), ("LLS", 600)):
+        cells = rng.randint(0, 64, size=(3, nn))
+        grp.create_dataset(name, data=cells)
+        grp.create_dataset(name+"_val", data=_true_colden(cells) + rng.uniform(-0.3, 0.3, size=nn))
+    f.close()
+    thresh = 10**20.3
+    rounds = {}
+    for margin in (None, 0.5):
+        spec = _make_grid_spectra(gridfile, margin)
+        spec.replace_not_DLA(100, thresh)
+        assert spec.NumLos == 100 and np.shape(spec.cofm) == (100, 3)
+        assert np.all(np.sum(spec.colden[("H", 1)], axis=1) > thresh)
+        assert spec.computed == [stats["computed"] for stats in spec.replace_stats]
+        rounds[margin] = spec.replace_stats
+    assert all(stats["computed"] == stats["tried"] for stats in rounds[None])
+    assert all(stats["computed"] < stats["tried"] for stats in rounds[0.5])
+    #The first round draws the same cells, and the cells rejected by the prefilter had no DLA
+    assert rounds[None][0]["tried"] == rounds[0.5][0]["tried"]
+    assert rounds[None][0]["accepted"] == rounds[0.5][0]["accepted"]
+
+def _brute_force_quadrants(x, y, xo, yo):
+    """Fraction of the points in each quadrant around an origin, as in quadct of Numerical Recipes"""
+    right = x > xo
+    up = y > yo
+    quad = [np.sum(right & up), np.sum(~right & up), np.sum(~right & ~up), np.sum(right & ~up)]
+    return np.array(quad)/(1.*np.size(x))
+
+def _brute_force_ks2d(data1, data2):
+    """The 2D KS statistic, comparing every origin to every point as in ks2d2s"""
+    d1 = np.max([np.abs(_brute_force_quadrants(data1[:,0], data1[:,1], xo, yo) - _brute_force_quadrants(data2[:,0], data2[:,1], xo, yo)) for (xo, yo) in data1])
+    d2 = np.max([np.abs(_brute_force_quadrants(data1[:,0], data1[:,1], xo, yo) - _brute_force_quadrants(data2[:,0], data2[:,1], xo, yo)) for (xo, yo) in data2])
+    return (d1+d2)/2.
+
+def test_ks2d_matches_brute_force():
+    """The swept quadrant counts give the same statistic as comparing every origin to every point"""
+    rng = np.random.RandomState(29)
+    for (n1, n2) in ((50, 300), (301, 7), (1, 130)):
+        #Rounded, so there are ties on the quadrant boundaries
+        data1 = np.round(rng.normal(0, 1, size=(n1, 2)), 1)
+        data2 = np.round(rng.normal(0.3, 1.2, size=(n2, 2)), 1)
+        assert np.isclose(ks2d.ks_2d_2samp(data1, data2), _brute_force_ks2d(data1, data2))
+        counter = ks2d.QuadrantCounter(data2[:,0], data2[:,1], block=16)
+        ref = np.array([_brute_force_quadrants(data2[:,0], data2[:,1], xo, yo) for (xo, yo) in data1])
+        assert np.allclose(counter.fractions(data1[:,0], data1[:,1]), ref)
+    assert ks2d.ks_2d_2samp(data2, data2) == 0
+
+def test_ks2d_trials_reproducible():
+    """Subsample trials depend on the seed, but not on the number of processes"""
+    rng = np.random.RandomState(31)
+    reference = rng.normal(0, 1, size=(200, 2))
+    population = rng.normal(0, 1, size=(500, 2))
+    serial = ks2d.subsample_trials(reference, population, 40, ntrials=23, nproc=1, chunk=5)
+    assert np.size(serial) == 23
+    assert np.array_equal(serial, ks2d.subsample_trials(reference, population, 40, ntrials=23, nproc=2, chunk=5))
+    assert not np.array_equal(serial, ks2d.subsample_trials(reference, population, 40, ntrials=23, seed=24, nproc=1, chunk=5))
@@ -6,23 +6,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 from fake_spectra import plot_spectra as ps
 from fake_spectra import haloassigned_spectra as hs
-import kstest as ks
+import ks2d
+import haloindex
 import vw_spectra as vw
-try:
-    xrange(1)
-except NameError:
-    xrange = range
-
-def _bootstrap_sample(vel_data, v_table, samples, error):
-    """Generate a Monte Carlo error sample of the differential distribution."""
-    # Generate some Monte Carlo samples where each element is perturbed by
-    # a Gaussian, sigma given by error.
-    index = np.random.random_integers(0, np.size(vel_data)-1, samples)
-    bootstrap = vel_data[index]
-    if error > 0.:
-        bootstrap += np.random.normal(0,error,size=samples)
-    nn = np.histogram(bootstrap,v_table)[0]
-    return nn
 
 class VWPlotSpectra(hs.HaloAssignedSpectra, ps.PlottingSpectra, vw.VWSpectra):
     """Extends PlottingSpectra with velocity width specific code."""
@@ -93,21 +79,9 @@ class VWPlotSpectra(hs.HaloAssignedSpectra, ps.PlottingSpectra, vw.VWSpectra):
         v_table=np.logspace(1,np.log10(np.max(vel_width)+10),nv_table)
         self._plot_errors(vel_width, v_table, samples, 5, cumulative, True, color)
 
-    def _plot_errors(self, vel_data, v_table, samples, error, cumulative=False, lognorm=True, color="red"):
+    def _plot_errors(self, vel_data, v_table, samples, error, cumulative=False, lognorm=True, color="red", seed=23):
         """Find and plot a 68% contour for a subsample of size samples, by Monte Carlo."""
-        vbin = np.array([(v_table[i]+v_table[i+1])/2. for i in range(0,np.size(v_table)-1)])
-        #Get a subsample
-        cdfs = np.array([_bootstrap_sample(vel_data, v_table, samples, error) for _ in xrange(10000)])
-        if cumulative:
-            cdfs = np.cumsum(cdfs, axis=1)
-            norm = 1
-        else:
-            if lognorm:
-                v_table = np.log10(v_table)
-            norm = samples * np.array([(-v_table[i]+v_table[i+1]) for i in xrange(np.size(v_table)-1)])
-
-        lower = np.percentile(cdfs, 16, axis=0)/norm
-        upper = np.percentile(cdfs, 84, axis=0)/norm
+        (vbin, lower, upper) = vw.bootstrap_errors(vel_data, v_table, samples, error, cumulative, lognorm, seed=seed)
         plt.fill_between(vbin, lower, upper, color=color, alpha=0.3)
 
     def plot_f_meanmedian(self, elem, ion, dv=0.06, color="red", ls="-"):
@@ -134,7 +108,8 @@ class VWPlotSpectra(hs.HaloAssignedSpectra, ps.PlottingSpectra, vw.VWSpectra):
         Threshold is as a percentage of the maximum value.
         mindist is in km/s
         """
-        sep = self.get_separated(elem, ion, thresh,mindist)
+        (nregions, _) = self.get_separated(elem, ion, thresh,mindist)
+        sep = nregions > 1
         vels = self.vel_width(elem, ion)
         ind = self.get_filt(elem, ion)
         v_table = 10**np.arange(1, 3, dv)
@@ -176,7 +151,6 @@ class VWPlotSpectra(hs.HaloAssignedSpectra, ps.PlottingSpectra, vw.VWSpectra):
         mindist is in km/s
         """
         #Find velocity width
-        (halos, subhalos) = self.find_nearby_halos()
         vels = self.vel_width(elem, ion)
         ii = self.get_filt(elem, ion)
         #Find virial velocity
@@ -192,12 +166,53 @@ class VWPlotSpectra(hs.HaloAssignedSpectra, ps.PlottingSpectra, vw.VWSpectra):
         hist1 = np.histogram(vwvir, v_table)
         hist1[0][np.where(hist1[0] == 0)] = 1
         #Find places with multiple halos
-        subhalo_parent = [list(self.sub_sub_index[ss]) for ss in subhalos]
-        allh = np.array([list(set(subhalo_parent[ii] + halos[ii])) for ii in xrange(self.NumLos)])
-        indmult = np.where([len(aa) > 1 for aa in allh[ind]])
+        mult = self.halo_association().multiplicity(self.sub_sub_index)
+        indmult = np.where(mult[ii][ind] > 1)
         histmult = np.histogram(vwvir[indmult],v_table)
         plt.semilogx(vbin, histmult[0]/(1.*hist1[0]), color=color, ls=ls, label=self.label)
 
+    def _halo_indices(self):
+        """Spatial indices over the halos and subhalos, built once per snapshot."""
+        try:
+            return self._halo_index
+        except AttributeError:
+            self._halo_index = (haloindex.HaloIndex(self.sub_cofm, self.sub_radii, self.box),
+                                haloindex.HaloIndex(self.sub_sub_cofm, self.sub_sub_radii, self.box))
+            return self._halo_index
+
+    def halo_association(self):
+        """
+        Get the halos and subhalos containing the absorbers along each sightline, as a haloindex.HaloAssociation.
+        Absorbers are the contiguous regions of high HI column density.
+        This is found once per object. Call save_stats to keep it in the save file with the derived statistics.
+        """
+        try:
+            return self.halo_assoc
+        except AttributeError:
+            pass
+        zpos = self.get_contiguous_regions(thresh = 1e19, relthresh = 1e-2)
+        rows = np.repeat(np.arange(self.NumLos), [len(zz) for zz in zpos])
+        pos = np.array(self.cofm[rows,:], dtype=np.float64)
+        pos[np.arange(np.size(rows)), self.axis[rows]-1] = np.array([zz for zzs in zpos for zz in zzs])
+        (halos, subhalos) = self._halo_indices()
+        assoc = haloindex.associate(rows, pos, halos, subhalos, self.sub_sub_index, self.virial_vel(), self.NumLos)
+        nhalos = np.diff(assoc.halo_offsets)
+        nsub = np.diff(assoc.subhalo_offsets)
+        print("no. halos: ",np.sum(nhalos)," mult halos: ",np.sum(nhalos > 1))
+        print("no. subhalos: ",np.sum(nsub)," mult subhalos: ",np.sum(nsub > 1))
+        self.halo_assoc = assoc
+        return assoc
+
+    def find_nearby_halos(self):
+        """Find halos and subhalos associated with absorption near a sightline, as lists for each sightline.
+           See halo_association for the same information as arrays."""
+        assoc = self.halo_association()
+        return (assoc.to_lists(assoc.halo_offsets, assoc.halos), assoc.to_lists(assoc.subhalo_offsets, assoc.subhalos))
+
+    def find_nearest_halo(self):
+        """Find the single most massive halos associated with absorption near a sightline, possibly via a subhalo."""
+        return (self.halo_association().nearest, 0)
+
     def plot_Z_vs_vel_width(self,elem="Si", ion=2, color="blue",color2="darkblue"):
         """Plot the correlation between metallicity and velocity width"""
         vel = self.vel_width(elem, ion)
@@ -217,16 +232,27 @@ class VWPlotSpectra(hs.HaloAssignedSpectra, ps.PlottingSpectra, vw.VWSpectra):
         vel = self.vel_width(elem, ion)
         self._plot_xx_vs_mass(vel, "vel",color,color2)
 
-    def kstest(self, Zdata, veldata, elem="Si", ion=2):
-        """Find the 2D KS test value of the vel width and log metallicity
-           with respect to an external dataset, veldata and Z data"""
+    def ks_engine(self, elem="Si", ion=2):
+        """Get a KS2D engine for the log metallicity and log vel width of the filtered spectra.
+           This is cached per (elem, ion, minwidth, snr, spec_res), so repeated tests against the spectra are cheap."""
+        key = (elem, ion, self.minwidth, self.snr, self.spec_res)
+        try:
+            return self.ks_engines[key]
+        except (AttributeError, KeyError):
+            pass
         met = self.get_metallicity()
         ind = self.get_filt(elem, ion)
         met = np.log10(met[ind])
         vel = np.log10(self.vel_width(elem, ion)[ind])
-        data2 = np.array([met,vel]).T
+        engine = ks2d.KS2D(np.array([met,vel]).T)
+        self._cache("ks_engines")[key] = engine
+        return engine
+
+    def kstest(self, Zdata, veldata, elem="Si", ion=2):
+        """Find the 2D KS test value of the vel width and log metallicity
+           with respect to an external dataset, veldata and Z data"""
         data = np.array([np.log10(Zdata), np.log10(veldata)]).T
-        return ks.ks_2d_2samp(data,data2)
+        return self.ks_engine(elem, ion).statistic(data)
 
     def plot_virial_vel_vs_vel_width(self,elem, ion,color="red", ls="-", label="", dm=0.1):
         """Plot a histogram of the velocity widths vs the halo virial velocity"""
@@ -293,3 +319,53 @@ class VWPlotSpectra(hs.HaloAssignedSpectra, ps.PlottingSpectra, vw.VWSpectra):
         thresh - observable density threshold
         """
         return vw.VWSpectra.get_filt(self, elem, ion, thresh)
+
+class VWPlotSummary(VWPlotSpectra):
+    """
+    View of the per-spectrum statistics in a save file: velocity width, f_mm, f_edg, metallicity,
+    equivalent width and the filters, for comparing two sets of spectra.
+    The halo catalogue is not loaded, so methods which need it will not work.
+    Large arrays are only read from the save file if a statistic is missing from it.
+    Statistics which had to be computed are saved to the save file, so the next run does not need to.
+    """
+    lazy_arrays = True
+    def __init__(self, num, base, cofm=None, axis=None, label="", snr=0., **kwargs):
+        #Skip HaloAssignedSpectra, which loads the halo catalogue
+        ps.PlottingSpectra.__init__(self, num, base, cofm=cofm, axis=axis, label=label, snr=snr, **kwargs)
+
+    def _ncached(self):
+        """Number of derived statistics in memory"""
+        total = 0
+        for name in ("vel_statistics", "max_density", "eq_widths", "metallicities", "stat_hists"):
+            total += len(self._cache(name))
+        for filts in self._cache("filt_ind").values():
+            total += len(filts)
+        return total
+
+    def _saving(self, func, *args):
+        """Call func, saving the derived statistics if any were computed."""
+        before = self._ncached()
+        result = func(self, *args)
+        if self._ncached() > before:
+            self.save_stats()
+        return result
+
+    def vel_stats(self, elem, ion):
+        """As VWSpectra.vel_stats, saving the statistics if they were computed."""
+        return self._saving(VWPlotSpectra.vel_stats, elem, ion)
+
+    def get_filt_mask(self, elem, ion, thresh = 100):
+        """As VWSpectra.get_filt_mask, saving the mask if it was computed."""
+        return self._saving(VWPlotSpectra.get_filt_mask, elem, ion, thresh)
+
+    def get_metallicity(self, width=0.):
+        """As VWSpectra.get_metallicity, saving the metallicity if it was computed."""
+        return self._saving(VWPlotSpectra.get_metallicity, width)
+
+    def equivalent_width(self, elem, ion, line):
+        """As VWSpectra.equivalent_width, saving the widths if they were computed."""
+        return self._saving(VWPlotSpectra.equivalent_width, elem, ion, line)
+
+    def stat_histogram(self, elem, ion, func, edges, log=True, filt=True, line=None):
+        """As VWSpectra.stat_histogram, saving the histogram if it was computed."""
+        return self._saving(VWPlotSpectra.stat_histogram, elem, ion, func, edges, log, filt, line)
@@ -4,6 +4,10 @@
 from __future__ import print_function
 import math
 import numpy as np
+import h5py
+import lazyarray
+import stathist
+import haloindex
 from fake_spectra import spectra as ss
 from fake_spectra import spec_utils
 try:
@@ -11,12 +15,506 @@ try:
 except NameError:
     xrange = range
 
+def _absorber_windows(absorbed, low, high, chunk):
+    """
+       Find the region of significant absorption in every spectrum at once.
+       absorbed - boolean array [NumLos, nbins], True where there is significant absorption.
+                  Spectra should be rolled so that the deepest absorption is in the middle.
+       low, high - starting window, the same for every spectrum.
+       chunk - step size in which to expand the window.
+
+       The window is first expanded chunk by chunk, on each side, until a chunk with
+       no absorption is found. It is then shrunk to the first absorbing pixel on the left
+       and chunk pixels beyond the last absorbing pixel on the right.
+
+       Returns arrays of the low and high indices for each spectrum.
+    """
+    (nlos, nbins) = np.shape(absorbed)
+    lows = low*np.ones(nlos, dtype=int)
+    highs = high*np.ones(nlos, dtype=int)
+    #Expand leftwards. Chunks are contiguous, so the nearest one ends at low+chunk,
+    #and reduceat wants the chunk starts in increasing order.
+    starts = np.arange(low, 0, -chunk)
+    if np.size(starts) > 0:
+        empty = np.logical_not(np.logical_or.reduceat(absorbed[:, :low+chunk], starts[::-1], axis=1)[:, ::-1])
+        found = np.any(empty, axis=1)
+        lows[found] = starts[np.argmax(empty[found], axis=1)]
+    #Expand rightwards: the last chunk is truncated at the end of the spectrum.
+    starts = np.arange(high, nbins, chunk)
+    if np.size(starts) > 0:
+        empty = np.logical_not(np.logical_or.reduceat(absorbed, starts, axis=1))
+        found = np.any(empty, axis=1)
+        highs[found] = starts[np.argmax(empty[found], axis=1)]+chunk
+    #Shrink to the width which has some absorption
+    pix = np.arange(nbins)
+    inwin = absorbed*(pix >= lows[:, np.newaxis])*(pix < highs[:, np.newaxis])
+    found = np.any(inwin, axis=1)
+    first = np.argmax(inwin, axis=1)
+    last = nbins - 1 - np.argmax(inwin[:, ::-1], axis=1)
+    lows[found] = first[found]
+    highs[found] = np.minimum(last[found]+chunk, nbins)
+    return (lows, highs)
+
+#Version of the layout of the derived statistics stored in the save file.
+#Sections with a different version are ignored on load, and recomputed.
+DERIVED_VERSION = 2
+
+#Histograms of the velocity width are binned in log10(v90 / km/s) from 1 up to this.
+#Bins are fixed, rather than set by the data, so that histograms from different spectra line up bin for bin.
+VEL_WIDTH_LOGMAX = 4
+#Range of the bins for histograms of the equivalent width, in log10(W / Angstrom).
+EQ_WIDTH_LOGRANGE = (-4, 1)
+
+#Special line numbers for compute_batch requests. Any other line is the optical depth in that line,
+#labelled by wavelength as in self.lines. Line 0 is the column density, as in get_col_density.
+COLDEN = 0
+OBSERVER_TAU = -1
+VELOCITY = -2
+
+def _read_multihash(grp, key=()):
+    """
+       Read back a hierarchy of hdf groups written by _save_multihash.
+       Keys are (elem, ion, ...), where any further parts of the key are numbers.
+       Yields (key, array) pairs.
+    """
+    for (name, item) in grp.items():
+        if isinstance(item, h5py.Group):
+            for pair in _read_multihash(item, key+(name,)):
+                yield pair
+        else:
+            full = key+(name,)
+            yield ((full[0], int(full[1]))+tuple(float(kk) for kk in full[2:]), np.array(item))
+
+#Groups of per-sightline arrays in the save file, with the method which computes each
+#and the attribute it stores them in. The observer tau is first, as it also chooses tau_obs_line.
+APPEND_ARRAYS = [("tau_obs", "get_observer_tau", "tau_obs"), ("tau", "get_tau", "tau"), ("colden", "get_col_density", "colden"),
+                 ("velocity", "get_velocity", "velocity"), ("temperature", "get_temp", "temp")]
+#Other groups in the save file which append_sightlines knows how to handle.
+#Any other group holding arrays may be per-sightline, so append_sightlines refuses to extend the file.
+APPEND_OTHER = ["Header", "spectra", "tau_obs_line", "derived", "sampler"]
+
+def _load_stat_hist(grp_hist):
+    """Read back a histogram saved by _save_derived. Returns (key in stat_hists, histogram)."""
+    hist = stathist.load_histogram(grp_hist)
+    params = grp_hist.attrs["params"]
+    key = (str(grp_hist.attrs["stat"]), str(grp_hist.attrs["label"]), str(grp_hist.attrs["elem"]), int(params[0]), int(params[1]),
+           hist.log, float(params[2]), float(params[3]), float(params[4]), tuple(hist.edges))
+    return (key, hist)
+
+def _multihash_keys(grp, key=()):
+    """
+       Keys of the arrays in a hierarchy of hdf groups written by _save_multihash, without reading them.
+       Keys are (elem, ion, ...), with the ion and any further parts of the key as integers, as load_savefile makes them.
+       Yields (key, path of the dataset).
+    """
+    for (name, item) in grp.items():
+        if isinstance(item, h5py.Group):
+            for pair in _multihash_keys(item, key+(name,)):
+                yield pair
+        else:
+            full = key+(name,)
+            yield ((full[0],)+tuple(int(float(kk)) for kk in full[1:]), item.name)
+
+def _append_rows(f, name, rows):
+    """
+       Append rows to the dataset name in an open hdf file, along its first axis.
+       Datasets written by save_file have a fixed size, so the first append rewrites the dataset as a chunked,
+       resizable one. Later appends then only write the new rows.
+    """
+    dset = f[name]
+    if dset.maxshape[0] is not None:
+        old = np.array(dset)
+        del f[name]
+        dset = f.create_dataset(name, data=old, maxshape=(None,)+old.shape[1:], chunks=True)
+    nold = dset.shape[0]
+    dset.resize(nold+np.shape(rows)[0], axis=0)
+    dset[nold:] = rows
+
+def _fft_res_corr(tau, dvbin, fwhm=8):
+    """
+       As spec_utils.res_corr, convolving every spectrum with a Gaussian of the spectrograph resolution,
+       but done with an FFT over the whole [NumLos, nbins] block.
+       The kernel is the one gaussian_filter1d uses (truncated at 4 sigma and normalised),
+       wrapped onto the periodic spectrum, so the results agree to rounding error.
+       With no resolution (fwhm <= 0) the spectra are returned unchanged, as res_corr does.
+    """
+    if fwhm <= 0:
+        return np.array(tau)
+    nbins = np.shape(tau)[-1]
+    #FWHM of a Gaussian is 2 \sqrt(2 ln 2) sigma
+    sigma = fwhm/dvbin/(2*np.sqrt(2*np.log(2)))
+    radius = int(4*sigma+0.5)
+    xx = np.arange(-radius, radius+1)
+    weights = np.exp(-0.5*xx**2/sigma**2)
+    kernel = np.zeros(nbins)
+    np.add.at(kernel, xx % nbins, weights/np.sum(weights))
+    return np.fft.irfft(np.fft.rfft(tau, axis=-1)*np.fft.rfft(kernel), n=nbins, axis=-1)
+
+def _line_preference(maxtau):
+    """
+       Rank a line by how useful it is to an observer, given the maximum optical depth
+       it produces in each spectrum. Lines are compared first by rank, then by score:
+       higher is better, and on a tie the line seen first is kept.
+
+       We want unsaturated lines, defined as those with tau < 3,
+       which is the maximum tau in the sample of Neeleman 2013.
+       Also use lines with some absorption: tau > 0.1, roughly twice noise level.
+       Of these the strongest line is best (rank 2).
+       If there are no lines in the desired region, use the least saturated one (rank 1).
+       In reality the observers will use a different ion.
+       If there are no observable lines, the spectra are metal-poor and will be filtered anyway:
+       use the strongest line (rank 0).
+
+       Returns (rank, score) arrays with one entry per spectrum.
+    """
+    rank = np.zeros(np.size(maxtau), dtype=int)
+    rank[maxtau > 0.1] = 1
+    rank[np.logical_and(maxtau < 3, maxtau > 0.1)] = 2
+    score = np.where(rank == 1, -maxtau, maxtau)
+    return (rank, score)
+
+def _roll_rows(tau, offset):
+    """Roll each row of tau by the matching entry in offset, as np.roll does for a single spectrum."""
+    nbins = np.shape(tau)[1]
+    ind = (np.arange(nbins) - offset[:, np.newaxis]) % nbins
+    return tau[np.arange(np.shape(tau)[0])[:, np.newaxis], ind]
+
+def _vel_stat_kernel(tau, low, high, offset, block=1024):
+    """
+       Find the 5%, 50% and 95% points of the integrated optical depth, and the peak optical depth,
+       in the absorber window of every spectrum at once.
+       tau - optical depth array [NumLos, nbins]
+       low, high, offset - absorber windows and rolls, as returned by find_absorber_width.
+       block - number of spectra to process at a time, which bounds the temporary memory.
+
+       Each spectrum is rolled so the deepest point is in the middle, and everything outside
+       its window is zeroed, so that the cumulative sum over the whole row is the cumulative sum over the window.
+       A crossing is then the first pixel in the window where the cumulative optical depth reaches the
+       required fraction of the total, exactly as for a single spectrum.
+
+       Returns (nnlow, nnhigh, median, vmax), the pixel indices of each point, relative to low.
+    """
+    (nlos, nbins) = np.shape(tau)
+    points = np.zeros([4, nlos], dtype=int)
+    pix = np.arange(nbins)
+    for start in xrange(0, nlos, block):
+        end = min(start+block, nlos)
+        rolled = _roll_rows(tau[start:end], offset[start:end])
+        inwin = np.logical_and(pix >= low[start:end, np.newaxis], pix < high[start:end, np.newaxis])
+        cum_tau = np.cumsum(np.where(inwin, rolled, 0), axis=1)
+        tot = cum_tau[:, -1:]
+        for (ii, frac) in enumerate((0.05, 0.95, 0.5)):
+            points[ii, start:end] = np.argmax(np.logical_and(inwin, cum_tau - frac*tot >= 0), axis=1)
+        points[3, start:end] = np.argmax(np.where(inwin, rolled, -np.inf), axis=1)
+    return points - low
+
+def _separated_regions(condition, mindist=0):
+    """
+       Find the contiguous True regions in each row of the boolean array condition,
+       combining regions separated by a gap shorter than mindist.
+       Returns (row, low, high): the row of each region and the index of its first element
+       and one past its last, ordered by row and then position.
+    """
+    (nlos, nbins) = np.shape(condition)
+    padded = np.zeros([nlos, nbins+2], dtype=np.int8)
+    padded[:, 1:-1] = condition
+    change = np.diff(padded, axis=1)
+    (row, low) = np.nonzero(change == 1)
+    high = np.nonzero(change == -1)[1]
+    #A region starts a new combined region if it is the first in its row or far from the last.
+    new = np.ones(np.size(row), dtype=bool)
+    new[1:] = np.logical_or(row[1:] != row[:-1], low[1:] - high[:-1] >= mindist)
+    first = np.where(new)[0]
+    last = np.append(first[1:], np.size(row))[:np.size(first)] - 1
+    return (row[first], low[first], high[last])
+
+def bootstrap_histograms(vel_data, v_table, samples, error, nboot=10000, seed=23, block=2**22):
+    """
+       Generate Monte Carlo error samples of the differential distribution of vel_data.
+       Each sample draws samples elements of vel_data with replacement, perturbs each by
+       a Gaussian with sigma given by error, and histograms them in the bins v_table.
+       All draws for a block of samples are made at once, as a 2D index matrix,
+       and histogrammed with a single searchsorted and bincount, using the same
+       bin edge conventions as np.histogram.
+
+       nboot - number of samples
+       seed - seed for the random number Generator, so the samples are reproducible.
+       block - approximate maximum number of elements drawn at once, which bounds the memory used.
+
+       Returns an array [nboot, nbins] of the number of elements in each bin.
+    """
+    rng = np.random.default_rng(seed)
+    nbins = np.size(v_table)-1
+    hists = np.zeros([nboot, nbins], dtype=int)
+    nrows = int(np.max([1, block // np.max([samples, 1])]))
+    for start in xrange(0, nboot, nrows):
+        end = min(start+nrows, nboot)
+        index = rng.integers(0, np.size(vel_data), size=(end-start, samples))
+        bootstrap = vel_data[index]
+        if error > 0.:
+            bootstrap = bootstrap + rng.normal(0, error, size=np.shape(index))
+        #Bins are half-open, except the last, which includes its right edge.
+        ibin = np.searchsorted(v_table, bootstrap, side='right') - 1
+        ibin[bootstrap == v_table[-1]] = nbins-1
+        inrange = np.logical_and(ibin >= 0, ibin < nbins)
+        rows = np.repeat(np.arange(end-start)[:, np.newaxis], samples, axis=1)
+        flat = rows[inrange]*nbins + ibin[inrange]
+        hists[start:end] = np.bincount(flat, minlength=(end-start)*nbins).reshape(end-start, nbins)
+    return hists
+
+def bootstrap_errors(vel_data, v_table, samples, error, cumulative=False, lognorm=True, nboot=10000, seed=23):
+    """
+       Find a 68% contour for the distribution of a subsample of size samples from vel_data, by Monte Carlo.
+       If cumulative, the contour is on the cumulative number of elements.
+       Otherwise it is on the differential distribution, normalised per unit v_table,
+       or per unit log10(v_table) if lognorm.
+       Returns (vbin, lower, upper).
+    """
+    vbin = np.array([(v_table[i]+v_table[i+1])/2. for i in range(0,np.size(v_table)-1)])
+    cdfs = bootstrap_histograms(vel_data, v_table, samples, error, nboot=nboot, seed=seed)
+    if cumulative:
+        cdfs = np.cumsum(cdfs, axis=1)
+        norm = 1
+    else:
+        if lognorm:
+            v_table = np.log10(v_table)
+        norm = samples * np.array([(-v_table[i]+v_table[i+1]) for i in xrange(np.size(v_table)-1)])
+    lower = np.percentile(cdfs, 16, axis=0)/norm
+    upper = np.percentile(cdfs, 84, axis=0)/norm
+    return (vbin, lower, upper)
+
 class VWSpectra(ss.Spectra):
     """"Extends the spectra class with velocity width functions."""
+    #If True, convolve observer tau with the spectrograph resolution using an FFT over all spectra at once.
+    #Set this before any observer tau is requested: the convolved spectra are cached.
+    fft_res_corr = False
+    #If True, arrays in the save file which have not yet been loaded are not loaded whole when
+    #only a single spectrum or a per-spectrum maximum is needed: these are read from the file directly.
+    lazy_arrays = False
+    #Name for the criteria used by _filter_mask. Filters are cached separately for each name.
+    filt_label = "density"
+
     def __init__(self,num, base, load_snapshot = True,cofm=None, axis=None, label="", snr=0., load_halo=True,**kwargs):
         
         ss.Spectra.__init__(self,num, base, cofm=cofm, load_snapshot=load_snapshot ,axis=axis, snr=snr, load_halo=load_halo, **kwargs)
         
+    def _cache(self, name):
+        """Get a dictionary of derived quantities, creating it if needed.
+           These are made here rather than in __init__, which VWPlotSpectra does not call."""
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            setattr(self, name, {})
+            return getattr(self, name)
+
+    def load_savefile(self, savefile=None):
+        """Load data from a file, including the line used for each observer tau spectrum
+        and any derived statistics saved with it. These are small, so are not lazy-loaded."""
+        ss.Spectra.load_savefile(self, savefile)
+        f=h5py.File(savefile,'r')
+        try:
+            grp = f["tau_obs_line"]
+            for elem in grp.keys():
+                for ion in grp[elem].keys():
+                    self._cache("tau_obs_line")[(elem, int(ion))] = np.array(grp[elem][ion])
+        except KeyError:
+            pass
+        try:
+            grp = f["derived"]
+            if grp.attrs["version"] == DERIVED_VERSION:
+                for (key, value) in _read_multihash(grp["absorber_width"]):
+                    self.absorber_width[key] = tuple(value)
+                for (key, value) in _read_multihash(grp["vel_stats"]):
+                    self._cache("vel_statistics")[key] = tuple(value)
+                for (key, value) in _read_multihash(grp["max_density"]):
+                    self._cache("max_density")[key] = value
+                if "eq_width" in grp:
+                    for (key, value) in _read_multihash(grp["eq_width"]):
+                        self._cache("eq_widths")[key] = value
+                if "metallicity" in grp:
+                    self._cache("metallicities")[0.] = np.array(grp["metallicity"])
+                if "halo_assoc" in grp:
+                    self.halo_assoc = haloindex.load_association(grp["halo_assoc"])
+                for label in grp["filt"].keys():
+                    filts = self._cache("filt_ind").setdefault(label, {})
+                    for (key, value) in _read_multihash(grp["filt"][label]):
+                        filts[key] = (value, np.where(value))
+                if "stat_hist" in grp:
+                    for grp_hist in grp["stat_hist"].values():
+                        (key, hist) = _load_stat_hist(grp_hist)
+                        self._cache("stat_hists")[key] = hist
+        except KeyError:
+            pass
+        f.close()
+
+    def _save_file(self, f):
+        """Save the line used for each observer tau spectrum and the derived statistics,
+        then the rest of the spectra."""
+        grp_grid = f.create_group("tau_obs_line")
+        self._save_multihash(self._cache("tau_obs_line"), grp_grid)
+        self._save_derived(f)
+        ss.Spectra._save_file(self, f)
+
+    def save_stats(self):
+        """Save only the derived statistics, adding them to those already in the save file.
+        This is much faster than save_file, which rewrites all the spectra."""
+        f = h5py.File(self.savefile, 'r+')
+        self._save_derived(f)
+        f.close()
+
+    def append_sightlines(self):
+        """
+        Append the sightlines of this object to the end of its save file, which already holds other sightlines.
+        Every per-sightline array in the save file is computed for the new sightlines only, and the new rows are
+        written in place. The line chosen for the observer tau and the number of discarded sightlines are extended too.
+        The derived statistics in the save file are deleted, as they no longer cover every sightline:
+        they are recomputed when next needed.
+        Afterwards this object is reloaded from the save file, so it holds all the sightlines.
+        Arrays which were computed for the new sightlines but are not in the save file are dropped.
+        Raises ValueError, without changing the file, if it holds arrays which cannot be computed for the new sightlines,
+        such as num_important.
+        """
+        f = h5py.File(self.savefile, 'r+')
+        try:
+            known = [group for (group, _, _) in APPEND_ARRAYS] + APPEND_OTHER
+            for name in f.keys():
+                if name not in known and (not isinstance(f[name], h5py.Group) or len(list(_multihash_keys(f[name]))) > 0):
+                    raise ValueError("Cannot append sightlines to "+self.savefile+": it contains "+name+", which cannot be extended")
+            for (group, method, attr) in APPEND_ARRAYS:
+                if group not in f:
+                    continue
+                for (key, name) in list(_multihash_keys(f[group])):
+                    getattr(self, method)(*key)
+                    _append_rows(f, name, self._cache(attr)[key])
+            if "tau_obs_line" in f:
+                for (key, name) in list(_multihash_keys(f["tau_obs_line"])):
+                    _append_rows(f, name, self.tau_obs_line[key])
+            _append_rows(f, "spectra/cofm", self.cofm)
+            _append_rows(f, "spectra/axis", self.axis)
+            f["Header"].attrs["discarded"] += self.discarded
+            if "derived" in f:
+                del f["derived"]
+        finally:
+            f.close()
+        self._reload()
+
+    def _reload(self):
+        """Discard everything in memory and load the save file again."""
+        for name in ("tau_obs", "tau", "colden", "velocity", "temp", "num_important", "absorber_width", "part_ind",
+                     "tau_obs_line", "vel_statistics", "max_density", "eq_widths", "metallicities", "filt_ind", "stat_hists",
+                     "tau_conv", "tau_noise", "ks_engines"):
+            setattr(self, name, {})
+        if hasattr(self, "halo_assoc"):
+            del self.halo_assoc
+        self.cofm_final = False
+        self.load_savefile(self.savefile)
+        self.NumLos = np.size(self.axis)
+
+    def _save_derived(self, f):
+        """
+        Save the derived statistics to a group in an open hdf file.
+        Statistics already in the group, from the same version of the layout, are kept unless this object has
+        its own value for them, so that several objects sharing a save file do not discard each other's statistics.
+        """
+        if "derived" in f and f["derived"].attrs.get("version") != DERIVED_VERSION:
+            del f["derived"]
+        grp = f.require_group("derived")
+        grp.attrs["version"] = DERIVED_VERSION
+        grp_grid = grp.require_group("absorber_width")
+        self._save_multihash(dict((key, np.array(value)) for (key, value) in self.absorber_width.items()), grp_grid)
+        grp_grid = grp.require_group("vel_stats")
+        self._save_multihash(dict((key, np.array(value)) for (key, value) in self._cache("vel_statistics").items()), grp_grid)
+        grp_grid = grp.require_group("max_density")
+        self._save_multihash(self._cache("max_density"), grp_grid)
+        grp_grid = grp.require_group("eq_width")
+        self._save_multihash(self._cache("eq_widths"), grp_grid)
+        if 0. in self._cache("metallicities"):
+            if "metallicity" in grp:
+                del grp["metallicity"]
+            grp.create_dataset("metallicity", data=self.metallicities[0.])
+        if hasattr(self, "halo_assoc"):
+            if "halo_assoc" in grp:
+                del grp["halo_assoc"]
+            self.halo_assoc.save(grp.create_group("halo_assoc"))
+        grp_grid = grp.require_group("filt")
+        for (label, filts) in self._cache("filt_ind").items():
+            self._save_multihash(dict((key, value[0]) for (key, value) in filts.items()), grp_grid.require_group(label))
+        grp_grid = grp.require_group("stat_hist")
+        #Histograms are in numbered groups: replace those with the same key, and number new ones after the rest.
+        saved = dict((_load_stat_hist(grp_hist)[0], name) for (name, grp_hist) in grp_grid.items())
+        nextname = np.max([int(name) for name in grp_grid.keys()]+[-1])+1
+        for (key, hist) in self._cache("stat_hists").items():
+            if key in saved:
+                name = saved[key]
+                del grp_grid[name]
+            else:
+                name = str(nextname)
+                nextname += 1
+            grp_hist = grp_grid.create_group(name)
+            grp_hist.attrs["stat"] = key[0]
+            grp_hist.attrs["label"] = key[1]
+            grp_hist.attrs["elem"] = key[2]
+            #ion, line, minwidth, snr, spec_res
+            grp_hist.attrs["params"] = np.array((key[3], key[4]) + key[6:9], dtype=np.float64)
+            hist.save(grp_hist)
+
+    def _lazy_array(self, key, array, array_name):
+        """
+        Get a LazyArray for an array in the save file, if lazy_arrays is set and it has not been loaded.
+        Returns None otherwise. Raises KeyError if the array is not known.
+        """
+        if not self.lazy_arrays or np.size(array[key]) > 1:
+            return None
+        return lazyarray.LazyArray(self.savefile, "/".join([array_name]+[str(kk) for kk in key]))
+
+    def _res_corr(self, tau):
+        """Convolve optical depth with a Gaussian of the resolution of the spectrograph."""
+        if self.fft_res_corr:
+            return _fft_res_corr(tau, self.dvbin, self.spec_res)
+        return spec_utils.res_corr(tau, self.dvbin, self.spec_res)
+
+    def get_tau(self, elem, ion, line, number = -1, force_recompute=False, noise=True):
+        """Get the optical depth in each pixel along the sightline for a given line.
+        If lazy_arrays is set, a single spectrum not yet loaded is read alone from the save file.
+        Spectra are convolved with _res_corr, as for the observer tau."""
+        tau = None
+        if number >= 0 and not force_recompute:
+            try:
+                lazy = self._lazy_array((elem, ion, line), self.tau, "tau")
+            except KeyError:
+                lazy = None
+            if lazy is not None:
+                tau = lazy[number]
+        if tau is None:
+            try:
+                if force_recompute:
+                    raise KeyError
+                self._really_load_array((elem, ion, line), self.tau, "tau")
+                tau = self.tau[(elem, ion, line)]
+            except KeyError:
+                tau = self.compute_spectra(elem, ion, line, True)
+                self.tau[(elem, ion, line)] = tau
+            if number >= 0:
+                tau = tau[number,:]
+        tau = self._res_corr(tau)
+        if noise and self.snr > 0:
+            tau = self.add_noise(self.snr, tau, number)
+        return tau
+
+    def _forget_stats(self, elem, ion):
+        """Discard the convolved spectra and derived statistics for an ion,
+        because its observer tau has been recomputed."""
+        for stats in (self.absorber_width, self._cache("vel_statistics"), self._cache("tau_conv"), self._cache("tau_noise")):
+            for key in [kk for kk in stats.keys() if kk[:2] == (elem, ion)]:
+                del stats[key]
+        #Filters may use the observer tau
+        for filts in self._cache("filt_ind").values():
+            for key in [kk for kk in filts.keys() if kk[:2] == (elem, ion)]:
+                del filts[key]
+        hists = self._cache("stat_hists")
+        for key in [kk for kk in hists.keys() if kk[2:4] == (elem, ion)]:
+            del hists[key]
+
     def find_absorber_width(self, elem, ion, chunk = 20, minwidth=None):
         """
            Find the region in velocity space considered to be an absorber for each spectrum.
@@ -29,11 +527,13 @@ class VWSpectra(ss.Spectra):
            or F < 0.15 for no noise (and an assumed SNR of 20).
 
            Returns the low and high indices of absorption, and the offset for the maximal absorption.
+           These are cached per (elem, ion, minwidth, snr, spec_res).
         """
         if minwidth is None:
             minwidth = self.minwidth
+        key = (elem, ion, minwidth, self.snr, self.spec_res)
         try:
-            return self.absorber_width[(elem, ion, minwidth)]
+            return self.absorber_width[key]
         except KeyError:
             pass
         if self.snr > 0:
@@ -50,29 +550,13 @@ class VWSpectra(ss.Spectra):
         (offset, roll) = spec_utils.get_rolled_spectra(strong)
         #Minimum
         if 0 < minwidth < self.nbins/2:
-            low  = int(self.nbins/2-minwidth/self.dvbin)*np.ones(self.NumLos, dtype=np.int)
-            high = int(self.nbins/2+minwidth/self.dvbin)*np.ones(self.NumLos, dtype=np.int)
+            low  = int(self.nbins/2-minwidth/self.dvbin)
+            high = int(self.nbins/2+minwidth/self.dvbin)
         else:
-            low = np.zeros(self.NumLos, dtype=np.int)
-            high = self.nbins*np.ones(self.NumLos, dtype=np.int)
-        for ii in xrange(self.NumLos):
-            #First expand the search area in case there is absorption at the edges.
-            for i in xrange(low[ii],0,-chunk):
-                if not np.any(roll[ii,i:(i+chunk)] > thresh):
-                    low[ii] = i
-                    break
-            #Where is there no absorption rightwards of the peak?
-            for i in xrange(high[ii],self.nbins,chunk):
-                if not np.any(roll[ii,i:(i+chunk)] > thresh):
-                    high[ii] = i+chunk
-                    break
-            #Shrink to width which has some absorption
-            ind = np.where(roll[ii][low[ii]:high[ii]] > thresh)[0]
-            if np.size(ind) != 0:
-                oldlow = low[ii]
-                low[ii] = np.max((ind[0]+oldlow,0))
-                high[ii] = np.min((ind[-1]+oldlow+chunk,self.nbins))
-        self.absorber_width[(elem, ion, minwidth)] = (low, high, offset)
+            low = 0
+            high = self.nbins
+        (low, high) = _absorber_windows(roll > thresh, low, high, chunk)
+        self.absorber_width[key] = (low, high, offset)
         return (low, high, offset)
 
     def _eq_width_from_colden(self, col_den, elem = "H", ion = 1, line = 1215):
@@ -96,61 +580,241 @@ class VWSpectra(ss.Spectra):
         #Convert from cm/s to km/s
         return width/1e5
 
+    def _choose_observer_tau(self, elem, ion, taus):
+        """
+        Choose the line to use for the observer tau of each spectrum, and store the observer tau and the lines chosen.
+        taus - iterable of (line, tau) pairs, for every line of the ion. Only the best line found so far is kept
+               for each spectrum, so this may be a generator which computes each tau as it is needed.
+        Returns the observer tau.
+        """
+        ntau = np.zeros([self.NumLos, self.nbins])
+        best_rank = -np.ones(self.NumLos, dtype=int)
+        best_score = np.zeros(self.NumLos)
+        best_line = np.zeros(self.NumLos, dtype=int)
+        for (line, tau_loc) in taus:
+            #Maximum tau in each spectra with this line,
+            #after convolving with a Gaussian for instrumental broadening.
+            maxtau = np.max(spec_utils.res_corr(tau_loc, self.dvbin, self.spec_res), axis=-1)
+            (rank, score) = _line_preference(maxtau)
+            better = np.logical_or(rank > best_rank, np.logical_and(rank == best_rank, score > best_score))
+            ntau[better,:] = tau_loc[better,:]
+            best_rank[better] = rank[better]
+            best_score[better] = score[better]
+            best_line[better] = line
+            del tau_loc
+        self.tau_obs[(elem, ion)] = ntau
+        self._cache("tau_obs_line")[(elem, ion)] = best_line
+        self._forget_stats(elem, ion)
+        return ntau
+
     def get_observer_tau(self, elem, ion, number=-1, force_recompute=False, noise=True):
         """Get the optical depth for a particular element out of:
            (He, C, N, O, Ne, Mg, Si, Fe)
            and some ion number, choosing the line which causes the maximum optical depth to be closest to unity.
+           The line chosen for each spectrum, labelled by wavelength as in self.lines,
+           is stored in self.tau_obs_line[(elem, ion)] and saved with the spectra.
+
+           The convolved optical depth is cached per (elem, ion, spec_res) and the noisy optical depth
+           per (elem, ion, spec_res, snr), so the returned array should not be modified.
+           A single spectrum is a row of the cached array: the noise for spectrum ii is always seeded with ii.
+           If lazy_arrays is set and neither this nor the observer tau are in memory,
+           a single spectrum is instead read alone from the save file.
         """
+        if number >= 0 and not force_recompute and (elem, ion, self.spec_res) not in self._cache("tau_conv"):
+            try:
+                lazy = self._lazy_array((elem, ion), self.tau_obs, "tau_obs")
+            except KeyError:
+                lazy = None
+            if lazy is not None:
+                ntau = self._res_corr(lazy[number])
+                if noise and self.snr > 0:
+                    ntau = self.add_noise(self.snr, ntau, number)
+                return ntau
         try:
             if force_recompute:
                 raise KeyError
             self._really_load_array((elem, ion), self.tau_obs, "tau_obs")
             ntau = self.tau_obs[(elem, ion)]
         except KeyError:
-            #Compute tau for each line
-            nlines = len(self.lines[(elem,ion)])
-            tau = np.zeros([nlines, self.NumLos,self.nbins])
-            for ll in range(nlines):
-                line = list(self.lines[(elem,ion)].keys())[ll]
-                tau_loc = self.compute_spectra(elem, ion, line, True)
-                tau[ll,:,:] = tau_loc
-                del tau_loc
-            #Maximum tau in each spectra with each line,
-            #after convolving with a Gaussian for instrumental broadening.
-            maxtaus = np.max(spec_utils.res_corr(tau, self.dvbin, self.spec_res), axis=-1)
-            #Array for line indices
-            ntau = np.empty([self.NumLos, self.nbins])
-            #Use the maximum unsaturated optical depth
-            for ii in xrange(self.NumLos):
-                # we want unsaturated lines, defined as those with tau < 3
-                #which is the maximum tau in the sample of Neeleman 2013
-                #Also use lines with some absorption: tau > 0.1, roughly twice noise level.
-                ind = np.where(np.logical_and(maxtaus[:,ii] < 3, maxtaus[:,ii] > 0.1))
-                if np.size(ind) > 0:
-                    line = np.where(maxtaus[:,ii] == np.max(maxtaus[ind,ii]))
-                else:
-                    #We have no lines in the desired region: here use something slightly saturated.
-                    #In reality the observers will use a different ion
-                    ind2 = np.where(maxtaus[:,ii] > 0.1)
-                    if np.size(ind2) > 0:
-                        line = np.where(maxtaus[:,ii] == np.min(maxtaus[ind2,ii]))
-                    else:
-                        #We have no observable lines: this spectra are metal-poor
-                        #and will be filtered anyway.
-                        line = np.where(maxtaus[:,ii] == np.max(maxtaus[:,ii]))
-                if np.size(line) > 1:
-                    line = (line[0][0],)
-                ntau[ii,:] = tau[line,ii,:]
-            self.tau_obs[(elem, ion)] = ntau
-        if number >= 0:
-            ntau = ntau[number,:]
+            #Compute tau one line at a time, keeping only the best line found so far for each spectrum.
+            ntau = self._choose_observer_tau(elem, ion, ((line, self.compute_spectra(elem, ion, line, True)) for line in self.lines[(elem,ion)].keys()))
         # Convolve lines by a Gaussian filter of the resolution of the spectrograph.
-        ntau = spec_utils.res_corr(ntau, self.dvbin, self.spec_res)
+        key = (elem, ion, self.spec_res)
+        try:
+            ctau = self.tau_conv[key]
+        except (AttributeError, KeyError):
+            ctau = self._res_corr(ntau)
+            self._cache("tau_conv")[key] = ctau
+        ntau = ctau
         #Add noise
         if noise and self.snr > 0:
-            ntau = self.add_noise(self.snr, ntau, number)
+            key = (elem, ion, self.spec_res, self.snr)
+            try:
+                ntau = self.tau_noise[key]
+            except (AttributeError, KeyError):
+                #add_noise works in place, so copy the convolved spectra first.
+                ntau = self.add_noise(self.snr, np.array(ctau), -1)
+                self._cache("tau_noise")[key] = ntau
+        if number >= 0:
+            ntau = ntau[number,:]
         return ntau
 
+    def _line_data(self, elem, ion, ll):
+        """Data for a line. For ion -1 (all of the element in the absorbing state), use the first ion with this line."""
+        if ion != -1:
+            return self.lines[(elem, ion)][ll]
+        for ii in range(8):
+            try:
+                return self.lines[(elem, ii)][ll]
+            except KeyError:
+                continue
+        raise KeyError("No line "+str(ll)+" for "+str(elem))
+
+    def _observer_taus(self, elem, ion, results, particles):
+        """
+        Optical depth in each line of an ion, as (line, tau) pairs for _choose_observer_tau, each computed only
+        when it is needed, so that only one line not otherwise wanted is in memory at a time.
+        results - lines already computed by compute_batch, keyed by (elem, ion, line).
+        particles - particle data from _read_particle_data, for a snapshot with a single segment.
+                    If None, lines are computed with compute_spectra.
+        """
+        for ll in self.lines[(elem, ion)].keys():
+            if (elem, ion, ll) in results:
+                yield (ll, results[(elem, ion, ll)])
+            elif particles is None:
+                yield (ll, self.compute_spectra(elem, ion, ll, True))
+            elif particles[-1] is False:
+                yield (ll, np.zeros([self.NumLos, self.nbins], dtype=np.float32))
+            else:
+                yield (ll, self._do_interpolation_work(*(particles + (self._line_data(elem, ion, ll), True))))
+
+    def compute_batch(self, requests, force_recompute=False):
+        """
+        Compute several arrays for every sightline in one pass over the particles.
+        requests - list of (elem, ion, line). line is the wavelength of a line, for get_tau,
+                   or one of COLDEN (get_col_density), OBSERVER_TAU (get_observer_tau) or VELOCITY (get_velocity).
+        Arrays already in memory or in the save file are not recomputed, unless force_recompute is set.
+
+        Each segment of the snapshot is read, and the particles near the sightlines found, once.
+        The particle densities of each ion are then found once and interpolated for every array requested for that ion.
+        Results are stored in the same places as the single array methods store them, so those methods
+        afterwards return them without recomputing.
+        The observer tau is chosen one line at a time, as in get_observer_tau, so only the best line so far is kept.
+        For a snapshot with a single segment, lines are interpolated from the particles already read.
+        Otherwise a line only becomes complete after every segment has been read, so each line not also requested
+        has a further pass over the segments, reusing the particles found near the sightlines.
+        """
+        requests = [tuple(req) for req in requests]
+        #Optical depths to compute for each ion, and whether the column density, velocity and observer tau are needed.
+        todo = {}
+        for (elem, ion, ll) in requests:
+            if ll == OBSERVER_TAU:
+                (array, key) = (self.tau_obs, (elem, ion))
+            elif ll == COLDEN:
+                (array, key) = (self.colden, (elem, ion))
+            elif ll == VELOCITY:
+                (array, key) = (self.velocity, (elem, ion))
+            else:
+                (array, key) = (self.tau, (elem, ion, ll))
+            if key in array and not force_recompute:
+                continue
+            need = todo.setdefault((elem, ion), {"lines":set(), "colden":False, "velocity":False, "observer":False})
+            if ll == OBSERVER_TAU:
+                need["observer"] = True
+            elif ll == COLDEN:
+                need["colden"] = True
+            elif ll == VELOCITY:
+                need["velocity"] = True
+                #The velocity is weighted by the density
+                if (elem, ion) not in self.colden or force_recompute:
+                    need["colden"] = True
+            else:
+                need["lines"].add(ll)
+        if len(todo) == 0:
+            return
+        #Sum of the arrays over all segments
+        results = {}
+        for ((elem, ion), need) in todo.items():
+            for ll in need["lines"]:
+                results[(elem, ion, ll)] = np.zeros([self.NumLos, self.nbins], dtype=np.float32)
+            if need["colden"]:
+                results[(elem, ion, COLDEN)] = np.zeros([self.NumLos, self.nbins], dtype=np.float32)
+            if need["velocity"]:
+                results[(elem, ion, VELOCITY)] = np.zeros([self.NumLos, self.nbins, 3], dtype=np.float32)
+        #Line used when only the density is interpolated, as in _interpolate_single_file.
+        hline = self.lines[("H",1)][1215]
+        phys = self.dvbin/self.velfac*self.rscale
+        nsegments = self.snapshot_set.get_n_segments()
+        #Keep the particles near the sightlines for each segment, so they are found only once per segment.
+        cofm_final = self.cofm_final
+        self.cofm_final = True
+        try:
+            for fn in range(nsegments):
+                for ((elem, ion), need) in todo.items():
+                    #Velocities and temperatures are only read if needed.
+                    get_tau = len(need["lines"]) > 0 or need["velocity"] or need["observer"]
+                    particles = self._read_particle_data(fn, elem, ion, get_tau)
+                    (pos, velocity, elem_den, temp, hh, amumass) = particles
+                    if amumass is not False:
+                        for ll in need["lines"]:
+                            results[(elem, ion, ll)] += self._do_interpolation_work(pos, velocity, elem_den, temp, hh, amumass, self._line_data(elem, ion, ll), True)
+                        if need["colden"]:
+                            results[(elem, ion, COLDEN)] += self._do_interpolation_work(pos, velocity, elem_den, temp, hh, amumass, hline, False)
+                        if need["velocity"]:
+                            for ax in (0,1,2):
+                                weight = velocity[:,ax]*np.sqrt(self.atime)
+                                results[(elem, ion, VELOCITY)][:,:,ax] += self._do_interpolation_work(pos, velocity, elem_den*weight/phys, temp, hh, amumass, hline, False)
+                    if need["observer"] and nsegments == 1:
+                        self._choose_observer_tau(elem, ion, self._observer_taus(elem, ion, results, particles))
+                    del pos, velocity, elem_den, temp, hh, particles
+            if nsegments > 1:
+                for ((elem, ion), need) in todo.items():
+                    if need["observer"]:
+                        self._choose_observer_tau(elem, ion, self._observer_taus(elem, ion, results, None))
+        finally:
+            self.cofm_final = cofm_final
+            if not cofm_final:
+                self.part_ind = {}
+        #Store the results where the single array methods would
+        for ((elem, ion), need) in todo.items():
+            if need["colden"]:
+                self.colden[(elem, ion)] = results.pop((elem, ion, COLDEN))
+            if need["velocity"]:
+                velocity = results.pop((elem, ion, VELOCITY))
+                den = self.get_density(elem, ion)
+                den[np.where(den == 0.)] = 1
+                for ax in range(3):
+                    velocity[:,:,ax] /= den
+                self.velocity[(elem, ion)] = velocity
+            for ll in need["lines"]:
+                self.tau[(elem, ion, ll)] = results.pop((elem, ion, ll))
+
+    def vel_stats(self, elem, ion):
+        """
+           Find the velocity width, f_mm and f_edg statistics of an ion in a single pass over the spectra.
+           These are cached per (elem, ion, minwidth, snr, spec_res), so changing any of these
+           attributes gives fresh statistics, and saved with the spectra.
+
+           elem - element to look at
+           ion - ionisation state of this element.
+
+           Returns (v90, f_mm, f_edg), each an array with one entry per spectrum.
+        """
+        key = (elem, ion, self.minwidth, self.snr, self.spec_res)
+        try:
+            return self.vel_statistics[key]
+        except (AttributeError, KeyError):
+            pass
+        tau = self.get_observer_tau(elem, ion)
+        (low, high, offset) = self.find_absorber_width(elem, ion)
+        (nnlow, nnhigh, vel_median, vmax) = _vel_stat_kernel(tau, low, high, offset)
+        vel_width = self.dvbin*(nnhigh-nnlow)
+        vmean = (nnlow+nnhigh)/2.
+        mean_median = np.abs(vmean - vel_median)/((nnhigh-nnlow)/2.)
+        peak = np.abs(vmax - vmean)/((nnhigh-nnlow)/2.)
+        self._cache("vel_statistics")[key] = (vel_width, mean_median, peak)
+        return self.vel_statistics[key]
+
     def vel_width(self, elem, ion):
         """
            Find the velocity width of an ion.
@@ -160,21 +824,7 @@ class VWSpectra(ss.Spectra):
            elem - element to look at
            ion - ionisation state of this element.
         """
-        try:
-            return self.vel_widths[(elem, ion)]
-        except KeyError:
-            tau = self.get_observer_tau(elem, ion)
-            (low, high, offset) = self.find_absorber_width(elem, ion)
-            #  Size of a single velocity bin
-            vel_width = np.zeros(np.shape(tau)[0])
-            #deal with periodicity by making sure the deepest point is in the middle
-            for ll in np.arange(0, np.shape(tau)[0]):
-                tau_l = np.roll(tau[ll,:],offset[ll])[low[ll]:high[ll]]
-                (nnlow, nnhigh) = self._vel_width_bound(tau_l)
-                vel_width[ll] = self.dvbin*(nnhigh-nnlow)
-            #Return the width
-            self.vel_widths[(elem, ion)] = vel_width
-            return self.vel_widths[(elem, ion)]
+        return self.vel_stats(elem, ion)[0]
 
     def _vel_width_bound(self, tau):
         """Find the 0.05 and 0.95 bounds of the integrated optical depth"""
@@ -187,54 +837,19 @@ class VWSpectra(ss.Spectra):
         low = np.where(tdiff >= 0)[0][0]
         return (low, high)
 
-    def _vel_median(self, tau):
-        """Find the median point of the integrated optical depth"""
-        cum_tau = np.cumsum(tau)
-        #Use spline interpolation to find the edge of the bins.
-        tdiff = cum_tau - 0.5*cum_tau[-1]
-        high = np.where(tdiff >= 0)[0][0]
-        return high
-
     def vel_mean_median(self, elem, ion):
         """Find the difference between the mean velocity and the median velocity.
            The mean velocity is the point halfway across the extent of the velocity width.
            The median velocity is v(tau = tot_tau /2)
            """
-        tau = self.get_observer_tau(elem, ion)
-        (low, high, offset) = self.find_absorber_width(elem, ion)
-        mean_median = np.zeros(np.shape(tau)[0])
-        #Deal with periodicity by making sure the deepest point is in the middle
-        for ll in xrange(np.shape(tau)[0]):
-            tau_l = np.roll(tau[ll,:],offset[ll])[low[ll]:high[ll]]
-            (nnlow, nnhigh) = self._vel_width_bound(tau_l)
-            vel_median = self._vel_median(tau_l)
-            vmean = (nnlow+nnhigh)/2.
-            mean_median[ll] = np.abs(vmean - vel_median)/((nnhigh-nnlow)/2.)
-        #Return the width
-        return mean_median
+        return self.vel_stats(elem, ion)[1]
 
     def vel_peak(self, elem, ion):
         """
            Find the f_peak statistic for spectra in an ion.
            f_peak = (vel_peak - vel_mean) / (v_90/2)
         """
-        tau = self.get_observer_tau(elem, ion)
-        (low, high, offset) = self.find_absorber_width(elem, ion)
-        peak = np.zeros(np.shape(tau)[0])
-        #Deal with periodicity by making sure the deepest point is in the middle
-        for ll in xrange(np.shape(tau)[0]):
-            tau_l = np.roll(tau[ll,:],offset[ll])[low[ll]:high[ll]]
-            peak[ll] = self._vel_peak_tau(tau_l)
-        #Return the width
-        return peak
-
-    def _vel_peak_tau(self,tau_l):
-        """Helper function for a single spectrum to compute v_peak"""
-        (nnlow, nnhigh) = self._vel_width_bound(tau_l)
-        vmax = np.where(tau_l == np.max(tau_l))[0][0]
-        vmean = (nnlow+nnhigh)/2.
-        peak = np.abs(vmax - vmean)/((nnhigh-nnlow)/2.)
-        return peak
+        return self.vel_stats(elem, ion)[2]
 
     def vel_width_hist(self, elem, ion, dv=0.1):
         """
@@ -279,74 +894,184 @@ class VWSpectra(ss.Spectra):
         """
         return self._vel_stat_hist(elem, ion, dv, self.vel_peak, log=False)
 
+    def eq_width_hist(self, elem, ion, line, dv=0.05):
+        """
+        Compute a histogram of the equivalent width distribution of our spectra.
+        Bins are spaced by dv in log10 over EQ_WIDTH_LOGRANGE, so histograms from different spectra line up.
+
+        Returns:
+            (v, f_table) - v (binned in log) and corresponding f(N)
+        """
+        edges = 10**np.arange(EQ_WIDTH_LOGRANGE[0], EQ_WIDTH_LOGRANGE[1], dv)
+        hist = self.stat_histogram(elem, ion, self.equivalent_width, edges, log=True, filt=False, line=line)
+        return (hist.log_centres(), hist.density()[1])
+
     def get_separated(self, elem="Si", ion = 2, thresh = 1e-1, mindist=0):
         """
         Find spectra with more than a single density peak.
         Threshold is as a percentage of the maximum value.
-        mindist is in km/s
+        mindist is in km/s: regions closer than this are combined.
+        Returns (nregions, region_colden):
+            nregions - the number of separate regions in each filtered spectrum.
+            region_colden - the HI column density of each region, ordered by spectrum,
+                            so the regions of spectrum ii are region_colden[sum(nregions[:ii]):sum(nregions[:ii+1])]
         """
         dist = int(mindist/self.dvbin)
         ind = self.get_filt(elem, ion)
         rho = self.get_col_density(elem, ion)[ind]
         H1_den = self.get_col_density("H", 1)[ind]
-        seps = np.zeros(np.size(ind[0]), dtype=np.bool)
-        lls = 0
-        dla = 0
-        none = 0
-        #deal with periodicity by making sure the deepest point is in the middle
-        for ll in xrange(np.size(ind[0])):
-            rho_l = rho[ll,:]
-            H1_l = H1_den[ll,:]
-            lsep = ss.combine_regions(rho_l > thresh*np.max(rho_l), dist)
-            seps[ll] = (np.shape(lsep)[0] > 1)
-            if seps[ll] is False:
-                continue
-            m_H1_colden = np.array([np.sum(H1_l[lsep[jj,0]:lsep[jj,1]]) for jj in xrange(np.shape(lsep)[0])])
-            #All DLAs
-            if np.all(m_H1_colden > 10**(20.3)):
-                dla += 1
-            #Some LLS
-            elif np.all(m_H1_colden > 10**(17.)):
-                lls += 1
-            else:
-                none += 1
-        tot = dla + lls + none
-        print("Fraction DLA: ",1.*dla/tot," Fraction LLS: ",1.*lls/tot," fraction less: ",1.*none/tot)
-        return seps
+        (row, low, high) = _separated_regions(rho > thresh*np.max(rho, axis=1)[:, np.newaxis], dist)
+        nregions = np.bincount(row, minlength=np.shape(rho)[0])
+        #Sum the HI in each region: every other interval of the flattened array.
+        nbins = np.shape(H1_den)[1]
+        bounds = np.ravel(np.column_stack([row*nbins+low, row*nbins+high]))
+        if np.size(bounds) > 0:
+            region_colden = np.add.reduceat(np.append(np.ravel(H1_den), 0), bounds)[::2]
+        else:
+            region_colden = np.zeros(0)
+        #All DLAs
+        dla = np.bincount(row, weights=(region_colden <= 10**(20.3)), minlength=np.shape(rho)[0]) == 0
+        #Some LLS
+        lls = np.logical_and(np.logical_not(dla), np.bincount(row, weights=(region_colden <= 10**(17.)), minlength=np.shape(rho)[0]) == 0)
+        tot = np.size(nregions)
+        none = tot - np.sum(dla) - np.sum(lls)
+        print("Fraction DLA: ",1.*np.sum(dla)/tot," Fraction LLS: ",1.*np.sum(lls)/tot," fraction less: ",1.*none/tot)
+        return (nregions, region_colden)
 
-    def get_filt(self, elem, ion, thresh = 100):
+    def get_max_density(self, elem, ion):
+        """Get the maximum density of an ion along each spectrum.
+        This is cached per (elem, ion), and saved with the spectra.
+        If lazy_arrays is set and the column density is not in memory, it is read from the save file in chunks."""
+        try:
+            return self.max_density[(elem, ion)]
+        except (AttributeError, KeyError):
+            pass
+        met = self._reduce_density(elem, ion, np.max)
+        self._cache("max_density")[(elem, ion)] = met
+        return met
+
+    def _reduce_density(self, elem, ion, func):
         """
-        Get an index list to exclude spectra where the ion is too small, usually the result of
-        unresolved star formation.
+        Reduce the density of an ion along each spectrum, as func(self.get_density(elem, ion), axis=1).
+        If lazy_arrays is set and the column density is not in memory, it is read from the save file in chunks.
+        """
+        try:
+            lazy = self._lazy_array((elem, ion), self.colden, "colden")
+        except KeyError:
+            lazy = None
+        if lazy is None:
+            return func(self.get_density(elem, ion), axis=1)
+        phys = self.dvbin/self.velfac*self.rscale
+        return lazy.reduce(lambda colden, axis: func(colden/phys, axis=axis), axis=1)
 
-        thresh - observable density threshold
+    def get_metallicity(self, width=0.):
+        """Return the metallicity, as M/H.
+        If width > 0, computes M/H +- width km/s from the maximum H peak.
+        The metallicity of the whole spectrum, width = 0, is cached and saved with the spectra."""
+        if width > 0:
+            return ss.Spectra.get_metallicity(self, width)
+        try:
+            return self.metallicities[0.]
+        except (AttributeError, KeyError):
+            pass
+        mms = self._reduce_density("Z", -1, np.sum)
+        hhs = self._reduce_density("H", -1, np.sum)
+        met = mms/hhs/self.solarz
+        self._cache("metallicities")[0.] = met
+        return met
+
+    def equivalent_width(self, elem, ion, line):
+        """Calculate the equivalent width of a line in Angstroms.
+        This is cached per (elem, ion, line, snr, spec_res), and saved with the spectra."""
+        key = (elem, ion, line, self.snr, self.spec_res)
+        try:
+            return self.eq_widths[key]
+        except (AttributeError, KeyError):
+            pass
+        eq_width = ss.Spectra.equivalent_width(self, elem, ion, line)
+        self._cache("eq_widths")[key] = eq_width
+        return eq_width
+
+    def _filter_mask(self, elem, ion, thresh):
+        """
+        Boolean mask of the spectra where the ion is observable.
+        Child classes may override this to use other criteria: they should then also change filt_label.
         """
         #Remember this is not in log.
-        met = np.max(self.get_density(elem, ion), axis=1)
+        met = self.get_max_density(elem, ion)
         #vw = self.vel_width(elem, ion)
         phys = self.dvbin/self.velfac*self.rscale
-        ind = np.where(met > thresh/phys)
-        return ind
+        return met > thresh/phys
+
+    def get_filt_mask(self, elem, ion, thresh = 100):
+        """
+        Get a boolean mask which excludes spectra where the ion is too small, usually the result of
+        unresolved star formation. The criteria are given by _filter_mask.
+
+        thresh - observable density threshold
+        Masks are cached per (elem, ion, thresh, snr, spec_res) for each filt_label, and saved with the spectra.
+        """
+        key = (elem, ion, thresh, self.snr, self.spec_res)
+        try:
+            return self.filt_ind[self.filt_label][key][0]
+        except (AttributeError, KeyError):
+            pass
+        mask = self._filter_mask(elem, ion, thresh)
+        self._cache("filt_ind").setdefault(self.filt_label, {})[key] = (mask, np.where(mask))
+        return mask
+
+    def get_filt(self, elem, ion, thresh = 100):
+        """
+        Get an index list to exclude spectra where the ion is too small, usually the result of
+        unresolved star formation. This is the index list for get_filt_mask, and is cached with it.
+
+        thresh - observable density threshold
+        """
+        self.get_filt_mask(elem, ion, thresh)
+        return self.filt_ind[self.filt_label][(elem, ion, thresh, self.snr, self.spec_res)][1]
+
+    def stat_histogram(self, elem, ion, func, edges, log=True, filt=True, line=None):
+        """
+           Histogram of a statistic with one value per spectrum, func(elem, ion), or func(elem, ion, line) if line is given,
+           with fixed bin edges. The StatHistogram returned can be merged with those of other spectra.
+           log - bin in log10 of the statistic.
+           filt - only include spectra passing get_filt.
+           Histograms are cached per statistic, filter, (elem, ion, line), minwidth, snr, spec_res and bins,
+           and saved with the spectra.
+        """
+        if filt:
+            label = self.filt_label
+        else:
+            label = ""
+        if line is None:
+            line = 0
+        key = (func.__name__, label, elem, ion, line, bool(log), self.minwidth, self.snr, self.spec_res, tuple(np.array(edges, dtype=np.float64)))
+        try:
+            return self.stat_hists[key]
+        except (AttributeError, KeyError):
+            pass
+        if line > 0:
+            stat = func(elem, ion, line)
+        else:
+            stat = func(elem, ion)
+        #Filter small number of spectra without metals
+        if filt:
+            stat = stat[self.get_filt(elem, ion)]
+        hist = stathist.StatHistogram(edges, log).update(stat)
+        self._cache("stat_hists")[key] = hist
+        return hist
 
     def _vel_stat_hist(self, elem, ion, dv, func, log=True, filt=True):
         """
            Internal function that finds the histogram in velocity space of
            the values of a statistic for a particular ion.
+           If log, bins are spaced by dv in log10 between 10 and 10^VEL_WIDTH_LOGMAX, otherwise by dv from 0 to 1.
+           dv may also be an array of bin edges.
         """
-        #Filter small number of spectra without metals
-        vel_width = func(elem, ion)
-        if filt:
-            ind = self.get_filt(elem, ion)
-            vel_width = vel_width[ind]
         if np.size(dv) > 1:
             v_table = dv
         elif log:
-            v_table = 10**np.arange(1, np.min((50,np.log10(np.max(vel_width)))), dv)
+            v_table = 10**np.arange(1, VEL_WIDTH_LOGMAX, dv)
         else:
             v_table = np.arange(0, 1, dv)
-        vbin = np.array([(v_table[i]+v_table[i+1])/2. for i in range(0,np.size(v_table)-1)])
-        if log:
-            vels = np.histogram(np.log10(vel_width),np.log10(v_table), density=True)[0]
-        else:
-            vels = np.histogram(vel_width,v_table, density=True)[0]
-        return (vbin, vels)
+        return self.stat_histogram(elem, ion, func, v_table, log, filt).density()